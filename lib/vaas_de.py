@@ -1,20 +1,40 @@
-import csv, json, yaml
-from io import StringIO
+import csv, json, yaml, re
+import hashlib
+import gzip
+import copy
+import itertools
+import bisect
+from io import StringIO, BytesIO
+import importlib
 import requests
 import logging
 import datetime
+import decimal
 from dateutil.parser import parse
 from dateutil.tz import gettz
 from dateutil.relativedelta import relativedelta
 import pytz
 import psycopg2
+import psycopg2.pool
+import sqlite3
 
 import os
+import threading
+import queue
+import time
+import random
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import collections
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning) # https://stackoverflow.com/questions/27981545/suppress-insecurerequestwarning-unverified-https-request-is-being-made-in-pytho
 
 import sys, traceback
+import tempfile, shutil
+import contextlib
+import cProfile, pstats, tracemalloc
 
 
 import smtplib
@@ -30,6 +50,15 @@ with open('global_config/vaas_lib.yml', 'rb') as input:
 			
 dbONE_API_headers= {'Content-Type': 'text/xml;charset=UTF-8'}
 
+# <TimeDef> startTime/endTime format, e.g. 2018-05-15_00:00:00
+dbONE_time_format = '%Y-%m-%d_%H:%M:%S'
+
+dbONE_resolutions = {'ONE_MINUTE': relativedelta(minutes=1), 'FIVE_MINUTES': relativedelta(minutes=5), 'ONE_HOUR': relativedelta(hours=1),
+                     'ONE_DAY': relativedelta(days=1), 'ONE_WEEK': relativedelta(weeks=1), 'ONE_MONTH': relativedelta(months=1)}
+# dbONE functions computed within every time bucket, so they give the same rows whether the window is queried at once or in shards.
+# Others (TopN ranks over the whole window) keep a query from being sharded
+dbONE_shardable_functions = ['Percent']
+
 service_mappings_separator=vaas_lib['Output_Separator']
 output_separator=vaas_lib['Output_Separator']
 
@@ -45,12 +74,143 @@ tzinfos= dict()
 for code, timezone in vaas_lib['Tzinfos'].items(): 
 	tzinfos[code] = gettz(timezone)
 	
-
-def query_dbONE(host, port, query, username, password, ssl=True, headers=dbONE_API_headers, api_version=None, verify=False, conversion='true',DT='csv', encrypted='false'):
+# Identical upstream calls issued by pipelines running in the same process are coalesced: 
+# the first caller performs the request and every other caller waits for and shares its response.
+# A response is dropped once it has been handed to the callers waiting for it, unless 'ttl' (seconds, 0 by default) keeps
+# completed responses for pipelines starting slightly later, at the cost of holding their bodies in memory.
+
+coalescing = vaas_lib.get('Coalescing') or {}
+coalescing_enabled = coalescing.get('enabled', True)
+coalescing_ttl = coalescing.get('ttl', 0)
+
+_coalesced_calls = {}
+_coalesced_calls_lock = threading.Lock()
+
+# Mapping files (service_mappings/*.cfg) are read once per process
+_mapping_files = {}
+_mapping_indexes = {}
+_mapping_files_lock = threading.Lock()
+
+# Rows fetched per round trip by the server-side cursor of query_psql
+psql_batch_size = vaas_lib.get('Psql_Batch_Size', 10000)
+
+# optional columnar transformation backend: 'python', 'pandas' or 'auto' (pandas when it is installed)
+transformation_backend = vaas_lib.get('Transformation_Backend', 'auto')
+columnar_chunk_size = vaas_lib.get('Columnar_Chunk_Size', 100000)
+columnar_min_rows = vaas_lib.get('Columnar_Min_Rows', 10000)
+# pandas is only imported when an extract is large enough to use it
+_pandas = None
+
+# large extracts are transformed in chunks on a pool of worker processes (workers: 0 is one per CPU), started with
+# start_method ('forkserver', or 'spawn' where there is no forkserver) once min_rows records have been transformed in process
+transformation_processes = {'enabled': True, 'workers': 0, 'min_rows': 200000, 'chunk_size': 50000, 'start_method': 'forkserver'}
+transformation_processes.update(vaas_lib.get('Transformation_Processes') or {})
+# plan of the transformation run by a worker process, set once when the worker starts
+_process_plan = None
+
+# local store of nGPulse 5 minute trends (one file per feed and day), and its rollup periods
+trend_store_settings = {'directory': 'trend_store', 'retention_days': 400}
+trend_store_settings.update(vaas_lib.get('Trend_Store') or {})
+# (start of the period of a naive local time, length of the period), see _trend_period
+trend_rollups = {'hourly': (lambda time: time.replace(minute=0, second=0, microsecond=0), relativedelta(hours=1)),
+                 'daily': (lambda time: time.replace(hour=0, minute=0, second=0, microsecond=0), relativedelta(days=1)),
+                 'monthly': (lambda time: time.replace(day=1, hour=0, minute=0, second=0, microsecond=0), relativedelta(months=1))}
+_trend_store_lock = threading.Lock()
+
+# id -> name indexes of dimensions, for the <column>_String columns of dbONE queries sent with conversion=false (see dimension_names).
+# Kept per postGres datasource in 'directory' and extracted again once older than 'refresh' seconds
+dimension_cache_settings = {'directory': 'dimension_cache', 'refresh': 86400, 'timezone': vaas_lib['Timezone'], 'columns': {}}
+dimension_cache_settings.update(vaas_lib.get('Dimension_Cache') or {})
+_dimension_indexes = {}
+_dimension_indexes_lock = threading.Lock()
+
+# Partitioned outputs (service 'partition_by'): files kept open at most, the others are closed and appended to when their rows come back
+partition_settings = {'max_open_files': 64}
+partition_settings.update(vaas_lib.get('Partitions') or {})
+
+# nGPulse responses are decoded from the bytes of their body, with orjson when it is installed ('library': auto, orjson or json).
+# With ijson installed and 'incremental', the entries of 'data' are decoded one at a time instead of building the whole document,
+# and with 'stream' while the body is still arriving (streamed calls are not coalesced)
+json_settings = {'library': 'auto', 'incremental': True, 'stream': False}
+json_settings.update(vaas_lib.get('JSON') or {})
+_json_libraries = {}
+
+# Catalogs of nGPulse tests kept by every run (one file per host and test type), from which vaaspipe --explain selects the tests of a query
+# without calling nGPulse. 'trend_interval': seconds between the trend points of a nGPulse trend query, for its row estimate
+explain_settings = {'catalog_directory': 'catalog_cache', 'trend_interval': 300}
+explain_settings.update(vaas_lib.get('Explain') or {})
+_catalog_lock = threading.Lock()
+
+# nGPulse group and test type name of the test categories, as queried by their query_nGPulse_* extractor
+nGPulse_test_types = {'VoIP Test': ('VoIP', 'VoipPulse'), 'Latency Test': ('latency', 'latency'), 'Ping Test': ('ping', 'ping'),
+                      'Web Test': ('Web', 'Web'), 'O365 OneDrive Test': ('o365AccountOneDrive', 'o365AccountOneDrive'),
+                      'O365 Outlook Test': ('o365AccountOutlook', 'o365AccountOutlook')}
+
+# Timeouts, retries and circuit breaking of every upstream HTTP call. Datasources can override any of these in an 'http' section.
+
+http_settings = {'connect_timeout': 10, 'read_timeout': 300, 'retries': 3, 'backoff': 1, 'max_backoff': 30,
+                 'breaker_failures': 5, 'breaker_reset': 60}
+http_settings.update(vaas_lib.get('HTTP') or {})
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+# failures of a call, or of reading its body, that another attempt may not have (raw streamed bodies raise the urllib3 ones)
+_http_retried_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError,
+                        urllib3.exceptions.HTTPError)
+
+# Rate and concurrency limits of every datasource (token bucket plus in-flight limit), see _Governor.
+# A datasource overrides them with a 'governor' section ('http' section for nG1 and nGPulse, 'postGres' section for PostgreSQL)
+governor_settings = {'rate': 0, 'burst': 1, 'max_in_flight': 0, 'adaptive': False, 'target_latency': 30}
+governor_settings.update(vaas_lib.get('Governor') or {})
+_governors = {}
+_governors_lock = threading.Lock()
+
+# Several sinks of one pipeline (Notifications 'sinks'): rows are handed to every sink in chunks of 'chunk_size', with at most
+# 'queue_chunks' chunks waiting per sink
+sink_settings = {'chunk_size': 1000, 'queue_chunks': 16}
+sink_settings.update(vaas_lib.get('Sinks') or {})
+
+# Several datasources or sites merged into one feed (merge_sources): every source hands its records over in chunks of
+# 'chunk_size', with at most 'queue_chunks' chunks waiting per source
+source_settings = {'chunk_size': 1000, 'queue_chunks': 16}
+source_settings.update(vaas_lib.get('Sources') or {})
+
+# Column types of the tables created for 'Types' declarations of the transformations
+sqlite_column_types = {'int': 'INTEGER', 'float': 'REAL', 'datetime': 'TEXT'}
+psql_column_types = {'int': 'BIGINT', 'float': 'DOUBLE PRECISION', 'datetime': 'TIMESTAMPTZ'}
+# Text sinks (CSV file, email) write datetime columns with the 'format' of their declaration, this one by default
+datetime_text_format = '%d-%m-%Y %H:%M:%S'
+
+# Per-pipeline state (deadline, log file) of the pipeline running in the current thread
+_pipeline = threading.local()
+
+# Stage profiler of the run (vaaspipe --profile), see start_profile
+_profile = None
+
+class DeadlineExceeded(Exception):
+	pass
+
+class CircuitOpen(Exception):
+	pass
+
+
+def query_dbONE(host, port, query, username, password, ssl=True, headers=dbONE_API_headers, api_version=None, verify=False, conversion='true',DT='csv', encrypted='false', http=None, shards=None, columns=None, names=None):
 	'''
 	Builds DBONE API query.
 	Format as of nG1 6.1 is of type: https://192.168.99.18:8443/dbonequerydata/?username=svc-dBONE/password=F34Mu93S7Rv6/encrypted=false/conversion=true/DT=csv 
 	
+	shards: optional {'interval': relativedelta params, 'max_workers': N}. Splits the <TimeDef> window into sub-windows of 'interval'
+	that are queried concurrently (at most max_workers at a time) and merged back in time order. 
+	e.g. {'interval': {'days': 1}, 'max_workers': 4}
+	With a 'resolution' finer than the query's (e.g. ONE_DAY shards of a ONE_MONTH query), the rows of the shards are rolled back
+	up to the buckets of the query, see _dbONE_rollup
+	
+	columns: optional names of the columns the pipeline uses, see dbONE_projection
+	names: optional {column: {id: name}} (see dimension_names). The query is then sent with conversion=false and the
+	<column>_String columns of names and targetTime are added locally
+	
+	Returns a generator of records: the header and then one tuple per row. Before records were streamed, the same rows were returned as separator-joined lines:
+	
 	Output Format:
 	['serviceId\ttargetTime\tfailedTransactions\ttotalTransactions\tresponseTime\tfailedPercentage\tserviceId_String\ttargetTime_String', '122029775\t1535256000000\t0\t67407\t139304.6454063840\t0.0000000000\tO365 Authentication (Pune)\tSun Aug 26 00:00:00 EDT 2018', '122030298\t1535256000000\t0\t714182\t291171.5849273787\t0.0000000000\tO365 Exchange (Pune)\tSun Aug 26 00:00:00 EDT 2018', '148578737\t1535256000000\t0\t38039\t317043.3394678725\t0.0000000000\tSalesForce (Pune)\tSun Aug 26 00:00:00 EDT 2018']
 	'''
@@ -59,42 +219,632 @@ def query_dbONE(host, port, query, username, password, ssl=True, headers=dbONE_A
 	protocol = get_protocol(ssl)
 	print(protocol)
 	
+	# read the query up-front so identical queries from several pipelines can be coalesced
+	if hasattr(query, 'read'):
+		query = query.read()
+	
+	if columns is not None:
+		query, conversion = dbONE_projection(query, _dbONE_rollup_columns(columns, shards), conversion)
+	if names is not None:
+		conversion = 'false'
+	
 	query_url= protocol+host+':'+str(port)+'/dbonequerydata/?username='+username+'/password='+password+'/encrypted='+encrypted+'/conversion='+conversion+'/DT='+DT
 	
 	logging.info(query_url)
 	
-	api_response = requests.post(query_url, headers=headers, data=query, verify=verify)
-	
-	reader = csv.DictReader(StringIO(api_response.text), delimiter=",", quotechar='"')
+	now = datetime.datetime.now(tz)
+	queries = _dbONE_shard_queries(query, shards, now) if shards else [query]
 	
-	response=StringIO()
-	writer = csv.DictWriter(response, reader.fieldnames, delimiter=output_separator)
-	writer.writeheader()
-	writer.writerows(reader)
-	return response.getvalue().strip().split("\r\n")
+	if len(queries) == 1:
+		api_responses = [_http_post(query_url, data=query, headers=headers, verify=verify, http=http)]
+	else:
+		post = _pipeline_task(lambda shard: _http_post(query_url, data=shard, headers=headers, verify=verify, http=http))
+		with ThreadPoolExecutor(max_workers=shards.get('max_workers', 4)) as executor:
+			# map() returns the responses in submission order, i.e. in time order
+			api_responses = list(executor.map(post, queries))
+	
+	records = _dbONE_records(api_responses)
+	if queries != [query] and _dbONE_rolls_up(query, shards):
+		records = _dbONE_rollup(records, query, shards, now)
+	if names is not None:
+		return _dbONE_enrich(records, names)
+	return records
+
+def _dbONE_records(api_responses):
+	'''
+	Yields the header and the rows of one or more dbONE CSV responses (sub-windows of the same query, in time order)
+	'''
+	header = None
+	for api_response in api_responses:
+		reader = csv.reader(StringIO(api_response.text), delimiter=",", quotechar='"')
+		shard_header = next(reader, None)
+		if shard_header is None:
+			# empty sub-window
+			continue
+		if header is None:
+			header = tuple(shard_header)
+			yield header
+		for row in reader:
+			if not row:
+				continue
+			if len(row) < len(header):
+				row += [''] * (len(header) - len(row))
+			yield tuple(row)
+
+def _dbONE_enrich(records, names):
+	'''
+	Adds the <column>_String columns nG1 adds with conversion=true, after the other columns and in their order:
+	names of the columns in names, looked up in their index (unknown ids are kept as they are), and targetTime as a date
+	'''
+	header = next(records, None)
+	if header is None:
+		return
+	converted = [index for index, column in enumerate(header) if column in names or column == 'targetTime']
+	yield header + tuple(header[index] + '_String' for index in converted)
+	
+	timezone = pytz.timezone(dimension_cache_settings['timezone'])
+	times = {}
+	for row in records:
+		strings = []
+		for index in converted:
+			value = row[index]
+			if header[index] == 'targetTime':
+				if value not in times:
+					times[value] = _dbONE_time(value, timezone)
+				strings.append(times[value])
+			else:
+				strings.append(names[header[index]].get(value, value))
+		yield row + tuple(strings)
+
+def _dbONE_time(value, timezone):
+	# epoch milliseconds as nG1 formats them (Java Date), e.g. Sun Jul 01 00:00:00 EDT 2018
+	if not value:
+		return ''
+	return datetime.datetime.fromtimestamp(int(value) / 1000.0, timezone).strftime('%a %b %d %H:%M:%S %Z %Y')
+
+def dimension_names(columns, postgres=None):
+	'''
+	{column: {id: name}} of the <column>_String columns in columns, for query_dbONE names, from the local dimension cache
+	('Dimension_Cache' 'columns' in vaas_lib.yml). targetTime needs no index.
+	None when one of them has no configured dimension or no index could be loaded: nG1 then converts the query.
+	postgres: the postGres datasource the dimensions are extracted from
+	'''
+	names = {}
+	for column in columns:
+		if not column.endswith('_String') or column == 'targetTime_String':
+			continue
+		column = column[:-len('_String')]
+		dimension = dimension_cache_settings['columns'].get(column)
+		if dimension is None or postgres is None:
+			logging.info("No local dimension for %s_String, nG1 converts the query", column)
+			return None
+		index = _dimension_index(dimension, postgres)
+		if index is None:
+			return None
+		names[column] = index
+	return names
+
+def _dimension_index(dimension, postgres):
+	'''
+	id -> name index of a dimension: from memory or from its cache file while fresh, otherwise extracted again.
+	A stale index is still used when the extract fails
+	'''
+	name = os.path.splitext(os.path.basename(dimension['query_file']))[0] + '_' + str(dimension['id_column']) + '_' + str(dimension['name_column'])
+	path = os.path.join(dimension_cache_settings['directory'], str(postgres.get('host')) + '_' + str(postgres.get('dbname')), name + '.json.gz')
+	
+	with _dimension_indexes_lock:
+		cached = _dimension_indexes.get(path)
+		if cached is None and os.path.exists(path):
+			with gzip.open(path, 'rt', encoding='utf-8') as input:
+				cached = json.load(input)
+		if cached is not None and time.time() - cached['extracted'] < dimension_cache_settings['refresh']:
+			_dimension_indexes[path] = cached
+			return cached['names']
+		
+		try:
+			extracted = time.time()
+			names = {}
+			for row in query_psql(postgres.get('host'), postgres.get('user'), postgres.get('password'), postgres.get('dbname'),
+			                      dimension['query_file'], governor=postgres.get('governor')):
+				names[row[dimension['id_column']]] = row[dimension['name_column']]
+		except Exception as e:
+			if cached is None:
+				logging.error("Cannot extract dimension %s: %s", name, repr(e))
+				return None
+			logging.warning("Cannot refresh dimension %s, using the one extracted at %s: %s", name, time.ctime(cached['extracted']), repr(e))
+			_dimension_indexes[path] = cached
+			return cached['names']
+		
+		cached = {'extracted': extracted, 'names': names}
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as output:
+			json.dump(cached, output)
+		os.replace(path + '.tmp', path)
+		logging.info("Dimension %s extracted: %i names", name, len(names))
+		_dimension_indexes[path] = cached
+		return names
+
+def dbONE_template(query, site):
+	'''
+	Query of one site of a templated dbONE query: every {name} of the query is replaced with the value of name in site
+	(e.g. {'site': 'Allen', 'networkServiceId': 174327696})
+	'''
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	for name, value in site.items():
+		text = text.replace('{' + str(name) + '}', str(value))
+	missing = re.findall(r'\{(\w+)\}', re.sub(r'<!--.*?-->', '', text, flags=re.S))
+	if missing:
+		raise Exception('No value of ' + ', '.join(sorted(set(missing))) + ' for site ' + str(site.get('site')))
+	return text.encode('utf-8') if isinstance(query, bytes) else text
+
+def dbONE_projection(query, columns, conversion='true'):
+	'''
+	Rewrites the <SelectColumnList> of a dbONE query down to columns (<column>_String stands for <column>) and the operands of
+	the selected <FunctionList> functions. Functions whose column is dropped are dropped too.
+	Returns (query, conversion): conversion becomes 'false' when no _String column is used.
+	targetTime is always kept. Other selected columns that split rows (e.g. errorCode) are aggregated away when they are dropped,
+	so they must be in columns
+	'''
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	
+	needed = set(column[:-len('_String')] if column.endswith('_String') else column for column in columns)
+	# the time bucket of every row
+	needed.add('targetTime')
+	if conversion == 'true' and not any(column.endswith('_String') for column in columns):
+		conversion = 'false'
+	
+	select = re.search(r'<SelectColumnList>(.*?)</SelectColumnList>', text, re.S)
+	if select is None:
+		logging.warning("dbONE query has no <SelectColumnList>, not projecting it")
+		return query, conversion
+	selected = re.findall(r'<ClientColumn>\s*([^<]*?)\s*</ClientColumn>', re.sub(r'<!--.*?-->', '', select.group(1), flags=re.S))
+	
+	functions = list(re.finditer(r'<Function>(.*?)</Function>', text, re.S))
+	for function in functions:
+		fields = dict(re.findall(r'<(\w+)>\s*([^<]*?)\s*</\1>', function.group(1)))
+		if fields.get('ClientColumn') in needed:
+			needed.update(value for name, value in fields.items() if value in selected)
+	
+	kept = [column for column in selected if column in needed]
+	if not kept or len(kept) == len(selected):
+		return query, conversion
+	logging.info("dbONE projection: %i of %i columns (%s)", len(kept), len(selected), ','.join(kept))
+	
+	projected = text[:select.start()] + '<SelectColumnList>\n' + ''.join('<ClientColumn>' + column + '</ClientColumn>\n' for column in kept) + '</SelectColumnList>'
+	end = select.end()
+	for function in functions:
+		if function.start() < end:
+			continue
+		fields = dict(re.findall(r'<(\w+)>\s*([^<]*?)\s*</\1>', function.group(1)))
+		projected += text[end:function.start()]
+		if fields.get('ClientColumn') in kept:
+			projected += function.group(0)
+		end = function.end()
+	projected += text[end:]
+	
+	return (projected.encode('utf-8') if isinstance(query, bytes) else projected), conversion
+
+def _dbONE_shard_queries(query, shards, now=None):
+	'''
+	Rewrites the <TimeDef> of a dbONE query into one query per sub-window of shards['interval'], with explicit startTime/endTime.
+	Returns [query] whenever the shards could give other rows than the single query: when the window cannot be resolved, when the
+	resolution is missing or not one of dbONE_resolutions (NO_RESOLUTION aggregates the whole window), when the interval is not a
+	whole multiple of the resolution, or when the query has functions that are not dbONE_shardable_functions (e.g. TopN).
+	shards['resolution'] (optional) queries the shards at finer buckets that _dbONE_rollup adds back up. The buckets of the query
+	then have to be whole multiples of it, and the operands of its Percent functions have to be summed (shards['aggregations']).
+	'''
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	
+	time_def = re.search(r'<TimeDef>(.*?)</TimeDef>', text, re.S)
+	if time_def is None:
+		logging.warning("dbONE query has no <TimeDef>, not sharding it")
+		return [query]
+	
+	fields = _dbONE_time_fields(time_def.group(1))
+	
+	window = _dbONE_window(fields, now or datetime.datetime.now(tz))
+	if window is None:
+		logging.warning("Cannot resolve dbONE window %s, not sharding it", fields)
+		return [query]
+	start_time, end_time = window
+	
+	resolution = fields.get('resolution')
+	if resolution not in dbONE_resolutions:
+		logging.warning("dbONE query resolution %s is not a time bucket, not sharding it", resolution)
+		return [query]
+	
+	functions = [function for function in re.findall(r'<Function>.*?<name>\s*([^<]*?)\s*</name>', re.sub(r'<!--.*?-->', '', text, flags=re.S), re.S)
+	             if function not in dbONE_shardable_functions]
+	if functions:
+		logging.warning("dbONE query has %s functions over the whole window, not sharding it", ','.join(functions))
+		return [query]
+	
+	shard_resolution = shards.get('resolution') or resolution
+	if shard_resolution != resolution:
+		if shard_resolution not in dbONE_resolutions:
+			logging.warning("dbONE shard resolution %s is not a time bucket, not sharding the query", shard_resolution)
+			return [query]
+		if not _dbONE_aligned(start_time, [bucket_end for bucket_start, bucket_end in _dbONE_buckets(start_time, end_time, resolution)], dbONE_resolutions[shard_resolution]):
+			logging.warning("The %s buckets of the dbONE query are not whole multiples of %s, not sharding it", resolution, shard_resolution)
+			return [query]
+		aggregations = shards.get('aggregations') or {}
+		for column, (numerator, denominator) in _dbONE_percents(text).items():
+			if aggregations.get(numerator) != 'sum' or aggregations.get(denominator) != 'sum':
+				logging.warning("dbONE Percent %s cannot be rolled up unless %s and %s are summed, not sharding the query", column, numerator, denominator)
+				return [query]
+	
+	interval = relativedelta(**shards['interval'])
+	boundaries = []
+	shard_start = start_time
+	while shard_start < end_time:
+		boundaries.append((shard_start, min(shard_start + interval, end_time)))
+		shard_start = boundaries[-1][1]
+	if not _dbONE_aligned(start_time, [shard_end for shard_start, shard_end in boundaries], dbONE_resolutions[shard_resolution]):
+		logging.warning("Shard interval %s is not a whole multiple of the %s resolution, not sharding the query", shards['interval'], shard_resolution)
+		return [query]
+	
+	queries = []
+	for shard_start, shard_end in boundaries:
+		shard_time_def = '<TimeDef>\n<startTime>' + shard_start.strftime(dbONE_time_format) + '</startTime>\n<endTime>' + shard_end.strftime(dbONE_time_format) + '</endTime>\n'
+		if shard_resolution:
+			shard_time_def += '<resolution>' + shard_resolution + '</resolution>\n'
+		shard_time_def += '</TimeDef>'
+		shard = text[:time_def.start()] + shard_time_def + text[time_def.end():]
+		queries.append(shard.encode('utf-8') if isinstance(query, bytes) else shard)
+	
+	logging.info("dbONE query split in %i sub-windows from %s to %s", len(queries), start_time, end_time)
+	return queries
+
+def _dbONE_buckets(start, end, resolution):
+	'''
+	(start, end) of the buckets of a dbONE resolution (a dbONE_resolutions name) in the window from start to end
+	'''
+	buckets = []
+	bucket_start = start
+	while bucket_start < end:
+		buckets.append((bucket_start, min(bucket_start + dbONE_resolutions[resolution], end)))
+		bucket_start = buckets[-1][1]
+	return buckets
+
+def _dbONE_percents(text):
+	'''
+	{column: (numerator, denominator)} of the Percent functions of a dbONE query
+	'''
+	percents = {}
+	for function in re.findall(r'<Function>(.*?)</Function>', re.sub(r'<!--.*?-->', '', text, flags=re.S), re.S):
+		fields = dict(re.findall(r'<(\w+)>\s*([^<]*?)\s*</\1>', function))
+		if fields.get('name') == 'Percent':
+			percents[fields.get('ClientColumn')] = (fields.get('numerator'), fields.get('denominator'))
+	return percents
+
+def _dbONE_rolls_up(query, shards):
+	# True when the shards query finer buckets than the query itself, to be rolled up by _dbONE_rollup
+	if not shards or not shards.get('resolution'):
+		return False
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	time_def = re.search(r'<TimeDef>(.*?)</TimeDef>', text, re.S)
+	return time_def is not None and _dbONE_time_fields(time_def.group(1)).get('resolution') != shards['resolution']
+
+def _dbONE_rollup_columns(columns, shards):
+	# columns a projected query needs: with the weights of the averages of a rollup
+	if not shards or not shards.get('resolution'):
+		return columns
+	return list(columns) + [aggregation['avg'] for aggregation in (shards.get('aggregations') or {}).values() if isinstance(aggregation, dict)]
+
+def _dbONE_rollup(records, query, shards, now):
+	'''
+	Adds the rows of shards queried at shards['resolution'] back up to the buckets of the query's own resolution, e.g. the days of a
+	month to one row per month. Rows are grouped per bucket and key (shards['key_columns'], by default the ...Id columns, with their
+	_String). The other columns are aggregated as in shards['aggregations']: sum, min, max or {'avg': weight column} (e.g. the
+	responseTime averaged over totalTransactions); Percent functions of the query are computed again from their summed operands and
+	any other column is left empty. targetTime (and targetTime_String) become the start of the bucket
+	'''
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	fields = _dbONE_time_fields(re.search(r'<TimeDef>(.*?)</TimeDef>', text, re.S).group(1))
+	start_time, end_time = _dbONE_window(fields, now)
+	buckets = [bucket_start for bucket_start, bucket_end in _dbONE_buckets(start_time, end_time, fields['resolution'])]
+	percents = _dbONE_percents(text)
+	aggregations = shards.get('aggregations') or {}
+	timezone = pytz.timezone(dimension_cache_settings['timezone'])
+	
+	header = next(records, None)
+	if header is None:
+		return
+	yield header
+	
+	key_columns = shards.get('key_columns') or [column for column in header if column.endswith('Id')]
+	keys = [index for index, column in enumerate(header)
+	        if column in key_columns or (column.endswith('_String') and column[:-len('_String')] in key_columns)]
+	time_index = header.index('targetTime') if 'targetTime' in header else None
+	columns = {}
+	for index, column in enumerate(header):
+		aggregation = aggregations.get(column)
+		if isinstance(aggregation, dict):
+			weight = aggregation.get('avg')
+			columns[index] = ('avg', header.index(weight)) if weight in header else None
+		elif aggregation in ['sum', 'min', 'max']:
+			columns[index] = (aggregation, None)
+	percent_columns = dict((index, (header.index(percents[column][0]), header.index(percents[column][1])))
+	                       for index, column in enumerate(header) if column in percents and percents[column][0] in header and percents[column][1] in header)
+	empty = [column for index, column in enumerate(header) if index not in keys and columns.get(index) is None and index not in percent_columns
+	         and column not in ['targetTime', 'targetTime_String']]
+	if empty:
+		logging.warning("dbONE rollup leaves %s empty, they are not aggregated", ','.join(empty))
+	
+	bucket = None
+	groups = collections.OrderedDict()
+	for row in records:
+		row_bucket = buckets[0]
+		if time_index is not None and row[time_index]:
+			time = datetime.datetime.fromtimestamp(int(row[time_index]) / 1000.0, tz).replace(tzinfo=None)
+			row_bucket = buckets[max(bisect.bisect_right(buckets, time) - 1, 0)]
+		if row_bucket != bucket:
+			# the shards come in time order, so the previous bucket is complete
+			yield from _dbONE_rollup_rows(groups, bucket, header, keys, columns, percent_columns, timezone)
+			groups = collections.OrderedDict()
+			bucket = row_bucket
+		key = tuple(row[index] for index in keys)
+		if key not in groups:
+			groups[key] = {'row': row, 'values': dict((index, None) for index, column in columns.items() if column is not None)}
+		values = groups[key]['values']
+		for index, running in values.items():
+			aggregation, weight = columns[index]
+			number = _dbONE_number(row[index])
+			if number is None:
+				continue
+			if aggregation == 'avg':
+				weight = _dbONE_number(row[weight])
+				if weight is None:
+					continue
+				number = (number * weight, weight)
+				values[index] = number if running is None else (running[0] + number[0], running[1] + number[1])
+			elif running is None:
+				values[index] = number
+			else:
+				values[index] = {'sum': running + number, 'min': min(running, number), 'max': max(running, number)}[aggregation]
+	yield from _dbONE_rollup_rows(groups, bucket, header, keys, columns, percent_columns, timezone)
+
+def _dbONE_rollup_rows(groups, bucket, header, keys, columns, percent_columns, timezone):
+	if not groups:
+		return
+	target_time = str(int(tz.localize(bucket).timestamp() * 1000))
+	for key, group in groups.items():
+		row = [''] * len(header)
+		for index in keys:
+			row[index] = group['row'][index]
+		for index, value in group['values'].items():
+			if value is None:
+				continue
+			if columns[index][0] == 'avg':
+				row[index] = format(value[0] / value[1], '.10f') if value[1] else ''
+			else:
+				row[index] = str(value)
+		for index, (numerator, denominator) in percent_columns.items():
+			numerator = group['values'].get(numerator)
+			denominator = group['values'].get(denominator)
+			if numerator is not None and denominator:
+				row[index] = format(100 * numerator / denominator, '.10f')
+		for index, column in enumerate(header):
+			if column == 'targetTime':
+				row[index] = target_time
+			elif column == 'targetTime_String':
+				row[index] = _dbONE_time(target_time, timezone)
+		yield tuple(row)
+
+def _dbONE_number(value):
+	try:
+		return decimal.Decimal(value) if value != '' else None
+	except decimal.InvalidOperation:
+		return None
 
-def query_psql(host,user,password,dbname,sql):
+def _dbONE_aligned(start, ends, resolution):
+	'''
+	True when every shard end (in order) is a bucket boundary of resolution counted from start
+	'''
+	bucket = start
+	for end in ends:
+		while bucket < end:
+			bucket += resolution
+		if bucket != end:
+			return False
+	return True
 
-	conn = psycopg2.connect(host=host,user=user,password=password,dbname=dbname)
-	cur = conn.cursor()
+def _dbONE_time_fields(time_def_body):
+	'''
+	{field: value} of the body of a <TimeDef>
+	'''
+	# ignore commented-out alternatives, e.g. <!--duration>LAST_31_DAYS</duration-->
+	time_def_body = re.sub(r'<!--.*?-->', '', time_def_body, flags=re.S)
+	return dict(re.findall(r'<(\w+)>\s*([^<]*?)\s*</\1>', time_def_body))
+
+def _dbONE_window(fields, now):
+	'''
+	(start, end) of a <TimeDef>: explicit startTime/endTime, or YESTERDAY, TODAY, LAST_MONTH, LAST_<N>_DAYS. None otherwise
+	'''
+	if 'startTime' in fields and 'endTime' in fields:
+		return (datetime.datetime.strptime(fields['startTime'], dbONE_time_format), datetime.datetime.strptime(fields['endTime'], dbONE_time_format))
+	
+	midnight = now.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+	duration = fields.get('duration')
+	if duration == 'YESTERDAY':
+		return (midnight - relativedelta(days=1), midnight)
+	if duration == 'TODAY':
+		return (midnight, midnight + relativedelta(days=1))
+	if duration == 'LAST_MONTH':
+		this_month = midnight.replace(day=1)
+		return (this_month - relativedelta(months=1), this_month)
+	last_days = re.match(r'LAST_(\d+)_DAYS$', duration or '')
+	if last_days:
+		return (midnight - relativedelta(days=int(last_days.group(1))), midnight)
+	return None
+
+def query_psql(host,user,password,dbname,sql,governor=None):
+	'''
+	Yields one tuple per row of the sql file query. Rows are fetched from a server-side cursor in batches, not all at once.
+	The extract holds a slot of the database governor (governor: overrides of the 'Governor' settings) until it completes
+	'''
+	database = _governor('postgres://'+str(host)+'/'+str(dbname), governor)
+	database.acquire()
+	try:
+		conn = psycopg2.connect(host=host,user=user,password=password,dbname=dbname)
+		try:
+			cur = conn.cursor(name='vaaspipe_extract')
+			cur.itersize = psql_batch_size
+			for row in _psql_extract(cur, sql):
+				yield row
+		finally:
+			conn.close()
+	finally:
+		database.release()
+
+def query_psql_parallel(host,user,password,dbname,sqls,max_workers=4,governor=None):
+	'''
+	Runs several dimension extracts (sql files) in one process, in parallel, over a pool of at most max_workers connections.
+	Every extract runs in its own repeatable-read transaction that imports the same exported snapshot, so all lookup tables
+	are read as of the same instant.
+	Every extract holds a slot of the database governor, as in query_psql.
+	Returns {sql: rows}, rows as yielded by query_psql
+	'''
+	database = _governor('postgres://'+str(host)+'/'+str(dbname), governor)
+	pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers + 1, host=host,user=user,password=password,dbname=dbname)
+	
+	try:
+		# the exporting transaction has to stay open until every worker has imported its snapshot
+		coordinator = pool.getconn()
+		coordinator.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+		cur = coordinator.cursor()
+		try:
+			cur.execute("SELECT pg_export_snapshot()")
+			snapshot = cur.fetchone()[0]
+			logging.info("Dimension refresh using snapshot "+ snapshot)
+		except psycopg2.Error as e:
+			coordinator.rollback()
+			snapshot = None
+			logging.warning("Cannot export a snapshot, dimension extracts will not share one: "+ str(e).strip())
+		
+		def extract(sql):
+			database.acquire()
+			try:
+				conn = pool.getconn()
+				try:
+					conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+					cur = conn.cursor()
+					if snapshot is not None:
+						cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+					rows = list(_psql_extract(cur, sql))
+					logging.info("Extracted %i rows with %s", len(rows), sql)
+					return rows
+				finally:
+					conn.rollback()
+					pool.putconn(conn)
+			finally:
+				# also when no connection could be had
+				database.release()
+		
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			results = list(executor.map(extract, sqls))
+		
+		coordinator.rollback()
+		pool.putconn(coordinator)
+	finally:
+		pool.closeall()
+	
+	return dict(zip(sqls, results))
+
+def _psql_extract(cur, sql):
 	query_file=open(sql, 'r')
 	query = query_file.read()
+	query_file.close()
 
 	cur.execute(query)
-	all = cur.fetchall()
 	
-	#all=[(58841411, '050PLUS', '050Plus', 'UGP@050Plus', 'WEB', 'TCP'), (58835929, '30th Activ', '30th Active Directory', '30th Active Directory', 'NONE', 'TCP'),(58836025, '30th Intra', '30th Intra-Farm Services', '30th Intra-Farm Services', 'NONE', 'TCP')]
+	#row=(58841411, '050PLUS', '050Plus', 'UGP@050Plus', 'WEB', 'TCP')
 	
-	myList = []
+	for row in cur:
+		yield tuple(map(str,row))
+
+def merge_sources(extracts, source_column='source', has_header=True, max_workers=None):
+	'''
+	Queries several datasources concurrently and merges their records into one extract, in the order of extracts.
+	extracts: list of (source name, function returning the records of that source)
+	Every record gets the name of its source as an extra, last, column (source_column). When the records have a header (has_header),
+	the header of the first source is used and the rows of the other sources are aligned to it by column name.
+	Records stream through a bounded queue per source: the sources after the one being merged run ahead until their queue is full,
+	so only a few chunks per source are held in memory.
+	A source that fails before its first row is logged and left out, and the merge fails when every source failed.
+	A source that fails after some of its rows have been merged fails the merge.
+	'''
+	queues = [queue.Queue(maxsize=source_settings['queue_chunks']) for name, function in extracts]
+	stopped = threading.Event()
 	
-	for row in all:
-		myList.append(output_separator.join(map(str,row)))
- 
-	return myList
- 
+	def put(chunks, chunk):
+		# gives up once the merge has stopped reading
+		while not stopped.is_set():
+			try:
+				chunks.put(chunk, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+	
+	def produce(function, chunks):
+		try:
+			for chunk in _chunks(iter(function()), source_settings['chunk_size']):
+				if not put(chunks, chunk):
+					return
+			end = None
+		except Exception as e:
+			end = e
+		put(chunks, end)
+	
+	with ThreadPoolExecutor(max_workers=max_workers or len(extracts)) as executor:
+		for (name, function), chunks in zip(extracts, queues):
+			executor.submit(_pipeline_task(produce), function, chunks)
+		
+		try:
+			header = None
+			errors = []
+			for (name, function), chunks in zip(extracts, queues):
+				records = 0
+				rows = 0
+				columns = None
+				while True:
+					chunk = chunks.get()
+					if chunk is None:
+						logging.info("Datasource %s: %i records", name, records)
+						break
+					if isinstance(chunk, BaseException):
+						if rows:
+							logging.error("Datasource %s failed after %i records: %s", name, records, repr(chunk))
+							raise chunk
+						logging.error("Datasource "+str(name)+" failed: "+repr(chunk))
+						errors.append(chunk)
+						break
+					for record in chunk:
+						records += 1
+						if not has_header:
+							rows += 1
+							yield tuple(record) + (name,)
+							continue
+						if columns is None:
+							# the header of the source, the only record buffered to align its rows
+							if header is None:
+								header = tuple(record)
+								yield header + (source_column,)
+							columns = [record.index(column) if column in record else None for column in header]
+							continue
+						rows += 1
+						yield tuple('' if index is None else record[index] for index in columns) + (name,)
+			
+			if errors and len(errors) == len(extracts):
+				raise errors[0]
+		finally:
+			stopped.set()
+
 def query_nGPulse_server(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 
 	# ------- Common Setup -------------	
@@ -112,13 +862,15 @@ def query_nGPulse_server(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------	
 
 	# ------- Test-specific setup -------------	
@@ -146,35 +898,31 @@ def query_nGPulse_server(datasource, query, version=None, ssl=False):
 	
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	for type in kpi_filter_params['type']:
 		kpi_filter_params['type'] = type
-		response = requests.get(url, params=kpi_filter_params, headers=auth_headers) 
-		parsed_json = json.loads(response.text)
+		data = _nGPulse_table(url, kpi_filter_params, auth_headers, http=datasource.get('http'))
 		
-		for index, item in enumerate(parsed_json['data']):
-			service =  parsed_json['data'][index][type]['deviceType']
-			infrastructureId =  parsed_json['data'][index][kpi_filter_params['type']]['name']	
+		for item in data:
+			service =  item[type]['deviceType']
+			infrastructureId =  item[kpi_filter_params['type']]['name']	
 			try:
-				locationId = parsed_json['data'][index][type]['sites'][0]['name']
+				locationId = item[type]['sites'][0]['name']
 			except (IndexError,KeyError):
 				locationId = 'Unknown'
 			if (infrastructureId in infra[service] or infra[service] == []):
-				green =  parsed_json['data'][index]['status']['green'] 
-				yellow =  parsed_json['data'][index]['status']['yellow'] 
-				orange =  parsed_json['data'][index]['status']['orange'] 
-				red =  parsed_json['data'][index]['status']['red'] 
-				gray =  parsed_json['data'][index]['status']['gray'] 
-				count =  parsed_json['data'][index]['status']['count'] 	
-				writer.writerow([output_datestamp,service.replace(output_separator, " "),locationId.replace(output_separator, " "),infrastructureId.replace(output_separator, " "),green,yellow,orange,red,gray,count, start_time_ms, end_time_ms])
-	   
-	return parsed_response.getvalue().strip().split("\r\n")
+				green =  item['status']['green'] 
+				yellow =  item['status']['yellow'] 
+				orange =  item['status']['orange'] 
+				red =  item['status']['red'] 
+				gray =  item['status']['gray'] 
+				count =  item['status']['count'] 	
+				yield _record([output_datestamp,names[service],names[locationId],names[infrastructureId],green,yellow,orange,red,gray,count, start_time_ms, end_time_ms])
 
 def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -191,13 +939,16 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
+	times = _TrendTimes()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------	
 
 	# ------- Test-specific setup -------------	
@@ -210,12 +961,10 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 	
 	# ------- Test-specific query and data processing -------------
 	
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	
 	for nGP_Service_Test, item in service_dict.items():
@@ -225,20 +974,19 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
 			headers = auth_headers
-			response = requests.get(url, params=kpi_filter_params, headers=headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, headers, http=datasource.get('http'))
 			
 			if ('trends' not in kpi_filter_params):
 				# ------- Query does not relate to trends -------
 		
 				# get the data from all the npoints
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name'].replace(output_separator, " ")
-					availability =  parsed_json['data'][index]['availPercent']
-					caller_mos =  parsed_json['data'][index]['avgLqmosRx'] 
-					callee_mos =  parsed_json['data'][index]['avgLqmosTx'] 
-					count  =  parsed_json['data'][index]['count'] 
-					writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint,availability,caller_mos,callee_mos,count, start_time_ms, end_time_ms])
+				for item in data:
+					nPoint =  names[item['agent']['name']]
+					availability =  item['availPercent']
+					caller_mos =  item['avgLqmosRx'] 
+					callee_mos =  item['avgLqmosTx'] 
+					count  =  item['count'] 
+					yield _record([output_datestamp,names[nGP_Service_Test],nPoint,availability,caller_mos,callee_mos,count, start_time_ms, end_time_ms])
 
 	
 			else:
@@ -248,40 +996,40 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 				# ------- Get trend data for kpi#1 (availability)
 				
 				
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name']
+				for item in data:
+					nPoint =  item['agent']['name']
 					
 					kpi1_trend_dict = {}
 					kpi2_trend_dict = {}
 					kpi3_trend_dict = {}
 					
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['availability']['data']):
+					for index1, item1 in enumerate(item['trends']['availability']['data']):
 						
-						availability =  parsed_json['data'][index]['trends']['availability']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['availability']['data'][index1]['str']
+						availability =  item['trends']['availability']['data'][index1]['value']
+						str = item['trends']['availability']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['availability']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['availability']['data'][index1]):
 							kpi1_trend_dict[time] = availability
 						
 						
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['avgLqmosRx']['data']):
+					for index1, item1 in enumerate(item['trends']['avgLqmosRx']['data']):
 						
-						caller_mos =  parsed_json['data'][index]['trends']['avgLqmosRx']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['avgLqmosRx']['data'][index1]['str']
+						caller_mos =  item['trends']['avgLqmosRx']['data'][index1]['value']
+						str = item['trends']['avgLqmosRx']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['avgLqmosRx']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['avgLqmosRx']['data'][index1]):
 							kpi2_trend_dict[time] = caller_mos
 							
 							
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['avgLqmosTx']['data']):
+					for index1, item1 in enumerate(item['trends']['avgLqmosTx']['data']):
 						
-						callee_mos =  parsed_json['data'][index]['trends']['avgLqmosTx']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['avgLqmosTx']['data'][index1]['str']
+						callee_mos =  item['trends']['avgLqmosTx']['data'][index1]['value']
+						str = item['trends']['avgLqmosTx']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['avgLqmosTx']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['avgLqmosTx']['data'][index1]):
 							kpi3_trend_dict[time] = callee_mos	
 						
 					count = 1	
@@ -296,18 +1044,16 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 						except KeyError:
 							callee_mos = ''
 							
-						writer.writerow(
-							[key,
-							nGP_Service_Test.replace(output_separator, " "),
-							nPoint.replace(output_separator, " "),
+						yield _record(
+							[names[key],
+							names[nGP_Service_Test],
+							names[nPoint],
 							kpi1_trend_dict[key],
 							caller_mos,
 							callee_mos,
 							count,
 							start_time_ms,
 							end_time_ms])
-
-	return parsed_response.getvalue().strip().split("\r\n")
 	
 	
 	
@@ -315,6 +1061,7 @@ def query_nGPulse_voip(datasource, query, version=None, ssl=False):
 def query_nGPulse_latency(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -331,13 +1078,15 @@ def query_nGPulse_latency(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------	
 	# ------- Test-specific setup -------------	
 
@@ -348,12 +1097,10 @@ def query_nGPulse_latency(datasource, query, version=None, ssl=False):
 
 	# ------- Test-specific query and data processing -------------
 
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	
 	for nGP_Service_Test, item in service_dict.items():
@@ -362,24 +1109,22 @@ def query_nGPulse_latency(datasource, query, version=None, ssl=False):
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
 			headers = auth_headers
-			response = requests.get(url, params=kpi_filter_params, headers=headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, headers, http=datasource.get('http'))
 		
 			# get the data from all the npoints
-			for index, item in enumerate(parsed_json['data']):
-				nPoint =  parsed_json['data'][index]['agent']['name']
-				availability =  parsed_json['data'][index]['availPercent'] 
-				Avg_Latency =  parsed_json['data'][index]['avgavg']
-				Best_Latency =  parsed_json['data'][index]['avgbest']
-				Worst_Latency =  parsed_json['data'][index]['avgworst']
-				count = parsed_json['data'][index]['count'] 
-				writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint.replace(output_separator, " "),availability,Avg_Latency,Best_Latency,Worst_Latency,count, start_time_ms, end_time_ms])
-				
-	return parsed_response.getvalue().strip().split("\r\n")
+			for item in data:
+				nPoint =  item['agent']['name']
+				availability =  item['availPercent'] 
+				Avg_Latency =  item['avgavg']
+				Best_Latency =  item['avgbest']
+				Worst_Latency =  item['avgworst']
+				count = item['count'] 
+				yield _record([output_datestamp,names[nGP_Service_Test],names[nPoint],availability,Avg_Latency,Best_Latency,Worst_Latency,count, start_time_ms, end_time_ms])
 	
 def query_nGPulse_ping(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -396,13 +1141,15 @@ def query_nGPulse_ping(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------	
 	# ------- Test-specific setup -------------	
 	nGP_Service_Test_List = query['nGP_Service_Test_List'] or []
@@ -412,35 +1159,31 @@ def query_nGPulse_ping(datasource, query, version=None, ssl=False):
 
 	# ------- Test-specific query and data processing -------------
 
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 	
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	for nGP_Service_Test, item in service_dict.items():
 		id = service_dict[nGP_Service_Test]
 		# check if this service test is on our list or if the list is null (meaning get all service tests)
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
-			response = requests.get(url, params=kpi_filter_params, headers=auth_headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, auth_headers, http=datasource.get('http'))
 		
 			# get the data from all the npoints
-			for index, item in enumerate(parsed_json['data']):
-				nPoint =  parsed_json['data'][index]['agent']['name']
-				availability =  parsed_json['data'][index]['availPercent'] 
-				Avg_Ping_Latency =  parsed_json['data'][index]['avgping_results']
-				count = parsed_json['data'][index]['count'] 
-				writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint.replace(output_separator, " "),availability,Avg_Ping_Latency,count, start_time_ms, end_time_ms])
+			for item in data:
+				nPoint =  item['agent']['name']
+				availability =  item['availPercent'] 
+				Avg_Ping_Latency =  item['avgping_results']
+				count = item['count'] 
+				yield _record([output_datestamp,names[nGP_Service_Test],names[nPoint],availability,Avg_Ping_Latency,count, start_time_ms, end_time_ms])
 			
-				
-	return parsed_response.getvalue().strip().split("\r\n")
  	
 def query_nGPulse_web(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -457,13 +1200,15 @@ def query_nGPulse_web(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------
 	# ------- Test-specific setup -------------	
 	nGP_Service_Test_List = query['nGP_Service_Test_List'] or []
@@ -472,12 +1217,10 @@ def query_nGPulse_web(datasource, query, version=None, ssl=False):
 	# ------- Test-specific setup -------------
 	# ------- Test-specific query and data processing -------------
 
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	
 	for nGP_Service_Test, item in service_dict.items():
@@ -485,23 +1228,21 @@ def query_nGPulse_web(datasource, query, version=None, ssl=False):
 		# check if this service test is on our list or if the list is null (meaning get all service tests)
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
-			response = requests.get(url, params=kpi_filter_params, headers=auth_headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, auth_headers, http=datasource.get('http'))
 		
 			# get the data from all the npoints
-			for index, item in enumerate(parsed_json['data']):
-				nPoint =  parsed_json['data'][index]['agent']['name']
-				availability =  parsed_json['data'][index]['availPercent'] 
-				Avg_Response =  parsed_json['data'][index]['avgResponse']
-				count = parsed_json['data'][index]['count'] 
-				writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint.replace(output_separator, " "),availability,Avg_Response,count, start_time_ms, end_time_ms])
+			for item in data:
+				nPoint =  item['agent']['name']
+				availability =  item['availPercent'] 
+				Avg_Response =  item['avgResponse']
+				count = item['count'] 
+				yield _record([output_datestamp,names[nGP_Service_Test],names[nPoint],availability,Avg_Response,count, start_time_ms, end_time_ms])
 			
-				
-	return parsed_response.getvalue().strip().split("\r\n")
 	
 def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -518,13 +1259,16 @@ def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
+	times = _TrendTimes()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------
 	# ------- Test-specific setup -------------	
 	nGP_Service_Test_List = query['nGP_Service_Test_List'] or []
@@ -533,12 +1277,10 @@ def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 	# ------- Test-specific setup -------------
 	# ------- Test-specific query and data processing -------------
 
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 	
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	
 	for nGP_Service_Test, item in service_dict.items():
@@ -547,19 +1289,18 @@ def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
 
-			response = requests.get(url, params=kpi_filter_params, headers = auth_headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, auth_headers, http=datasource.get('http'))
 			
 			if ('trends' not in kpi_filter_params):
 				# ------- Query does not relate to trends -------
 		
 				# get the data from all the npoints
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name']
-					availability =  parsed_json['data'][index]['availPercent'] 
-					maxupload_time =  parsed_json['data'][index]['maxupload_time']
-					count = parsed_json['data'][index]['count'] 
-					writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint.replace(output_separator, " "),availability,maxupload_time,count, start_time_ms, end_time_ms])
+				for item in data:
+					nPoint =  item['agent']['name']
+					availability =  item['availPercent'] 
+					maxupload_time =  item['maxupload_time']
+					count = item['count'] 
+					yield _record([output_datestamp,names[nGP_Service_Test],names[nPoint],availability,maxupload_time,count, start_time_ms, end_time_ms])
 				
 			
 			else:
@@ -569,29 +1310,29 @@ def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 				# ------- Get trend data for kpi#1 (availability)
 				
 				
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name']
+				for item in data:
+					nPoint =  item['agent']['name']
 					
 					kpi1_trend_dict = {}
 					kpi2_trend_dict = {}
 					
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['availability']['data']):
+					for index1, item1 in enumerate(item['trends']['availability']['data']):
 						
-						availability =  parsed_json['data'][index]['trends']['availability']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['availability']['data'][index1]['str']
+						availability =  item['trends']['availability']['data'][index1]['value']
+						str = item['trends']['availability']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['availability']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['availability']['data'][index1]):
 							kpi1_trend_dict[time] = availability
 						
 						
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['maxupload_time']['data']):
+					for index1, item1 in enumerate(item['trends']['maxupload_time']['data']):
 						
-						maxupload_time =  parsed_json['data'][index]['trends']['maxupload_time']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['maxupload_time']['data'][index1]['str']
+						maxupload_time =  item['trends']['maxupload_time']['data'][index1]['value']
+						str = item['trends']['maxupload_time']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['maxupload_time']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['maxupload_time']['data'][index1]):
 							kpi2_trend_dict[time] = maxupload_time
 						
 						
@@ -602,21 +1343,20 @@ def query_nGPulse_o365_onedrive(datasource, query, version=None, ssl=False):
 							maxupload_time = kpi2_trend_dict[key]
 						except KeyError:
 							maxupload_time = ''
-						writer.writerow(
-							[key,
-							nGP_Service_Test.replace(output_separator, " "),
-							nPoint.replace(output_separator, " "),
+						yield _record(
+							[names[key],
+							names[nGP_Service_Test],
+							names[nPoint],
 							kpi1_trend_dict[key],
 							maxupload_time,
 							count,
 							start_time_ms,
 							end_time_ms])
-
-	return parsed_response.getvalue().strip().split("\r\n")
  	
 def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 	'''
 	Builds nGPulse API query
+	Yields one record (tuple of strings) per row
 	'''
 	# ------- Common Setup -------------	
 	
@@ -633,13 +1373,16 @@ def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 	token = _nGPulse_token(datasource['emailOrUsername'], 
 							datasource['password'],
 							protocol,
-							hostname)
+							hostname,
+							http=datasource.get('http'))
 	
 	auth_headers = _nGPulse_auth_headers(token)
+	names = _Names()
+	times = _TrendTimes()
 	
 	output_datestamp =  kpi_filter_params['start_str']	
-	start_time_ms = kpi_filter_params['start']
-	end_time_ms = kpi_filter_params['end']	
+	start_time_ms = '%i' % kpi_filter_params['start']
+	end_time_ms = '%i' % kpi_filter_params['end']	
 	# ------- Common Setup -------------
 	# ------- Test-specific setup -------------	
 	nGP_Service_Test_List = query['nGP_Service_Test_List'] or []
@@ -648,12 +1391,10 @@ def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 	# ------- Test-specific setup -------------
 	# ------- Test-specific query and data processing -------------
 
-	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name)
+	service_dict = _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=datasource.get('http'))
 	
 	url = protocol + hostname + '/query/table'
 
-	parsed_response = StringIO()
-	writer = csv.writer(parsed_response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
 	
 	
 	
@@ -663,19 +1404,18 @@ def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 		if (nGP_Service_Test in nGP_Service_Test_List or nGP_Service_Test_List  == []):
 			kpi_filter_params['test'] = id
 			
-			response = requests.get(url, params=kpi_filter_params, headers= auth_headers) 
-			parsed_json = json.loads(response.text)
+			data = _nGPulse_table(url, kpi_filter_params, auth_headers, http=datasource.get('http'))
 			
 			if ('trends' not in kpi_filter_params):
 				# ------- Query does not relate to trends -------
 		
 				# get the data from all the npoints
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name']
-					availability =  parsed_json['data'][index]['availPercent'] 
-					maxresp_time =  parsed_json['data'][index]['maxresp_time']
-					count = parsed_json['data'][index]['count'] 
-					writer.writerow([output_datestamp,nGP_Service_Test.replace(output_separator, " "),nPoint.replace(output_separator, " "),availability,maxresp_time,count, start_time_ms, end_time_ms])
+				for item in data:
+					nPoint =  item['agent']['name']
+					availability =  item['availPercent'] 
+					maxresp_time =  item['maxresp_time']
+					count = item['count'] 
+					yield _record([output_datestamp,names[nGP_Service_Test],names[nPoint],availability,maxresp_time,count, start_time_ms, end_time_ms])
 			
 
 			else:
@@ -685,29 +1425,29 @@ def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 				# ------- Get trend data for kpi#1 (availability)
 				
 				
-				for index, item in enumerate(parsed_json['data']):
-					nPoint =  parsed_json['data'][index]['agent']['name']
+				for item in data:
+					nPoint =  item['agent']['name']
 					
 					kpi1_trend_dict = {}
 					kpi2_trend_dict = {}
 					
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['availability']['data']):
+					for index1, item1 in enumerate(item['trends']['availability']['data']):
 						
-						availability =  parsed_json['data'][index]['trends']['availability']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['availability']['data'][index1]['str']
+						availability =  item['trends']['availability']['data'][index1]['value']
+						str = item['trends']['availability']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['availability']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['availability']['data'][index1]):
 							kpi1_trend_dict[time] = availability
 						
 						
-					for index1, item1 in enumerate(parsed_json['data'][index]['trends']['maxresp_time']['data']):
+					for index1, item1 in enumerate(item['trends']['maxresp_time']['data']):
 						
-						maxresp_time =  parsed_json['data'][index]['trends']['maxresp_time']['data'][index1]['value']
-						str = parsed_json['data'][index]['trends']['maxresp_time']['data'][index1]['str']
+						maxresp_time =  item['trends']['maxresp_time']['data'][index1]['value']
+						str = item['trends']['maxresp_time']['data'][index1]['str']
 						# ------- Handle 'str' format: 2018-Oct-30_11:09 -------
-						time = datetime.datetime.strptime(str,'%Y-%b-%d_%H:%M')
-						if ('count' in parsed_json['data'][index]['trends']['maxresp_time']['data'][index1]):
+						time = times[str]
+						if ('count' in item['trends']['maxresp_time']['data'][index1]):
 							kpi2_trend_dict[time] = maxresp_time
 						
 						
@@ -718,19 +1458,381 @@ def query_nGPulse_o365_outlook(datasource, query, version=None, ssl=False):
 							maxresp_time = kpi2_trend_dict[key]
 						except KeyError:
 							maxresp_time = ''
-						writer.writerow(
-							[key,
-							nGP_Service_Test.replace(output_separator, " "),
-							nPoint.replace(output_separator, " "),
+						yield _record(
+							[names[key],
+							names[nGP_Service_Test],
+							names[nPoint],
 							kpi1_trend_dict[key],
 							maxresp_time,
 							count,
 							start_time_ms,
 							end_time_ms])
-
-	return parsed_response.getvalue().strip().split("\r\n")
 				
-def _nGPulse_token( emailOrUsername, password, protocol, hostname ):
+def explain_nGPulse(datasource, query, category):
+	'''
+	Plan of the calls the extractor of a nGPulse category (Infrastructure or a nGPulse_test_types one) would make, without making them.
+	Tests are selected from the catalog cached by the last run against the datasource. Rows are upper bounds: rowLimit agents
+	(devices) per call, times the trend points of the window for trend queries.
+	Returns a plan, see explain_report
+	'''
+	hostname = get_hostname(datasource['host'], datasource['port'])
+	kpi_filter_params = _start_to_end_time_ms(copy.deepcopy(query['kpi_filter_params']))
+	plan = {'window': (kpi_filter_params['start_str'], kpi_filter_params['end_str']), 'calls': [], 'concurrency': 1, 'notes': []}
+	
+	plan['calls'].append(_explain_call('POST', hostname + '/ipm/auth/login', {'emailOrUsername': datasource['emailOrUsername']}))
+	
+	rows = kpi_filter_params.get('rowLimit')
+	if rows is not None and 'trends' in kpi_filter_params:
+		rows *= -(-(kpi_filter_params['end'] - kpi_filter_params['start']) // explain_settings['trend_interval'])
+	stream = json_settings['stream'] and json_settings['incremental'] and _json_library('ijson') is not None
+	url = hostname + '/query/table'
+	
+	if category == 'Infrastructure':
+		types = kpi_filter_params['type']
+		for type in types if isinstance(types, list) else [types]:
+			plan['calls'].append(_explain_call('GET', url, dict(kpi_filter_params, type=type), rows, stream))
+		return plan
+	
+	group, service_type_name = nGPulse_test_types[category]
+	plan['calls'].append(_explain_call('GET', hostname + '/ipm/v1/admin/testTypes', {'query': '{"status":"Running","group":"'+group+'"}'}))
+	plan['calls'].append(_explain_call('GET', hostname + '/ipm/v1/admin/tests', {'query': '{"status":"Running"}'}))
+	
+	nGP_Service_Test_List = query['nGP_Service_Test_List'] or []
+	catalog = _catalog_load(hostname, service_type_name)
+	if catalog is not None:
+		tests = [(name, id) for name, id in catalog['tests'].items() if name in nGP_Service_Test_List or nGP_Service_Test_List == []]
+		plan['notes'].append('%i of the %i %s tests of the catalog cached %s' % (len(tests), len(catalog['tests']), service_type_name,
+		                     datetime.datetime.fromtimestamp(catalog['extracted'], tz).strftime('%d-%m-%Y %H:%M:%S')))
+	elif nGP_Service_Test_List:
+		tests = [(name, name) for name in nGP_Service_Test_List]
+		plan['notes'].append('no cached %s catalog, assuming every listed test is running' % service_type_name)
+	else:
+		tests = None
+		plan['notes'].append('no cached %s catalog: every running test, run the pipeline once to count them' % service_type_name)
+	
+	if tests is None:
+		plan['calls'].append(('GET', url, None, None))
+		return plan
+	plan['tests'] = [name for name, id in tests]
+	for name, id in tests:
+		plan['calls'].append(_explain_call('GET', url, dict(kpi_filter_params, test=id), rows, stream))
+	return plan
+
+def explain_dbONE(nG1_API, query, shards=None, columns=None, enriched=False, conversion='true'):
+	'''
+	Plan of the calls of query_dbONE, without making them: one per shard. nG1 does not tell how many rows a query returns.
+	enriched: names are looked up locally (conversion=false)
+	'''
+	if columns is not None:
+		query, conversion = dbONE_projection(query, _dbONE_rollup_columns(columns, shards), conversion)
+	if enriched:
+		conversion = 'false'
+	plan = {'window': None, 'calls': [], 'concurrency': 1, 'notes': ['conversion=' + conversion]}
+	
+	text = query.decode('utf-8') if isinstance(query, bytes) else query
+	time_def = re.search(r'<TimeDef>(.*?)</TimeDef>', text, re.S)
+	if time_def is not None:
+		fields = _dbONE_time_fields(time_def.group(1))
+		window = _dbONE_window(fields, datetime.datetime.now(tz))
+		if window is not None:
+			plan['window'] = tuple(time.strftime('%d-%m-%Y %H:%M:%S') for time in window)
+		if fields.get('resolution'):
+			plan['notes'].append('resolution ' + fields['resolution'])
+	
+	queries = _dbONE_shard_queries(query, shards) if shards else [query]
+	if len(queries) > 1:
+		plan['concurrency'] = min(len(queries), shards.get('max_workers', 4))
+		plan['notes'].append('%i shards of %s' % (len(queries), shards['interval']))
+	if queries != [query] and _dbONE_rolls_up(query, shards):
+		plan['notes'].append('shards at ' + shards['resolution'] + ', rolled up locally')
+	url = str(nG1_API.get('host')) + ':' + str(nG1_API.get('port')) + '/dbonequerydata'
+	for shard in queries:
+		plan['calls'].append(_explain_call('POST', url, shard, None))
+	return plan
+
+def explain_psql(postgres, sql):
+	'''
+	Plan of query_psql: one statement, the sql file
+	'''
+	return {'window': None, 'calls': [('SQL', str(postgres.get('host')) + '/' + str(postgres.get('dbname')), sql, None)],
+	        'concurrency': 1, 'notes': [sql]}
+
+def explain_trend_store(store, query):
+	'''
+	Plan of trend_store_rollup: no upstream calls
+	'''
+	kpi_filter_params = _start_to_end_time_ms(copy.deepcopy(query['kpi_filter_params']))
+	return {'window': (kpi_filter_params['start_str'], kpi_filter_params['end_str']), 'calls': [], 'concurrency': 0,
+	        'notes': [store['rollup'] + ' rollup of the ' + store['name'] + ' trend store, no upstream calls']}
+
+def _explain_call(method, url, params, rows=0, stream=False):
+	'''
+	(method, url, key, rows) of a planned call. Calls with the same key are coalesced when their pipelines run together;
+	streamed ones never are. rows: 0 for calls that return no rows, None when unknown
+	'''
+	key = object() if stream else _freeze(params)
+	return (method, url, key, rows)
+
+def explain_report(pipelines):
+	'''
+	Text of the call plans of a run. pipelines: list of (Key, Service_Category, [(source, plan)]), source None unless the pipeline
+	fans out over several datasources or sites (queried at the same time). A plan is a dict of
+	'window': (start, end) or None, 'calls': list of (method, url, key, rows), 'concurrency': calls in flight at once,
+	'notes': list of strings and optionally 'tests': names of the selected tests
+	'''
+	lines = []
+	keys = set()
+	total_calls = total_rows = total_concurrency = 0
+	unknown = False
+	hosts = collections.Counter()
+	
+	for name, category, plans in pipelines:
+		lines.append(name + ' (' + category + ')')
+		for source, plan in plans:
+			indent = '  '
+			if source is not None:
+				lines.append(indent + str(source) + ':')
+				indent += '  '
+			if plan['window'] is not None:
+				lines.append(indent + 'window ' + plan['window'][0] + ' - ' + plan['window'][1])
+			for note in plan['notes']:
+				lines.append(indent + note)
+			if plan.get('tests'):
+				lines.append(indent + 'tests: ' + ', '.join(plan['tests']))
+			
+			endpoints = collections.OrderedDict()
+			for method, url, key, rows in plan['calls']:
+				endpoint = endpoints.setdefault((method, url), {'calls': 0, 'rows': 0, 'more_calls': False, 'more_rows': False})
+				if key is None:
+					# one call per test of a catalog that is not cached
+					endpoint['more_calls'] = endpoint['more_rows'] = unknown = True
+					continue
+				if not coalescing_enabled or (method, url, key) not in keys:
+					hosts[url.split('/')[0]] += 1
+				keys.add((method, url, key))
+				endpoint['calls'] += 1
+				total_calls += 1
+				if rows is None:
+					endpoint['more_rows'] = unknown = True
+				else:
+					endpoint['rows'] += rows
+					total_rows += rows
+			for (method, url), endpoint in endpoints.items():
+				rows = '<= %i rows' % endpoint['rows'] if endpoint['rows'] else ''
+				if endpoint['more_rows']:
+					rows += ' + ? rows' if rows else '? rows'
+				calls = str(endpoint['calls'] or '') + ('+?' if endpoint['calls'] and endpoint['more_calls'] else '?' if endpoint['more_calls'] else '')
+				lines.append(indent + '%-4s %-50s %6s  %s' % (method, url, calls, rows))
+			total_concurrency += plan['concurrency']
+	
+	lines.append('')
+	calls = '%i calls' % total_calls
+	if coalescing_enabled and len(keys) < total_calls:
+		# without a ttl, only identical calls in flight at the same time are coalesced
+		calls += ' (%s%i after coalescing identical ones)' % ('' if coalescing_ttl else 'as few as ', len(keys))
+	lines.append('Total: ' + calls + ', <= %i rows' % total_rows + (' + unknown' if unknown else '') +
+	             ', up to %i calls at once' % total_concurrency)
+	# calls actually made to every host, for its rate and concurrency limits
+	for host, count in hosts.items():
+		lines.append('  ' + host + ': %i calls' % count)
+	return '\n'.join(lines)
+
+def trend_store_append(records, store, header=None):
+	'''
+	Passes records through and, once they have all been consumed, appends them to the day partitions of a local trend store:
+	<Trend_Store directory>/<store['name']>/<YYYY-MM-DD>.json.gz, with one list of values per column.
+	Rows are keyed on the time column (store['time_column'], 'date' by default) and store['key_columns'], so rows
+	fetched again replace the stored ones. Partitions older than Trend_Store 'retention_days' are removed.
+	While they pass, rows are spooled to one temporary file per day; the days are then merged into their partitions one at
+	a time, so at most one day of the store is held in memory.
+	header: column names of the records, None when the first record is the header
+	'''
+	records = iter(records)
+	if header is None:
+		header = list(next(records, []))
+		yield tuple(header)
+	time_index = header.index(store.get('time_column', 'date'))
+	
+	spool = tempfile.mkdtemp(prefix='trend_store_')
+	spools = collections.OrderedDict()
+	count = 0
+	try:
+		for record in records:
+			yield record
+			day = _trend_time(record[time_index]).date()
+			if day not in spools:
+				spools[day] = open(os.path.join(spool, day.isoformat() + '.json'), 'w', encoding='utf-8')
+			spools[day].write(json.dumps(list(record)) + '\n')
+			count += 1
+		for output in spools.values():
+			output.close()
+		
+		directory = os.path.join(trend_store_settings['directory'], store['name'])
+		with _trend_store_lock:
+			if not os.path.exists(directory):
+				os.makedirs(directory)
+			for day in spools:
+				with open(os.path.join(spool, day.isoformat() + '.json'), 'r', encoding='utf-8') as input:
+					_trend_partition_write(os.path.join(directory, day.isoformat() + '.json.gz'), header, time_index, store.get('key_columns') or [],
+					                       (tuple(json.loads(line)) for line in input))
+			
+			oldest = (datetime.datetime.now(tz) - datetime.timedelta(days=trend_store_settings['retention_days'])).date().isoformat()
+			for partition in os.listdir(directory):
+				if partition.endswith('.json.gz') and partition[:10] < oldest:
+					os.remove(os.path.join(directory, partition))
+	finally:
+		for output in spools.values():
+			output.close()
+		shutil.rmtree(spool)
+	
+	logging.info("Stored %i trend rows in %i partitions of %s", count, len(spools), directory)
+
+def trend_store_rollup(store, query):
+	'''
+	Hourly, daily or monthly rollup (store['rollup']) of a trend store over the window of the query (kpi_filter_params start and end),
+	without querying nGPulse. Yields one record per period and key, with the columns of the store:
+	the time column holds the period start, key columns their value and other columns are aggregated as in store['aggregations']
+	(avg, min, max, sum, samples (the number of stored rows), period_start or period_end, as seconds since the epoch), or left empty.
+	The day partitions are read in order into one running aggregate per period and key; a period is yielded once the day
+	it ends on has been read
+	'''
+	kpi_filter_params = _start_to_end_time_ms(copy.deepcopy(query['kpi_filter_params']))
+	start = datetime.datetime.fromtimestamp(kpi_filter_params['start'], tz)
+	end = datetime.datetime.fromtimestamp(kpi_filter_params['end'], tz)
+	aggregations = store.get('aggregations') or {}
+	
+	directory = os.path.join(trend_store_settings['directory'], store['name'])
+	logging.info("Rollup of %s from %s to %s", directory, start, end)
+	
+	header = None
+	groups = collections.OrderedDict()
+	day = start.date()
+	while day <= end.date():
+		partition = _trend_partition_read(os.path.join(directory, day.isoformat() + '.json.gz'))
+		day += datetime.timedelta(days=1)
+		if partition is None:
+			continue
+		if header is None:
+			header = partition['columns']
+			time_index = header.index(store.get('time_column', 'date'))
+			keys = [header.index(column) for column in partition['key_columns']]
+			numbers = [index for index, column in enumerate(header) if aggregations.get(column) in ['avg', 'min', 'max', 'sum']]
+		for row in _trend_partition_rows(partition, header):
+			time = _trend_time(row[time_index])
+			if start <= time < end:
+				key = _trend_period(store['rollup'], time) + tuple(row[index] for index in keys)
+				if key not in groups:
+					groups[key] = {'row': row, 'samples': 0, 'numbers': dict((index, None) for index in numbers)}
+				_trend_accumulate(groups[key], row)
+		# the periods ending by the start of the next day are complete
+		yield from _trend_rollup_records(groups, tz.localize(datetime.datetime.combine(day, datetime.time())), header, time_index, keys, aggregations)
+	
+	if header is not None:
+		yield from _trend_rollup_records(groups, None, header, time_index, keys, aggregations)
+
+def _trend_accumulate(group, row):
+	# running samples, and count, sum, min and max of the numeric values of every aggregated column
+	group['samples'] += 1
+	for index, running in group['numbers'].items():
+		number = _trend_number(row[index])
+		if number is None:
+			continue
+		if running is None:
+			group['numbers'][index] = [1, number, number, number]
+		else:
+			running[0] += 1
+			running[1] += number
+			running[2] = min(running[2], number)
+			running[3] = max(running[3], number)
+
+def _trend_rollup_records(groups, done, header, time_index, keys, aggregations):
+	'''
+	Records of the groups whose period ends by done (every group when done is None), in period order; the groups are removed
+	'''
+	complete = [key for key in groups if done is None or key[1] <= done]
+	for key in sorted(complete, key=lambda key: key[0]):
+		group = groups.pop(key)
+		record = list(group['row'])
+		for index, column in enumerate(header):
+			if index == time_index:
+				record[index] = key[0].strftime('%d-%m-%Y %H:%M:%S')
+			elif index in keys:
+				continue
+			else:
+				record[index] = _trend_aggregate(aggregations.get(column), group['samples'], group['numbers'].get(index), key[0], key[1])
+		yield _record(record)
+
+def _trend_aggregate(aggregation, samples, running, period_start, period_end):
+	# running: [count, sum, min, max] of the numeric values, None without any
+	if aggregation == 'period_start':
+		return int(period_start.timestamp())
+	if aggregation == 'period_end':
+		return int(period_end.timestamp())
+	if aggregation == 'samples':
+		return samples
+	if running is None or aggregation not in ['avg', 'min', 'max', 'sum']:
+		return ''
+	if aggregation == 'avg':
+		return running[1] / running[0]
+	return {'sum': running[1], 'min': running[2], 'max': running[3]}[aggregation]
+
+def _trend_number(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		try:
+			return float(value)
+		except (TypeError, ValueError):
+			# empty (no sample)
+			return None
+
+def _trend_period(rollup, time):
+	'''
+	(start, end) of the hourly, daily or monthly period of an aware local time. Days and months follow the local clock, so the
+	days on which DST starts or ends last 23 or 25 hours; an hour always lasts one hour, also the repeated one when DST ends
+	'''
+	period_start, period = trend_rollups[rollup]
+	local = time.replace(tzinfo=None)
+	start = period_start(local)
+	if rollup == 'hourly':
+		start = tz.normalize(time - (local - start))
+		return start, tz.normalize(start + datetime.timedelta(hours=1))
+	return tz.localize(start), tz.localize(start + period)
+
+def _trend_time(value):
+	# trend times are naive local times, e.g. 2018-10-30 11:05:00
+	time = parse(value, tzinfos=tzinfos)
+	return tz.localize(time) if time.tzinfo is None else time
+
+def _trend_partition_read(path):
+	if not os.path.exists(path):
+		return None
+	with gzip.open(path, 'rt', encoding='utf-8') as input:
+		return json.load(input)
+
+def _trend_partition_rows(partition, header):
+	# rows of a partition, in the column order of header (columns the partition does not have are empty)
+	size = len(next(iter(partition['data'].values()), []))
+	return zip(*[partition['data'].get(column, [''] * size) for column in header])
+
+def _trend_partition_write(path, header, time_index, key_columns, rows):
+	keys = [time_index] + [header.index(column) for column in key_columns]
+	
+	stored = {}
+	partition = _trend_partition_read(path)
+	if partition is not None:
+		for row in _trend_partition_rows(partition, header):
+			stored[tuple(row[index] for index in keys)] = row
+	for row in rows:
+		stored[tuple(row[index] for index in keys)] = row
+	
+	partition = {'columns': header, 'key_columns': key_columns,
+	             'data': dict((column, [row[index] for row in stored.values()]) for index, column in enumerate(header))}
+	with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as output:
+		json.dump(partition, output)
+	os.replace(path + '.tmp', path)
+
+def _nGPulse_token( emailOrUsername, password, protocol, hostname, http=None ):
 	'''
 
 	'''
@@ -739,10 +1841,11 @@ def _nGPulse_token( emailOrUsername, password, protocol, hostname ):
 	url = protocol + hostname + endpoint
 	
 	data = {'emailOrUsername' : emailOrUsername, 'password' : password}
-	response = requests.post(url, data= data)
-	
-	authentication_json = json.loads(response.text)
-	token =  authentication_json['accessToken']
+	with profile_stage('auth'):
+		response = _http_post(url, data=data, http=http)
+		
+		authentication_json = _json_loads(response.content)
+		token =  authentication_json['accessToken']
 	
 	return token
 
@@ -776,13 +1879,17 @@ def _start_to_end_time_ms(kpi_filter_params):
 	
 	return kpi_filter_params
 			
-def _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name):
+def _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_name, http=None):
+	with profile_stage('catalog'):
+		return _nGPulse_tests(protocol, hostname, auth_headers, group, service_type_name, http)
+
+def _nGPulse_tests(protocol, hostname, auth_headers, group, service_type_name, http=None):
 
 	url = protocol + hostname + '/ipm/v1/admin/testTypes'
 	params = {'query' : '{"status":"Running","group":"'+group+'"}'}
 	
-	response = requests.get(url, params = params, headers = auth_headers)
-	service_type_json = json.loads(response.text)
+	response = _http_get(url, params=params, headers=auth_headers, http=http)
+	service_type_json = _json_loads(response.content)
 	
 	for index, item in enumerate(service_type_json):
 		if (service_type_json[index]['name'] == service_type_name):
@@ -792,8 +1899,8 @@ def _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_nam
 	url = protocol + hostname + '/ipm/v1/admin/tests'
 	params = {'query' : '{"status":"Running"}'}
 	
-	response = requests.get(url, params = params, headers = auth_headers)
-	services_json = json.loads(response.text)
+	response = _http_get(url, params=params, headers=auth_headers, http=http)
+	services_json = _json_loads(response.content)
 
 	service_dict = {}
 	
@@ -803,12 +1910,705 @@ def _nGPulse_get_tests(protocol, hostname, auth_headers, group, service_type_nam
 		type = services_json[index]['type']
 		if (type == service_type_id):
 			service_dict[name] = id
+	
+	_catalog_save(hostname, service_type_name, service_dict)
 			
 	return service_dict
 
+def _catalog_path(hostname, service_type_name):
+	return os.path.join(explain_settings['catalog_directory'], re.sub(r'[^\w.-]+', '_', hostname + '_' + service_type_name) + '.json')
+
+def _catalog_save(hostname, service_type_name, tests):
+	'''
+	Keeps the {name: id} catalog of a test type for vaaspipe --explain. Failing to write it does not fail the extract
+	'''
+	path = _catalog_path(hostname, service_type_name)
+	try:
+		with _catalog_lock:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path + '.tmp', 'w', encoding='utf-8') as output:
+				json.dump({'extracted': time.time(), 'tests': tests}, output)
+			os.replace(path + '.tmp', path)
+	except OSError as e:
+		logging.warning("Cannot cache the %s catalog: %s", service_type_name, repr(e))
+
+def _catalog_load(hostname, service_type_name):
+	'''
+	{'extracted': epoch seconds, 'tests': {name: id}} cached by the last run against hostname, or None
+	'''
+	path = _catalog_path(hostname, service_type_name)
+	if not os.path.exists(path):
+		return None
+	with open(path, 'r', encoding='utf-8') as input:
+		return json.load(input)
+
 def _nGPulse_query_table():
 	return True
+
+def _nGPulse_table(url, params, headers, http=None):
+	'''
+	Entries of the 'data' list of a /query/table response
+	'''
+	if json_settings['stream'] and json_settings['incremental'] and _json_library('ijson') is not None:
+		return _http_get(url, params=params, headers=headers, http=http, read=lambda response: _json_items(response, 'data', True))
+	response = _http_get(url, params=params, headers=headers, http=http)
+	return _json_items(response, 'data')
+
+def _http_get(url, params=None, headers=None, http=None, read=None):
+	'''
+	GET shared by every pipeline in the process. Identical in-flight calls (same url, params and headers) are coalesced,
+	except streamed ones: with read (function of the response yielding items from its body), the items are returned
+	as they arrive, see _http_stream
+	'''
+	if read is not None:
+		return _http_stream('GET', url, read, http, params=params, headers=headers)
+	key = _request_key('GET', url, params, None, headers)
+	with profile_stage('fetch'):
+		return _coalesced(key, lambda: _http_request('GET', url, http, True, params=params, headers=headers))
+
+def _http_post(url, data=None, headers=None, verify=True, http=None):
+	'''
+	POST shared by every pipeline in the process. Only used for read-only calls (nGPulse login, dbONE queries), so it is retried like a GET
+	'''
+	key = _request_key('POST', url, None, data, headers)
+	with profile_stage('fetch'):
+		return _coalesced(key, lambda: _http_request('POST', url, http, True, data=data, headers=headers, verify=verify))
+
+def _json_loads(content):
+	'''
+	Decodes a JSON body from its bytes, without a str copy of it
+	'''
+	if json_settings['library'] != 'json':
+		orjson = _json_library('orjson')
+		if orjson is not None:
+			return orjson.loads(content)
+	return json.loads(content)
+
+def _json_items(response, key, stream=False):
+	'''
+	Entries of the list response[key]: one at a time with ijson, from the body as it arrives when the response is streamed
+	'''
+	ijson = _json_library('ijson') if json_settings['incremental'] else None
+	if ijson is None:
+		return iter(_json_loads(response.content)[key])
+	if not stream:
+		return ijson.items(BytesIO(response.content), key + '.item', use_float=True)
+	return _json_stream(ijson, response, key + '.item')
+
+def _json_stream(ijson, response, prefix):
+	try:
+		response.raw.decode_content = True
+		yield from ijson.items(response.raw, prefix, use_float=True)
+	finally:
+		response.close()
+
+def _json_library(name):
+	'''
+	Optional JSON module (orjson, ijson), None when it is not installed
+	'''
+	if name not in _json_libraries:
+		try:
+			_json_libraries[name] = importlib.import_module(name)
+		except ImportError:
+			_json_libraries[name] = None
+	return _json_libraries[name]
+
+def _http_request(method, url, http=None, idempotent=False, **kwargs):
+	'''
+	Sends a request with connect/read timeouts bounded by the pipeline deadline. 
+	Idempotent calls are retried on connection errors, timeouts, broken bodies, 429 and 5xx with exponential backoff and full jitter.
+	Every attempt goes through the circuit breaker of the target host, so a host that is down fails fast,
+	and through the governor of the host, which limits the rate and the number of concurrent calls.
+	http: per-datasource overrides of the 'HTTP' settings in vaas_lib.yml
+	'''
+	settings, breaker, governor = _http_target(url, http)
+	attempts = 1 + (settings['retries'] if idempotent else 0)
+	
+	for attempt in range(attempts):
+		breaker.before_call()
+		governor.acquire()
+		response = None
+		# no response, 429 and 503 mean the datasource is overloaded
+		congested = False
+		started = time.time()
+		try:
+			response, error, congested = _http_attempt(method, url, settings, breaker, attempt, attempts, **kwargs)
+			if error is None:
+				breaker.success()
+				return response
+		finally:
+			governor.release(time.time() - started, congested)
+			
+		if attempt + 1 < attempts:
+			_http_backoff(attempt, settings, response)
+			
+	raise error
+
+def _http_stream(method, url, read, http=None, **kwargs):
+	'''
+	Streamed idempotent call: yields the items read(response) reads from the body as it arrives.
+	The governor slot of the call is held, and the circuit breaker hears of the outcome, only once the body has been read;
+	the pipeline deadline is checked between items. A body that breaks off is requested again like a failed call, and the
+	items already yielded are skipped
+	'''
+	settings, breaker, governor = _http_target(url, http)
+	attempts = 1 + settings['retries']
+	count = 0
+	
+	for attempt in range(attempts):
+		breaker.before_call()
+		governor.acquire()
+		response = None
+		congested = False
+		started = time.time()
+		latency = None
+		try:
+			response, error, congested = _http_attempt(method, url, settings, breaker, attempt, attempts, stream=True, **kwargs)
+			# the adaptive governor judges the datasource by the time to the headers, not by how fast the pipeline reads
+			latency = time.time() - started
+			if error is None:
+				try:
+					for item in itertools.islice(read(response), count, None):
+						count += 1
+						yield item
+						_deadline_remaining()
+				except _http_retried_errors as e:
+					breaker.failure()
+					congested = True
+					error = e
+					logging.warning("%s %s broke off after %i items (attempt %i of %i): %s", method, url, count, attempt + 1, attempts, e)
+				else:
+					breaker.success()
+					return
+		finally:
+			if response is not None:
+				response.close()
+			governor.release(latency, congested)
+			
+		if attempt + 1 < attempts:
+			_http_backoff(attempt, settings, response)
+			
+	raise error
+
+def _http_target(url, http=None):
+	'''
+	(settings, circuit breaker, governor) of a call to url. http: per-datasource overrides of the 'HTTP' settings
+	'''
+	settings = dict(http_settings)
+	settings.update(http or {})
+	return settings, _circuit_breaker(url, settings), _governor(urllib3.util.parse_url(url).netloc, settings.get('governor'))
+
+def _http_attempt(method, url, settings, breaker, attempt, attempts, **kwargs):
+	'''
+	One attempt of a call: (response, None, False) when it got a response to use (4xx raise HTTPError),
+	(response or None, error, congested) when it failed and may be retried. Failures are reported to the breaker, successes are not
+	'''
+	try:
+		response = requests.request(method, url, timeout=_http_timeout(settings), **kwargs)
+	except _http_retried_errors as e:
+		breaker.failure()
+		logging.warning("%s %s failed (attempt %i of %i): %s", method, url, attempt + 1, attempts, e)
+		return None, e, True
+	if response.status_code < 500 and response.status_code != 429:
+		if response.status_code >= 400:
+			# the host answered: not a failure of the host
+			breaker.success()
+			response.raise_for_status()
+		return response, None, False
+	# 429 means the host is alive but throttling us: retry, but do not count it against the breaker
+	if response.status_code == 429:
+		breaker.success()
+	else:
+		breaker.failure()
+	logging.warning("%s %s returned %i (attempt %i of %i)", method, url, response.status_code, attempt + 1, attempts)
+	error = requests.exceptions.HTTPError("%i Server Error for url: %s" % (response.status_code, url), response=response)
+	return response, error, response.status_code in [429, 503]
+
+def _http_timeout(settings):
+	'''
+	(connect, read) timeout for the next attempt, never beyond the pipeline deadline
+	'''
+	connect_timeout = settings['connect_timeout']
+	read_timeout = settings['read_timeout']
+	remaining = _deadline_remaining()
+	if remaining is not None:
+		connect_timeout = min(connect_timeout, remaining)
+		read_timeout = min(read_timeout, remaining)
+	return (connect_timeout, read_timeout)
+
+def _http_backoff(attempt, settings, response=None):
+	delay = random.uniform(0, min(settings['max_backoff'], settings['backoff'] * 2 ** attempt))
+	if response is not None:
+		try:
+			delay = max(delay, float(response.headers.get('Retry-After')))
+		except (TypeError, ValueError):
+			pass
+	remaining = _deadline_remaining()
+	if remaining is not None and delay >= remaining:
+		raise DeadlineExceeded("Pipeline deadline reached while backing off")
+	time.sleep(delay)
+
+def set_deadline(seconds):
+	'''
+	Sets the deadline of the pipeline running in the current thread, in seconds from now. None removes it
+	'''
+	_pipeline.deadline = time.time() + seconds if seconds else None
+
+def set_pipeline_log(log_file):
+	'''
+	Sets the log file of the pipeline running in the current thread, see PipelineLogFilter. None: not in a pipeline
+	'''
+	_pipeline.log = log_file
+
+class PipelineLogFilter(logging.Filter):
+	'''
+	Lets a handler through only the records logged by the pipelines whose log file is log_file.
+	Records logged outside any pipeline (e.g. the shared dimension refresh) go to the default handler
+	'''
+	def __init__(self, log_file, default=False):
+		super().__init__()
+		self.log_file = log_file
+		self.default = default
+
+	def filter(self, record):
+		log_file = getattr(_pipeline, 'log', None)
+		if log_file is None:
+			return self.default
+		return log_file == self.log_file
+
+def _pipeline_task(function):
+	'''
+	Wraps function so that, when it runs on a worker thread, it keeps the pipeline state (deadline, log file) of the thread that created it
+	'''
+	deadline = getattr(_pipeline, 'deadline', None)
+	log_file = getattr(_pipeline, 'log', None)
+	def task(*args, **kwargs):
+		_pipeline.deadline = deadline
+		_pipeline.log = log_file
+		return function(*args, **kwargs)
+	return task
+
+def _deadline_remaining():
+	'''
+	Seconds left before the deadline of the current pipeline, None when there is no deadline.
+	Raises DeadlineExceeded once it has passed
+	'''
+	deadline = getattr(_pipeline, 'deadline', None)
+	if deadline is None:
+		return None
+	remaining = deadline - time.time()
+	if remaining <= 0:
+		raise DeadlineExceeded("Pipeline deadline reached")
+	return remaining
+
+def start_profile():
+	'''
+	Profiles the stages (config, auth, catalog, fetch, parse, transform, sink) of the pipelines run by the current thread
+	from now on: cProfile and tracemalloc, reported by write_profile
+	'''
+	global _profile
+	tracemalloc.start()
+	# work on worker processes would not show up in the profile
+	transformation_processes['enabled'] = False
+	_profile = _Profile()
+
+@contextlib.contextmanager
+def profile_stage(name):
+	'''
+	Everything run by the current thread inside the block counts as the stage name, except what nested stages run
+	'''
+	profile = _profile
+	if profile is None or profile.thread != threading.get_ident():
+		yield
+		return
+	profile.push(name)
+	try:
+		yield
+	finally:
+		profile.pop()
+
+@contextlib.contextmanager
+def profile_thread(name, waited=None):
+	'''
+	Everything run by another thread than the profiled one inside the block counts as the stage name, on a profiler of its own:
+	the sinks fed by tee_sinks. waited: [seconds] the thread spent waiting for its input, left out of the stage time
+	'''
+	profile = _profile
+	if profile is None or profile.thread == threading.get_ident():
+		yield
+		return
+	profiler = cProfile.Profile()
+	start = time.time()
+	profiler.enable()
+	try:
+		yield
+	finally:
+		profiler.disable()
+		profile.add_thread(name, profiler, time.time() - start - (waited[0] if waited else 0.0))
+
+def profile_iter(name, records):
+	'''
+	Streams records, pulling each of them counts as the stage name. Stages of a streaming pipeline are interleaved record by record
+	'''
+	records = iter(records)
+	while True:
+		with profile_stage(name):
+			try:
+				record = next(records)
+			except StopIteration:
+				return
+		yield record
+
+def write_profile(directory):
+	'''
+	Writes the profile of the run to directory: report.txt (time, peak memory, hot functions of every stage and top allocating lines)
+	and <stage>.prof cProfile stats for pstats or snakeviz
+	'''
+	global _profile
+	profile, _profile = _profile, None
+	if profile is None:
+		return
+	profile.sample()
+	tracemalloc.stop()
+	
+	os.makedirs(directory, exist_ok=True)
+	with open(os.path.join(directory, 'report.txt'), 'w') as report:
+		report.write('%-10s %12s %16s\n' % ('stage', 'seconds', 'peak traced MB'))
+		for name, stage in profile.stages.items():
+			report.write('%-10s %12.3f %16.1f\n' % (name, stage['seconds'], stage['peak'] / 1048576.0))
+		for name, stage in profile.threads.items():
+			report.write('%-10s %12.3f %16s\n' % (name + '*', stage['seconds'], '-'))
+		if profile.threads:
+			report.write('\n* on threads of their own, while the stages above ran; their memory counts in the stages above\n')
+		if not profile.reset_peak:
+			report.write('\nPython < 3.9: the peak of a stage is exact when the peak of the run was reached in it, otherwise it is the\n'
+			             'traced memory when the stage started or ended\n')
+		report.write('\nPeak traced memory %.1f MB during %s\n' % (profile.peak / 1048576.0, profile.peak_stage))
+		try:
+			import resource
+			# kilobytes on Linux
+			report.write('Peak resident memory %.1f MB\n' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+		except ImportError:
+			pass
+		
+		for name, stage in profile.stages.items():
+			stage['profiler'].dump_stats(os.path.join(directory, name + '.prof'))
+			for sort in ['tottime', 'cumulative']:
+				report.write('\n==== %s: hot functions by %s ====\n' % (name, sort))
+				try:
+					stats = pstats.Stats(stage['profiler'], stream=report)
+				except TypeError:
+					# nothing ran in the stage
+					continue
+				stats.sort_stats(sort).print_stats(25)
+		
+		for name, stage in profile.threads.items():
+			try:
+				stats = pstats.Stats(*stage['profilers'], stream=report)
+			except TypeError:
+				continue
+			stats.dump_stats(os.path.join(directory, name + '_threads.prof'))
+			for sort in ['tottime', 'cumulative']:
+				report.write('\n==== %s*: hot functions by %s ====\n' % (name, sort))
+				stats.sort_stats(sort).print_stats(25)
+		
+		if profile.snapshot is not None:
+			report.write('\n==== top allocating lines at %.1f MB, during %s ====\n' % (profile.snapshot_size / 1048576.0, profile.snapshot_stage))
+			snapshot = profile.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+			for statistic in snapshot.statistics('lineno')[:25]:
+				report.write(str(statistic) + '\n')
+	logging.info("Profile written to " + directory)
+
+class _Profile(object):
+	'''
+	One cProfile profiler per stage, enabled while the stage is the innermost one of the profiled thread.
+	At every stage switch the tracemalloc peak since the previous switch is charged to the stage that was running,
+	and the traced allocations are snapshotted whenever they have grown by 10%. Before Python 3.9 the peak cannot be reset:
+	a stage is charged with the peak of the run when it was reached in the stage, otherwise with the traced memory at the switches.
+	Stages run by other threads (profile_thread) only get their time and their own profilers
+	'''
+	def __init__(self):
+		self.thread = threading.get_ident()
+		self.stages = collections.OrderedDict()
+		self.threads = collections.OrderedDict()
+		self.threads_lock = threading.Lock()
+		self.reset_peak = hasattr(tracemalloc, 'reset_peak')
+		self.switched_traced = 0
+		self.switched_peak = 0
+		self.stack = []
+		self.switched = time.time()
+		self.peak = 0
+		self.peak_stage = None
+		self.snapshot = None
+		self.snapshot_size = 0
+		self.snapshot_stage = None
+	
+	def push(self, name):
+		# calls made to log in or to list the tests are part of auth and catalog
+		if name == 'fetch' and self.stack and self.stack[-1] in ['auth', 'catalog']:
+			name = self.stack[-1]
+		self.leave()
+		self.stack.append(name)
+		self.enter()
+	
+	def pop(self):
+		self.leave()
+		self.stack.pop()
+		if self.stack:
+			self.enter()
+	
+	def enter(self):
+		name = self.stack[-1]
+		if name not in self.stages:
+			self.stages[name] = {'profiler': cProfile.Profile(), 'seconds': 0.0, 'peak': 0}
+		self.stages[name]['profiler'].enable()
+	
+	def leave(self):
+		if self.stack:
+			self.stages[self.stack[-1]]['profiler'].disable()
+		self.sample()
+	
+	def sample(self):
+		now = time.time()
+		name = self.stack[-1] if self.stack else 'other'
+		if name not in self.stages:
+			self.stages[name] = {'profiler': cProfile.Profile(), 'seconds': 0.0, 'peak': 0}
+		stage = self.stages[name]
+		stage['seconds'] += now - self.switched
+		self.switched = now
+		
+		current, peak = tracemalloc.get_traced_memory()
+		if self.reset_peak:
+			tracemalloc.reset_peak()
+			stage_peak = peak
+		elif peak > self.switched_peak:
+			# the peak of the run was reached since the previous switch
+			stage_peak = peak
+		else:
+			stage_peak = max(current, self.switched_traced)
+		self.switched_traced = current
+		self.switched_peak = peak
+		stage['peak'] = max(stage['peak'], stage_peak)
+		if peak > self.peak:
+			self.peak = peak
+			self.peak_stage = name
+		if current > self.snapshot_size * 1.1:
+			self.snapshot = tracemalloc.take_snapshot()
+			self.snapshot_size = current
+			self.snapshot_stage = name
+	
+	def add_thread(self, name, profiler, seconds):
+		with self.threads_lock:
+			if name not in self.threads:
+				self.threads[name] = {'profilers': [], 'seconds': 0.0}
+			self.threads[name]['profilers'].append(profiler)
+			self.threads[name]['seconds'] += seconds
+
+def _circuit_breaker(url, settings):
+	host = urllib3.util.parse_url(url).netloc
+	with _circuit_breakers_lock:
+		if host not in _circuit_breakers:
+			_circuit_breakers[host] = _CircuitBreaker(host, settings['breaker_failures'], settings['breaker_reset'])
+		return _circuit_breakers[host]
+
+class _CircuitBreaker(object):
+	'''
+	Opens after 'failures' consecutive failed calls to a host. While open, calls fail immediately with CircuitOpen.
+	After 'reset' seconds a single trial call is let through: success closes the breaker, failure opens it again
+	'''
+	def __init__(self, host, failures, reset):
+		self.host = host
+		self.failures = failures
+		self.reset = reset
+		self.consecutive_failures = 0
+		self.opened_at = None
+		self.lock = threading.Lock()
+		
+	def before_call(self):
+		with self.lock:
+			if self.opened_at is None:
+				return
+			if time.time() - self.opened_at < self.reset:
+				raise CircuitOpen(self.host + " is failing, not calling it for " + str(self.reset) + " seconds")
+			# half-open: let this call through and keep the others out until it completes
+			self.opened_at = time.time()
+			
+	def success(self):
+		with self.lock:
+			self.consecutive_failures = 0
+			self.opened_at = None
+			
+	def failure(self):
+		with self.lock:
+			self.consecutive_failures += 1
+			if self.consecutive_failures >= self.failures:
+				if self.opened_at is None:
+					logging.error("Circuit breaker opened for "+ self.host)
+				self.opened_at = time.time()
+
+def _governor(name, settings=None):
+	'''
+	Governor shared by every pipeline and worker that calls the datasource name (host, or PostgreSQL host and database).
+	settings: the datasource overrides of the 'Governor' settings in vaas_lib.yml
+	'''
+	with _governors_lock:
+		if name not in _governors:
+			config = dict(governor_settings)
+			config.update(settings or {})
+			_governors[name] = _Governor(name, config)
+		return _governors[name]
+
+class _Governor(object):
+	'''
+	Limits the calls to one datasource to 'rate' per second (token bucket of 'burst' calls, 0 is unlimited)
+	and to 'max_in_flight' at a time (0 is unlimited). Callers wait in acquire, at most until the pipeline deadline.
+	With 'adaptive', both limits follow AIMD: they are halved when a call shows congestion (429/503, no response,
+	or slower than 'target_latency' seconds) and grow back additively, up to the configured values, while calls succeed
+	'''
+	def __init__(self, name, settings):
+		self.name = name
+		self.max_rate = self.rate = settings['rate']
+		self.burst = max(1, settings['burst'])
+		self.max_limit = self.limit = settings['max_in_flight']
+		self.adaptive = settings['adaptive']
+		self.target_latency = settings['target_latency']
+		self.tokens = self.burst
+		self.updated = time.time()
+		self.in_flight = 0
+		self.successes = 0
+		self.decreased = 0
+		self.condition = threading.Condition()
+		
+	def acquire(self):
+		with self.condition:
+			while True:
+				now = time.time()
+				if self.rate:
+					self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.limit and self.in_flight >= self.limit:
+					# woken up by release
+					wait = 1
+				elif self.rate and self.tokens < 1:
+					wait = (1 - self.tokens) / self.rate
+				else:
+					self.tokens -= 1
+					self.in_flight += 1
+					return
+				remaining = _deadline_remaining()
+				self.condition.wait(wait if remaining is None else min(wait, remaining))
+				
+	def release(self, latency=None, congested=False):
+		with self.condition:
+			self.in_flight -= 1
+			if self.adaptive:
+				if congested or (latency is not None and latency > self.target_latency):
+					self._decrease()
+				else:
+					self._increase()
+			self.condition.notify_all()
+			
+	def _decrease(self):
+		# the calls in flight when the datasource got congested all report it: halve once per second at most
+		if time.time() - self.decreased < 1:
+			return
+		self.decreased = time.time()
+		self.successes = 0
+		if self.limit:
+			self.limit = max(1, self.limit // 2)
+		if self.rate:
+			self.rate = max(self.max_rate / 16, self.rate / 2)
+		logging.warning("%s is congested, limiting it to %s calls in flight and %s calls per second", self.name, self.limit or 'unlimited', self.rate or 'unlimited')
+		
+	def _increase(self):
+		# one step per window of successful calls
+		self.successes += 1
+		if self.successes < max(1, self.limit):
+			return
+		self.successes = 0
+		if self.limit < self.max_limit:
+			self.limit += 1
+		if self.rate < self.max_rate:
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+def _request_key(method, url, params, data, headers):
+	# params are snapshotted here because the extractors keep mutating kpi_filter_params between calls
+	return (method, url, _freeze(params), _freeze(data), _freeze(headers))
+
+def _freeze(value):
+	if isinstance(value, dict):
+		return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+	if isinstance(value, (list, tuple)):
+		return tuple(_freeze(item) for item in value)
+	return value
+
+def _coalesced(key, call):
+	'''
+	Runs call() once per key. Concurrent callers with the same key block until the first one completes and share its result.
+	Waiters hold the future, so the key is removed as soon as the call completes (failed calls always, successful ones after coalescing_ttl)
+	'''
+	if not coalescing_enabled:
+		return call()
+
+	with _coalesced_calls_lock:
+		now = time.time()
+		for expired in [k for k, (f, done_at) in _coalesced_calls.items() if done_at is not None and now - done_at > coalescing_ttl]:
+			del _coalesced_calls[expired]
+
+		owner = key not in _coalesced_calls
+		if owner:
+			_coalesced_calls[key] = (Future(), None)
+		future = _coalesced_calls[key][0]
+
+	if not owner:
+		logging.info("Coalesced with identical upstream request: "+ key[0] + " " + key[1])
+		try:
+			return future.result(timeout=_deadline_remaining())
+		except FutureTimeoutError:
+			raise DeadlineExceeded("Pipeline deadline reached while waiting for "+ key[1])
+
+	try:
+		response = call()
+	except Exception as e:
+		# failures are not shared beyond the callers already waiting for them
+		with _coalesced_calls_lock:
+			_coalesced_calls.pop(key, None)
+		future.set_exception(e)
+		raise
+
+	with _coalesced_calls_lock:
+		if not coalescing_ttl:
+			_coalesced_calls.pop(key, None)
+		elif key in _coalesced_calls:
+			_coalesced_calls[key] = (future, time.time())
+	future.set_result(response)
+	return response
+
+class _Names(dict):
+	'''
+	One string per distinct name (test, nPoint, device, site) or time of an extract, shared by all its rows,
+	with the output separator replaced once per name instead of once per row
+	'''
+	__slots__ = ()
 	
+	def __missing__(self, value):
+		name = self[value] = sys.intern(str(value).replace(output_separator, " "))
+		return name
+
+class _TrendTimes(dict):
+	'''
+	Times of the points of nGPulse trends ('str' format: 2018-Oct-30_11:09), parsed once per extract: every nPoint and kpi has the same ones
+	'''
+	__slots__ = ()
+	
+	def __missing__(self, value):
+		time = self[value] = datetime.datetime.strptime(value,'%Y-%b-%d_%H:%M')
+		return time
+
+def _record(values):
+	# values are rendered as the csv module would write them: None as an empty string, anything else with str()
+	return tuple('' if value is None else str(value) for value in values)
+
 def get_hostname(hostname, port):	
 	if port is not None:
 		return hostname + ":" + port
@@ -830,102 +2630,432 @@ def transformation(text, output_headers, transformations):
 	 
 	headers = ['Customer', 'Service', 'Location', 'Date', 'mosBucket3In', 'mosBucket2In', 'mosBucket1In', 'ucServiceId', 'Total_Transactions', 'Avg_Good_Mos', 'Time', 'ucServiceId_String', 'targetTime_String']
 	
+	text can also be a list of lines. Lines are parsed with output_separator; the pipeline itself streams records through transform_records
 	'''
+	
+	if isinstance(text, str):
+		text = text.splitlines()
+	
+	response = StringIO()
+	writer = csv.writer(response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
+	
+	writer.writerows(transform_records(csv.reader(text, delimiter=output_separator), output_headers, transformations))
+	
+	return response.getvalue()
 
-	result_set = text
-	logging.debug(">>>======RESULT SET========")
-	logging.debug(result_set)
-	logging.debug("======RESULT SET========<<<<")
+def transform_records(records, output_headers, transformations):
+	'''
+	Streaming transformation. records is an iterable of records (sequences of strings) as yielded by the query_* extractors:
+	its first record is the header, unless the transformations add one ('Header: add_header').
+	Yields the output header and then one transformed row per record, so only the record being transformed is held in memory.
+	Output fields declared in the 'Types' section are converted to int, float (rounded to 'decimals') or datetime (from epoch
+	'unit': ms or s), empty when they are not numbers
+	'''
+	records = iter(records)
+	
+	api_headers = _transformation_headers(records, transformations)
+	logging.debug(api_headers)
+	
+	yield list(output_headers)
 	
-	Header=True if 'Header' in transformations.keys() else False
+	count = 0
+	if 'Transformations' in transformations.keys():
+		plan = _transformation_plan(api_headers, output_headers, transformations['Transformations'], transformations.get('Types'))
+		for size, rows in _run_plan(plan, records):
+			count += size
+			yield from rows
+	else:
+		# without transformations records are passed through as they are
+		for record in records:
+			count += 1
+			yield list(record)
+	
+	logging.info("Transformed %i records", count)
+
+def _transformation_headers(records, transformations):
+	'''
+	Header of the records, as changed by the 'Header' section. Consumes the header record unless 'add_header' provides it
+	'''
+	header = None
 	
-	if Header:
+	if 'Header' in transformations.keys():
 		if 'add_header' in transformations['Header'].keys():
 			# Adding a header to the result_set
-			result_set.insert(0, output_separator.join(transformations['Header']['add_header']))
+			header = list(transformations['Header']['add_header'])
 			
 		if 'modify_header' in transformations['Header'].keys():
 			# Assumes result_set contains header. Rename certain fields as per 'modify_header' mapping configuration
-			header=result_set[0].split(output_separator)
+			if header is None:
+				header = list(next(records, []))
 			mapping=transformations['Header']['modify_header']
 			for key, value in mapping.items():
 				header[header.index(key)]=value		
-			
-			result_set[0]=output_separator.join(header)
 	else:
 		logging.debug("No changes made to Header")
 	
-	logging.debug(result_set)
-	api_headers= result_set.pop(0).split(output_separator)
-	logging.debug(api_headers)
-	api_body = list(map(lambda x: x.replace('"','').split(output_separator),result_set)) 
-	
-	
-	transformed = []
-	transformed.append(output_headers)
-	
-	Transformations=True if 'Transformations' in transformations.keys() else False
-	
-	logging.debug(Transformations)
-	
-	if Transformations:
-		transformations = transformations['Transformations']
-	
-		for result in api_body:
-			eRow = [] # Enhanced Record
-			logging.info(result)
-			for out_field in output_headers:
+	if header is None:
+		header = list(next(records, []))
+	return header
+
+def transformation_columns(output_headers, transformations):
+	'''
+	Names of the extract columns the transformation of output_headers can read, None when it reads them all or by position
+	(no 'Transformations', or 'add_header')
+	'''
+	header = transformations.get('Header') or {}
+	if 'Transformations' not in transformations or 'add_header' in header:
+		return None
+	# columns renamed by 'modify_header' are read under their new name
+	renamed = dict((value, key) for key, value in (header.get('modify_header') or {}).items())
+	
+	columns = set()
+	for out_field in output_headers:
+		columns.add(renamed.get(out_field, out_field))
+		lookup_column = (transformations['Transformations'].get(out_field) or {}).get('lookup_column')
+		if lookup_column is not None:
+			columns.add(renamed.get(lookup_column, lookup_column))
+	return columns
+
+def _transformation_plan(api_headers, output_headers, transformations, types=None):
+	'''
+	Compiles the transformations of every output field once, instead of once per record:
+	('copy', index) copies a column of the record, ('const', value) is the same for every record,
+	('simple', index, mapped, default) is a mapping file lookup and ('date', index, date_format, cache) a date conversion.
+	('typed', step, cast) converts the value of step to the type declared in types (see _typed_step).
+	The plan only holds plain data, so it can be sent to other processes.
+	'''
+	types = types or {}
+	plan = []
+	for out_field in output_headers:
+		if out_field in api_headers:
+			step = ('copy', api_headers.index(out_field))
+		elif transformations[out_field]['type'] == 'simple':
+			step = _simple_step(api_headers, out_field, transformations[out_field])
+		elif transformations[out_field]['type'] == 'date':
+			step = _date_step(api_headers, out_field, transformations[out_field])
+		elif transformations[out_field]['type'] == 'date_injection':
+			step = ('const', transformation_date_injection(None, api_headers, out_field, transformations[out_field]))
+		else:
+			logging.warning("Unknown transformation type for "+ out_field +", the field is left out")
+			continue
+		if out_field in types:
+			step = _typed_step(step, out_field, types[out_field])
+		plan.append(step)
+	return plan
+
+def _typed_step(step, field, declaration):
+	'''
+	step with its value converted as declared for field: ('int',), ('float', decimals) or ('datetime', divisor to seconds)
+	'''
+	if declaration['type'] == 'int':
+		cast = ('int',)
+	elif declaration['type'] == 'float':
+		cast = ('float', declaration.get('decimals'))
+	elif declaration['type'] == 'datetime':
+		cast = ('datetime', {'ms': 1000, 's': 1}[declaration.get('unit', 'ms')])
+	else:
+		logging.warning("Unknown type "+ str(declaration['type']) +" for "+ field +", the field is left as it is")
+		return step
+	if step[0] == 'const':
+		return ('const', _typed_value(cast, step[1]))
+	return ('typed', step, cast)
+
+def _typed_value(cast, value):
+	if value is None or value == '':
+		return None
+	try:
+		if cast[0] == 'int':
+			if isinstance(value, int):
+				return value
+			if isinstance(value, str):
 				try:
-					index = api_headers.index(out_field)
-					eRow.append(result[index])
+					return int(value)
 				except ValueError:
-					if transformations[out_field]['type'] == 'simple':
-						eRow.append(transformation_simple(result, api_headers, out_field, transformations[out_field]))
-					if 	transformations[out_field]['type'] == 'date':
-						eRow.append(transformation_date(result, api_headers, out_field, transformations[out_field]))
-					if 	transformations[out_field]['type'] == 'date_injection':
-						eRow.append(transformation_date_injection(result, api_headers, out_field, transformations[out_field]))							
-			logging.info(eRow)			
-			transformed.append(eRow)
-	else:
-		transformed = transformed + api_body
-		
-	logging.debug(transformed)
-	
-	response = StringIO()
-	writer = csv.writer(response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
-	
-	writer.writerows(transformed)
-	
-	#print("\n".join(map(lambda x: print(x), transformed)))
-	#return "\n".join(map(lambda x: ",".join(x), transformed))
-	return response.getvalue()
+					pass
+			# whole numbers written as decimals ('12.0', '1.2e3') are read exactly; other decimals are not ints
+			number = decimal.Decimal(value)
+			return int(number) if number == number.to_integral_value() else None
+		if cast[0] == 'float':
+			return float(value) if cast[1] is None else round(float(value), cast[1])
+		return datetime.datetime.fromtimestamp(float(value) / cast[1], tz)
+	except (ValueError, TypeError, OverflowError, OSError, decimal.InvalidOperation):
+		return None
+
+def _run_plan(plan, records):
+	'''
+	Runs the plan over every record: record by record or chunk by chunk with the columnar backend (see _run_plan_local).
+	The records after the first transformation_processes['min_rows'] ones are transformed on worker processes.
+	Yields (number of records, transformed rows) in input order
+	'''
+	workers = _transformation_workers()
+	if not workers:
+		yield from _run_plan_local(plan, records)
+		return
+	
+	# the first records are transformed (and streamed on) here while they are counted, so smaller feeds never pay for
+	# starting the pool and larger ones are not held back until the count is reached
+	records = iter(records)
+	count = 0
+	for size, rows in _run_plan_local(plan, itertools.islice(records, transformation_processes['min_rows'])):
+		count += size
+		yield size, rows
+	if count == transformation_processes['min_rows']:
+		yield from _run_plan_processes(plan, records, workers)
+
+def _run_plan_local(plan, records):
+	'''
+	Runs the plan over every record in this process. Yields (number of records, transformed rows) in input order
+	'''
+	columnar = False
+	if transformation_backend != 'python':
+		# pandas is only imported for extracts of at least columnar_min_rows records
+		head = list(itertools.islice(records, columnar_min_rows))
+		records = itertools.chain(head, records)
+		columnar = len(head) == columnar_min_rows and _columnar()
+	
+	if not columnar:
+		for record in records:
+			yield 1, (_transform_record(plan, record),)
+		return
+	
+	for chunk in _chunks(records, columnar_chunk_size):
+		yield len(chunk), _transform_chunk(plan, chunk)
+
+def _run_plan_processes(plan, records, workers):
+	'''
+	Transforms chunks of records on a pool of worker processes. The plan, with its mapping file indexes, is sent to every
+	worker once when it starts; chunks only carry records. At most two chunks per worker are in flight
+	'''
+	chunks = _chunks(records, transformation_processes['chunk_size'])
+	chunk = next(chunks, None)
+	if chunk is None:
+		return
+	logging.info("Transforming on %i worker processes", workers)
+	with ProcessPoolExecutor(max_workers=workers, mp_context=_transformation_context(),
+	                         initializer=_process_plan_init, initargs=(plan,)) as executor:
+		pending = collections.deque()
+		for chunk in itertools.chain([chunk], chunks):
+			pending.append((len(chunk), executor.submit(_process_plan_chunk, chunk)))
+			if len(pending) >= 2 * workers:
+				size, future = pending.popleft()
+				yield size, future.result()
+		while pending:
+			size, future = pending.popleft()
+			yield size, future.result()
+
+def _transformation_workers():
+	'''
+	Number of worker processes for large extracts, 0 when they are not used
+	'''
+	if not transformation_processes['enabled']:
+		return 0
+	workers = transformation_processes['workers'] or os.cpu_count() or 1
+	return workers if workers > 1 else 0
 
-def transformation_simple(record, headers, mapping, transformations):
+def _transformation_context():
+	'''
+	Start method of the worker processes. Pipelines run on several threads, so workers are not forked from this process:
+	a forkserver forks them from a single-threaded server that only preloads this library, or they are spawned
+	'''
+	method = transformation_processes['start_method']
+	if method not in multiprocessing.get_all_start_methods():
+		method = 'spawn'
+	context = multiprocessing.get_context(method)
+	if method == 'forkserver':
+		context.set_forkserver_preload([__name__])
+	return context
+
+def _process_plan_init(plan):
+	global _process_plan
+	_process_plan = plan
+
+def _process_plan_chunk(chunk):
+	return list(_transform_chunk(_process_plan, chunk))
+
+def _chunks(records, size):
+	while True:
+		chunk = list(itertools.islice(records, size))
+		if not chunk:
+			return
+		yield chunk
+
+def _transform_chunk(plan, chunk):
+	'''
+	Transforms a chunk of records as whole columns (see _transform_columns), or record by record when the chunk is small
+	or ragged, or pandas is not used. Both give the same rows
+	'''
+	rows = None
+	if _columnar() and len(chunk) >= columnar_min_rows and len(set(map(len, chunk))) == 1:
+		rows = _transform_columns(plan, chunk)
+	if rows is None:
+		rows = [_transform_record(plan, record) for record in chunk]
+	return rows
+
+def _columnar():
+	return transformation_backend != 'python' and _pandas_module() is not None
+
+def _pandas_module():
+	global _pandas
+	if _pandas is None and transformation_backend in ['pandas', 'auto']:
+		try:
+			import pandas
+			_pandas = pandas
+		except ImportError:
+			if transformation_backend == 'pandas':
+				logging.warning("Transformation_Backend is pandas but pandas is not installed, transforming record by record")
+			_pandas = False
+	return _pandas or None
+
+def _transform_columns(plan, chunk):
+	'''
+	Columnar execution of the plan with NumPy/pandas:
+	a 'simple' step is a hash join of every column against the mapping file index (the first matching row wins, as in _simple_lookup),
+	computed once for all the steps that share the index, and a 'date' step converts each distinct value once (pandas.factorize)
+	and expands the results with an array take.
+	Returns the transformed rows (tuples), or None when the chunk cannot be factorized (missing values)
+	'''
+	pandas = _pandas_module()
+	import numpy
+	
+	table = numpy.array(chunk, dtype=object)
+	columns = [table[:, index].tolist() for index in range(table.shape[1])]
+	positions = {}
+	
+	def column(step):
+		if step[0] == 'copy':
+			return columns[step[1]]
+		elif step[0] == 'const':
+			return [step[1]] * len(chunk)
+		elif step[0] == 'simple':
+			if id(step[1]) not in positions:
+				positions[id(step[1])] = _columnar_positions(numpy, step[1], len(step[2]), columns)
+			# the default is appended after the mapped values, at the position of the records without a match
+			mapped = numpy.array(step[2] + [step[3]], dtype=object)
+			return mapped.take(positions[id(step[1])]).tolist()
+		elif step[0] == 'typed':
+			values = column(step[1])
+			return None if values is None else [_typed_value(step[2], value) for value in values]
+		else:
+			codes, uniques = pandas.factorize(table[:, step[1]])
+			if (codes < 0).any():
+				return None
+			converted = numpy.array([_date_value(step, value) for value in uniques], dtype=object)
+			return converted.take(codes).tolist()
+	
+	output = []
+	for step in plan:
+		values = column(step)
+		if values is None:
+			return None
+		output.append(values)
+	
+	return zip(*output)
+
+def _columnar_positions(numpy, index, missing, columns):
+	'''
+	Position of the first mapping file row matching any value of each record, missing (the number of rows) when there is none
+	'''
+	position = numpy.full(len(columns[0]), missing, dtype=numpy.int64)
+	for column in columns:
+		found = numpy.fromiter(map(index.get, column, itertools.repeat(missing)), dtype=numpy.int64, count=len(column))
+		numpy.minimum(position, found, out=position)
+	return position
+
+def _transform_record(plan, record):
+	eRow = [] # Enhanced Record
+	for step in plan:
+		if step[0] == 'copy':
+			eRow.append(record[step[1]])
+		elif step[0] == 'const':
+			eRow.append(step[1])
+		elif step[0] == 'simple':
+			eRow.append(_simple_lookup(step, record))
+		elif step[0] == 'typed':
+			value = record[step[1][1]] if step[1][0] == 'copy' else _transform_record((step[1],), record)[0]
+			eRow.append(_typed_value(step[2], value))
+		else:
+			eRow.append(_date_lookup(step, record))
+	return eRow
+
+def _simple_step(headers, mapping, transformations):
 	logging.info("A simple transformation: "+ mapping)
 	
 	try:
-		with open(transformations['mapping_file'], 'r') as mappings:
-			lookups = list(csv.DictReader(mappings, delimiter=service_mappings_separator))
-		lookup_column = headers.index(transformations['lookup_column'])
-		
-		for lookup in lookups:
-			if lookup[transformations['lookup_column']] in record:
-				return lookup[mapping]
-		return transformations['default']
+		lookups, fieldnames = _mapping_file(transformations['mapping_file'])
+		lookup_column = transformations['lookup_column']
+		headers.index(lookup_column)
 	except KeyError:
-		return transformations['default']	
+		return ('const', transformations['default'])
 	
-def transformation_date(record, headers, mapping, transformations):
+	if lookups and (lookup_column not in fieldnames or mapping not in fieldnames):
+		return ('const', transformations['default'])
+	
+	# A record maps to the first mapping file row (in file order) whose lookup value is one of the record values.
+	# index: lookup value -> position of its first row, mapped: mapped value of every row
+	index = _mapping_index(transformations['mapping_file'], lookup_column)
+	mapped = [lookup[mapping] for lookup in lookups]
+	
+	return ('simple', index, mapped, transformations['default'])
+
+def _simple_lookup(step, record):
+	index = step[1]
+	position = None
+	for value in record:
+		found = index.get(value)
+		if found is not None and (position is None or found < position):
+			position = found
+	return step[3] if position is None else step[2][position]
 
+def _mapping_file(mapping_file):
+	'''
+	Rows and column names of a mapping file, read once per process
+	'''
+	with _mapping_files_lock:
+		if mapping_file not in _mapping_files:
+			with open(mapping_file, 'r') as mappings:
+				reader = csv.DictReader(mappings, delimiter=service_mappings_separator)
+				_mapping_files[mapping_file] = (list(reader), reader.fieldnames or [])
+		return _mapping_files[mapping_file]
+
+def _mapping_index(mapping_file, lookup_column):
+	'''
+	Lookup value -> position of its first row in the mapping file. Built once and shared by all the fields mapped through the same column
+	'''
+	lookups, fieldnames = _mapping_file(mapping_file)
+	with _mapping_files_lock:
+		if (mapping_file, lookup_column) not in _mapping_indexes:
+			index = {}
+			for position, lookup in enumerate(lookups):
+				if lookup[lookup_column] is not None and lookup[lookup_column] not in index:
+					index[lookup[lookup_column]] = position
+			_mapping_indexes[(mapping_file, lookup_column)] = index
+		return _mapping_indexes[(mapping_file, lookup_column)]
+
+def _date_step(headers, mapping, transformations):
+	logging.info("A date transformation: "+ mapping)
 	try:
-		logging.info("A date transformation: "+ mapping)
-		
-		lookup_column = headers.index(transformations['lookup_column'])	
-		
-		return datetime.date.strftime(parse( record[lookup_column], tzinfos=tzinfos ) , transformations['date_format'])
+		return ('date', headers.index(transformations['lookup_column']), transformations['date_format'], {})
 	except:
+		return ('const', "00-0-0000 00:00:00")
+
+def _date_lookup(step, record):
+	try:
+		value = record[step[1]]
+	except IndexError:
 		return "00-0-0000 00:00:00"
+	return _date_value(step, value)
+
+def _date_value(step, value):
+	# dates repeat a lot (one per time bucket), so each distinct value is parsed only once
+	cache = step[3]
+	if value not in cache:
+		if len(cache) > 100000:
+			cache.clear()
+		try:
+			cache[value] = datetime.date.strftime(parse( value, tzinfos=tzinfos ) , step[2])
+		except:
+			cache[value] = "00-0-0000 00:00:00"
+	return cache[value]
 
 def transformation_date_injection(record, headers, mapping, transformations):
 	try:
@@ -962,7 +3092,7 @@ def send_notification(server, port, from_email, to_email, subject, msg_body, att
 	msg.attach(MIMEText(msg_body, 'plain'))
 
 	part = MIMEBase('application', 'octet-stream')
-	part.set_payload(attachment)
+	part.set_payload(attachment if isinstance(attachment, str) else records_to_csv(attachment))
 	encoders.encode_base64(part)
 	part.add_header('Content-Disposition', "attachment; filename= %s" % filename)
 	msg.attach(part)
@@ -979,7 +3109,9 @@ def send_notification(server, port, from_email, to_email, subject, msg_body, att
 	smtp_srv.quit()
 	
 def csv_to_disk(content,filename,directory):
-
+	'''
+	content: CSV text, or an iterable of records that is written as it is consumed
+	'''
 	output = os.path.join(directory,filename)
 	logging.info("========== Writing to local CSV %s ==========", output)
 	
@@ -987,9 +3119,346 @@ def csv_to_disk(content,filename,directory):
 	if not os.path.exists(directory):
 		os.makedirs(directory)
 		
-	file = open(output,"w")
-	file.write(content)
+	file = open(output,"w",newline='')
+	if isinstance(content, str):
+		file.write(content)
+	else:
+		writer = csv.writer(file,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
+		writer.writerows(content)
 	file.close()
+
+def csv_partitions_to_disk(records, columns, filename, directory):
+	'''
+	Writes the records to one CSV file per value of columns (output columns, e.g. ['location']), in one pass:
+	<filename>_<values>.csv, each with the header. At most partition_settings['max_open_files'] files are open at a time.
+	Returns [(values, path)] of the partitions, in order of their first row
+	'''
+	logging.info("========== Writing partitions by %s to local CSV %s ==========", ','.join(columns), directory)
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	
+	records = iter(records)
+	header = next(records, None)
+	if header is None:
+		return []
+	indexes = [list(header).index(column) for column in columns]
+	base, extension = os.path.splitext(filename)
 	
+	paths = collections.OrderedDict()
+	open_files = collections.OrderedDict()
+	try:
+		for record in records:
+			values = tuple(record[index] for index in indexes)
+			writer = open_files.get(values)
+			if writer is None:
+				if len(open_files) >= partition_settings['max_open_files']:
+					# the least recently written partition
+					open_files.popitem(last=False)[1][0].close()
+				if values in paths:
+					file = open(paths[values], 'a', newline='')
+					writer = (file, csv.writer(file, delimiter=output_separator, quoting=csv.QUOTE_MINIMAL))
+				else:
+					paths[values] = _partition_path(directory, base, extension, values, paths.values())
+					file = open(paths[values], 'w', newline='')
+					writer = (file, csv.writer(file, delimiter=output_separator, quoting=csv.QUOTE_MINIMAL))
+					writer[1].writerow(header)
+				open_files[values] = writer
+			else:
+				open_files.move_to_end(values)
+			writer[1].writerow(record)
+	finally:
+		for file, writer in open_files.values():
+			file.close()
+	
+	logging.info("%i partitions written", len(paths))
+	return list(paths.items())
+
+def _partition_path(directory, base, extension, values, used):
+	name = '_'.join(re.sub(r'[^\w.-]+', '_', '' if value is None else str(value)).strip('_') or 'none' for value in values)
+	path = os.path.join(directory, base + '_' + name + extension)
+	count = 1
+	while path in used:
+		count += 1
+		path = os.path.join(directory, base + '_' + name + '_' + str(count) + extension)
+	return path
+
+def send_partitions(server, port, from_email, to_email, subject, msg_body, records, columns, filename):
+	'''
+	Sends one email per value of columns, with the CSV of its rows attached (see csv_partitions_to_disk).
+	The partitions are written to a temporary directory first, so only one of them is held in memory at a time
+	'''
+	directory = tempfile.mkdtemp()
+	try:
+		for values, path in csv_partitions_to_disk(records, columns, filename, directory):
+			with open(path, newline='') as partition:
+				send_notification(server, port, from_email, to_email, subject + ';' + ';'.join(_text_value(value) for value in values), msg_body,
+				                  partition.read(), os.path.basename(path))
+	finally:
+		shutil.rmtree(directory)
+
+def records_to_database(records, database, table, key_columns=None, types=None):
+	'''
+	Bulk-loads records (header first) into a database table, created from the header when it does not exist: TEXT columns,
+	or the column type of the transformations 'Types' declaration (types) of the column.
+	With key_columns, rows replace the rows with the same key (upsert); the last of several rows with one key wins.
+	Empty values are loaded as NULL.
+	database: {'type': 'sqlite', 'path': file} or {'type': 'postgres', 'host':, 'port':, 'user':, 'password':, 'dbname':}
+	PostgreSQL rows are sent with COPY FROM STDIN, SQLite rows with batched executemany, Psql_Batch_Size rows at a time.
+	Returns the number of rows loaded
+	'''
+	records = iter(records)
+	header = list(next(records))
+	key_columns = key_columns or []
+	for column in key_columns:
+		if column not in header:
+			raise Exception(column+" is not a column of "+table)
+	
+	logging.info("========== Loading %s into %s database ==========", table, database['type'])
+	if database['type'] == 'sqlite':
+		count = _sqlite_load(records, database, table, header, key_columns, types)
+	elif database['type'] == 'postgres':
+		count = _psql_load(records, database, table, header, key_columns, types)
+	else:
+		raise Exception(str(database['type'])+' is not a valid database type')
+	
+	logging.info("Loaded %i rows into %s", count, table)
+	return count
+
+def _sqlite_load(records, database, table, header, key_columns, types=None):
+	columns = ', '.join(_quote_identifier(column) for column in header)
+	
+	connection = sqlite3.connect(database['path'])
+	try:
+		with connection:
+			connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %(_quote_identifier(table), _table_columns(header, key_columns, types, sqlite_column_types)))
+			# with a primary key, OR REPLACE turns every insert into an upsert
+			insert = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' %(_quote_identifier(table), columns, ', '.join('?' * len(header)))
+			count = 0
+			for batch in _chunks(records, psql_batch_size):
+				# SQLite has no datetime type, they are stored as ISO 8601 text
+				connection.executemany(insert, [[value.isoformat(' ') if isinstance(value, datetime.datetime) else value if value != '' else None
+				                                 for value in record] for record in batch])
+				count += len(batch)
+	finally:
+		connection.close()
+	return count
+
+def _psql_load(records, database, table, header, key_columns, types=None):
+	columns = ', '.join(_quote_identifier(column) for column in header)
+	
+	connection = psycopg2.connect(host=database.get('host'), port=database.get('port'), user=database.get('user'),
+	                              password=database.get('password'), dbname=database.get('dbname'))
+	try:
+		with connection:
+			with connection.cursor() as cur:
+				cur.execute('CREATE TABLE IF NOT EXISTS %s (%s)' %(_quote_identifier(table), _table_columns(header, key_columns, types, psql_column_types)))
+				target = _quote_identifier(table)
+				if key_columns:
+					# rows are copied into a staging table and merged from there
+					target = 'vaaspipe_load'
+					cur.execute('CREATE TEMP TABLE vaaspipe_load (LIKE %s) ON COMMIT DROP' %(_quote_identifier(table)))
+				
+				count = 0
+				for batch in _chunks(records, psql_batch_size):
+					# in CSV format, an empty unquoted value is NULL
+					rows = StringIO()
+					csv.writer(rows).writerows(batch)
+					rows.seek(0)
+					cur.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' %(target, columns), rows)
+					count += len(batch)
+				
+				if key_columns:
+					keys = ', '.join(_quote_identifier(column) for column in key_columns)
+					updates = ', '.join('%s = EXCLUDED.%s' %(_quote_identifier(column), _quote_identifier(column)) for column in header if column not in key_columns)
+					# ON CONFLICT cannot update a row twice: keep the last row of every key (the staging table is only appended to, so ctid follows load order)
+					cur.execute('INSERT INTO %s (%s) SELECT DISTINCT ON (%s) %s FROM vaaspipe_load ORDER BY %s, ctid DESC ON CONFLICT (%s) DO %s'
+					            %(_quote_identifier(table), columns, keys, columns, keys, keys, ('UPDATE SET ' + updates) if updates else 'NOTHING'))
+	finally:
+		connection.close()
+	return count
+
+def _table_columns(header, key_columns, types=None, column_types=None):
+	types = types or {}
+	column_types = column_types or {}
+	columns = ['%s %s' %(_quote_identifier(column), column_types[types[column]['type']] if column in types and types[column]['type'] in column_types else 'TEXT')
+	           for column in header]
+	if key_columns:
+		columns.append('PRIMARY KEY (%s)' %(', '.join(_quote_identifier(column) for column in key_columns)))
+	return ', '.join(columns)
+
+def _quote_identifier(name):
+	return '"' + str(name).replace('"', '""') + '"'
+
+def tee_sinks(records, sinks):
+	'''
+	Feeds one stream of records to several sinks at the same time. sinks: list of (name, function of the records), each run on
+	its own thread with its own bounded queue, so the slowest sink sets the pace and only a few chunks are held in memory.
+	Sinks get the same rows and must not change them. A sink that fails is logged and then drained, without holding up the others;
+	when the records fail, every sink gets the error. Raises once every sink is done if any failed, returns {name: result}
+	'''
+	queues = [(name, queue.Queue(maxsize=sink_settings['queue_chunks'])) for name, function in sinks]
+	
+	def run(name, function, chunks):
+		start = time.time()
+		received = [0]
+		done = [False]
+		waited = [0.0]
+		def rows():
+			while True:
+				before = time.time()
+				chunk = chunks.get()
+				waited[0] += time.time() - before
+				if chunk is None or isinstance(chunk, BaseException):
+					done[0] = True
+					if chunk is None:
+						return
+					raise chunk
+				received[0] += len(chunk)
+				yield from chunk
+		try:
+			with profile_thread('sink', waited):
+				result = function(rows())
+			logging.info("Sink %s: %i rows in %.1f s", name, received[0], time.time() - start)
+			return result
+		except BaseException as e:
+			logging.error("Sink %s failed after %i rows and %.1f s: %s", name, received[0], time.time() - start, repr(e))
+			raise
+		finally:
+			# the rest of the rows are discarded, so the other sinks go on
+			while not done[0]:
+				chunk = chunks.get()
+				done[0] = chunk is None or isinstance(chunk, BaseException)
+	
+	with ThreadPoolExecutor(max_workers=len(sinks), thread_name_prefix='sink') as executor:
+		futures = [executor.submit(_pipeline_task(run), name, function, chunks) for (name, function), (name, chunks) in zip(sinks, queues)]
+		try:
+			for chunk in _chunks(iter(records), sink_settings['chunk_size']):
+				for name, chunks in queues:
+					chunks.put(chunk)
+			end = None
+		except BaseException as e:
+			end = e
+		for name, chunks in queues:
+			chunks.put(end)
+	
+	results = {}
+	errors = []
+	for (name, function), future in zip(sinks, futures):
+		try:
+			results[name] = future.result()
+		except Exception as e:
+			errors.append((name, e))
+	if end is not None:
+		raise end
+	if errors:
+		raise Exception("Sinks failed: " + ', '.join(name + ': ' + repr(e) for name, e in errors))
+	return results
+
+def records_to_csv(records):
+	response = StringIO()
+	writer = csv.writer(response,delimiter=output_separator,quoting=csv.QUOTE_MINIMAL)
+	writer.writerows(records)
+	return response.getvalue()
+
+def text_records(records, types=None):
+	'''
+	records (header first) as the text sinks write them: the datetime columns declared in types (the transformations 'Types')
+	formatted with the 'format' of their declaration, datetime_text_format by default
+	'''
+	formats = dict((field, declaration.get('format', datetime_text_format)) for field, declaration in (types or {}).items()
+	               if declaration.get('type') == 'datetime')
+	records = iter(records)
+	header = next(records, None)
+	if header is None:
+		return
+	yield header
+	columns = [(index, formats[field]) for index, field in enumerate(header) if field in formats]
+	if not columns:
+		yield from records
+		return
+	for record in records:
+		record = list(record)
+		for index, date_format in columns:
+			if isinstance(record[index], datetime.datetime):
+				record[index] = record[index].strftime(date_format)
+		yield record
+
+def _text_value(value):
+	'''
+	value as the CSV writer writes it: typed values (see 'Types' of the transformations) as text, None as empty
+	'''
+	return '' if value is None else str(value)
+	
+def dimension_delta(records, delta, name):
+	'''
+	Reduces the records of a transformed dimension export (header first) to the rows that changed since the previous export.
+	A fingerprint (one hash per row, keyed on the JSON list of delta['key_columns']) is kept in delta['state_dir'].
+	The output gets a 'change_type' column: insert, update or delete (deleted rows only carry their key columns).
+	Every delta['full_snapshot_days'] days (and on the first run, or with a fingerprint of an older format) the full table is exported
+	instead, with change_type 'snapshot'. The records are streamed: only the hashes and the changed rows are kept.
+
+	Returns (records, fingerprint). records is None when nothing changed.
+	The fingerprint has to be saved with save_dimension_fingerprint once the export has been delivered.
+	'''
+	records = iter(records)
+	header = list(next(records))
+	keys = [header.index(column) for column in delta['key_columns']]
+
+	state_file = os.path.join(delta.get('state_dir', 'state'), name + '.fingerprint.json')
+	previous = None
+	if os.path.exists(state_file):
+		with open(state_file, 'r') as input:
+			previous = json.load(input)
+
+	now = datetime.datetime.now(tz)
+	full_snapshot = previous is None or previous.get('key_format') != 'json'
+	if previous is not None:
+		last_snapshot = datetime.datetime.strptime(previous['full_snapshot'], '%Y-%m-%d %H:%M:%S%z')
+	if not full_snapshot:
+		full_snapshot = now - last_snapshot >= datetime.timedelta(days=delta.get('full_snapshot_days', 7))
+
+	hashes = {}
+	changes = []
+	count = 0
+	for record in records:
+		count += 1
+		values = [_text_value(value) for value in record]
+		# JSON lists, so separators inside the values cannot shift the columns
+		key = json.dumps([values[index] for index in keys])
+		hashes[key] = hashlib.md5(json.dumps(values).encode('utf-8')).hexdigest()
+		if full_snapshot:
+			changes.append(list(record) + ['snapshot'])
+		elif key not in previous['rows']:
+			changes.append(list(record) + ['insert'])
+		elif previous['rows'][key] != hashes[key]:
+			changes.append(list(record) + ['update'])
+
+	if not full_snapshot:
+		for key in previous['rows']:
+			if key not in hashes:
+				deleted = [''] * len(header)
+				for index, value in zip(keys, json.loads(key)):
+					deleted[index] = value
+				changes.append(deleted + ['delete'])
+
+	fingerprint = {'full_snapshot': (now if full_snapshot else last_snapshot).strftime('%Y-%m-%d %H:%M:%S%z'), 'key_format': 'json', 'rows': hashes}
+	fingerprint['state_file'] = state_file
+
+	logging.info("Dimension %s: %i of %i rows exported (%s)", name, len(changes), count, 'full snapshot' if full_snapshot else 'delta')
+	if not changes:
+		return None, fingerprint
+
+	return [header + ['change_type']] + changes, fingerprint
+
+def save_dimension_fingerprint(fingerprint):
+	state_file = fingerprint.pop('state_file')
+	directory = os.path.dirname(state_file)
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+	# write-then-rename, so an interrupted run never leaves a truncated fingerprint behind
+	with open(state_file + '.tmp', 'w') as output:
+		json.dump(fingerprint, output)
+	os.replace(state_file + '.tmp', state_file)
+
 def get_time(format_str):
 	return datetime.datetime.now(tz).strftime(format_str)
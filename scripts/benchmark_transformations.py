@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import random
+import datetime
+import argparse
+import collections
+import yaml
+
+sys.path.insert(0, '.')
+import lib.vaas_de as vaas_de
+
+# ------- compares the record by record, columnar (pandas) and multi-process transformations on a synthetic Applications extract
+# ------- run from the VaaSPipe directory: python3 scripts/benchmark_transformations.py --rows 1000000
+# ------- measured results, and why the columnar one stays around 2x on one CPU: see 'Columnar transformations' in README.md
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("--rows", dest="rows", type=int, default=1000000)
+parser.add_argument("--transformations", dest="transformations", default="transformations/transformations_apps.yml")
+parser.add_argument("--processes", dest="processes", type=int, default=os.cpu_count() or 1)
+parser.add_argument("--mapping_file", dest="mapping_file", default="service_mappings/applications.cfg")
+
+# worker processes import this script again without running it
+if __name__ == '__main__':
+	args = parser.parse_args()
+
+	header = ('serviceId', 'targetTime', 'failedTransactions', 'totalTransactions', 'responseTime', 'failedPercentage', 'serviceId_String', 'targetTime_String')
+	output_format = ['customer', 'service', 'location', 'date'] + list(header)
+
+	with open(args.transformations, 'r') as input:
+		transformations = yaml.load(input)
+
+	lookups, fieldnames = vaas_de._mapping_file(args.mapping_file)
+	services = [lookup['serviceId_String'] for lookup in lookups] + ['Unmapped service (%i)' %(n) for n in range(20)]
+
+	# one month of hourly buckets
+	start = datetime.datetime(2018, 8, 1)
+	dates = [(start + datetime.timedelta(hours=hour)).strftime('%a %b %d %H:%M:%S EDT %Y') for hour in range(31 * 24)]
+
+	random.seed(0)
+	records = [header]
+	for n in range(args.rows):
+		records.append((str(random.randint(1, 10**9)), str(1533096000000 + n), str(random.randint(0, 50)), str(random.randint(0, 10**6)),
+		                repr(random.random() * 10**6), repr(random.random()), random.choice(services), random.choice(dates)))
+
+	def run(backend, workers=1):
+		vaas_de.transformation_backend = backend
+		vaas_de.transformation_processes.update({'workers': workers, 'min_rows': 1})
+		# rows are consumed as a sink does, without holding on to them
+		started = time.time()
+		collections.deque(vaas_de.transform_records(iter(records), output_format, transformations), maxlen=0)
+		elapsed = time.time() - started
+		return vaas_de.records_to_csv(vaas_de.transform_records(iter(records), output_format, transformations)), elapsed
+
+	python_csv, python_time = run('python')
+	print("rows:    %i" %(args.rows))
+	print("python:  %.2fs" %(python_time))
+
+	for backend in ['python', 'pandas']:
+		vaas_de.transformation_backend = backend
+		if vaas_de._columnar() or backend == 'python':
+			for workers in sorted(set([1, args.processes])):
+				if (backend, workers) == ('python', 1):
+					continue
+				result_csv, result_time = run(backend, workers)
+				print("%s, %i processes: %.2fs, %.1fx, identical output: %s" %(backend, workers, result_time, python_time / result_time, python_csv == result_csv))
+		else:
+			print("pandas is not installed")
@@ -0,0 +1,43 @@
+import subprocess
+import argparse
+
+# ------- refreshes all (or some) dimension lookup tables in a single vaaspipe run:
+# ------- the extracts run in parallel over one PostgreSQL connection pool and read the same snapshot
+
+dimensions = {
+	'applications': 'transformation_dim_applications.yml',
+	'appservices': 'transformation_dim_appservices.yml',
+	'codec': 'transformation_dim_codec.yml',
+	'communities': 'transformation_dim_communities.yml',
+	'device': 'transformation_dim_device.yml',
+	'errordescriptions': 'transformation_dim_errordescriptions.yml',
+	'hosts': 'transformation_dim_hosts.yml',
+	'messages': 'transformation_dim_messages.yml',
+	'networkservices': 'transformation_dim_networkservices.yml',
+	'qosgroups': 'transformation_dim_qosgroup.yml',
+	'sites': 'transformation_dim_sites.yml',
+	'ucservices': 'transformation_dim_ucservices.yml',
+	'vitalstats': 'transformation_dim_vitalstats.yml',
+	'vrfgroups': 'transformation_dim_vrfgroups.yml',
+}
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument("dimensions", nargs='*', help="dimensions to refresh, all of them when none is given: "+"|".join(sorted(dimensions)))
+parser.add_argument("--notifications", dest="notifications", default="global_config/notifications.yml")
+parser.add_argument("--datasource", dest="datasource", default="global_config/ng1_postgres.yml")
+
+args = parser.parse_args()
+
+selected = args.dimensions or sorted(dimensions)
+
+for dimension in selected:
+	if dimension not in dimensions:
+		parser.error(dimension+" is not a known dimension")
+
+sc_files = ['service_configuration/dimensions/dimension_%s.yml' %(dimension) for dimension in selected]
+t_files = ['transformations/%s' %(dimensions[dimension]) for dimension in selected]
+
+command="python3 vaaspipe.py -s %s -t %s -n %s -d %s" %(" ".join(sc_files), " ".join(t_files), args.notifications, args.datasource)
+
+subprocess.call([command],shell=True)
@@ -1,7 +1,25 @@
 import unittest
+from unittest import mock
 import yaml
 import sys
 import logging
+import datetime
+import tempfile
+import shutil
+import csv
+import importlib.util
+import sqlite3
+import io
+import json
+import re
+import os
+import threading
+import tracemalloc
+import time
+import requests
+import pytz
+from dateutil.relativedelta import relativedelta
+import psycopg2.pool
 logging.basicConfig(level=logging.DEBUG, format=	'[%(asctime)s]:[%(levelname)s]:%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', filename='tests_vaaspipe.log')
 
 sys.path.insert(0, '../lib/')
@@ -105,6 +123,835 @@ class VaaSPipeTests(unittest.TestCase):
 		response.close()
 		reference_file.close()
 			
+	def test_dbONE_shard_queries(self):
+		
+		with open("test_query_daily.xml","rb") as input:
+			query=input.read().replace(b'YESTERDAY', b'LAST_3_DAYS')
+		
+		now = vaas_de.tz.localize(datetime.datetime(2018, 7, 4, 5, 30))
+		
+		shards = vaas_de._dbONE_shard_queries(query, {'interval': {'days': 1}}, now=now)
+		
+		self.assertEqual(len(shards), 3)
+		self.assertIn(b'<startTime>2018-07-01_00:00:00</startTime>', shards[0])
+		self.assertIn(b'<endTime>2018-07-02_00:00:00</endTime>', shards[0])
+		self.assertIn(b'<startTime>2018-07-03_00:00:00</startTime>', shards[2])
+		self.assertNotIn(b'<duration>', shards[1])
+		
+		# sub-windows shorter than the ONE_DAY resolution would change the output
+		self.assertEqual(vaas_de._dbONE_shard_queries(query, {'interval': {'hours': 6}}, now=now), [query])
+		# so would sub-windows that split a ONE_DAY bucket
+		self.assertEqual(vaas_de._dbONE_shard_queries(query, {'interval': {'hours': 36}}, now=now), [query])
+		# a query without time buckets is aggregated over the whole window
+		no_resolution = re.sub(rb'<resolution>\w+</resolution>', b'<resolution>NO_RESOLUTION</resolution>', query)
+		self.assertEqual(vaas_de._dbONE_shard_queries(no_resolution, {'interval': {'days': 1}}, now=now), [no_resolution])
+		no_resolution = re.sub(rb'<resolution>\w+</resolution>', b'', query)
+		self.assertEqual(vaas_de._dbONE_shard_queries(no_resolution, {'interval': {'days': 1}}, now=now), [no_resolution])
+		# TopN ranks over the whole window
+		top_n = query.replace(b'<TimeDef>', b'<FunctionList><Function><name>TopN</name><column>totalTransactions</column><nValue>10</nValue></Function></FunctionList>\n<TimeDef>')
+		self.assertEqual(vaas_de._dbONE_shard_queries(top_n, {'interval': {'days': 1}}, now=now), [top_n])
+
+
+	def test_dimension_delta(self):
+		
+		state_dir = tempfile.mkdtemp()
+		delta = {'key_columns': ['siteid'], 'state_dir': state_dir, 'full_snapshot_days': 7}
+		
+		first = [['customer', 'siteid', 'sitename'], ['NTCT IT', '1', 'Pune'], ['NTCT IT', '2', 'Allen']]
+		result, fingerprint = vaas_de.dimension_delta(first, delta, 'lu_sites')
+		self.assertEqual(result, [['customer', 'siteid', 'sitename', 'change_type'], ['NTCT IT', '1', 'Pune', 'snapshot'], ['NTCT IT', '2', 'Allen', 'snapshot']])
+		vaas_de.save_dimension_fingerprint(fingerprint)
+		
+		result, fingerprint = vaas_de.dimension_delta(first, delta, 'lu_sites')
+		self.assertIsNone(result)
+		
+		second = [['customer', 'siteid', 'sitename'], ['NTCT IT', '1', 'Pune (MS)'], ['NTCT IT', '3', 'Plano']]
+		result, fingerprint = vaas_de.dimension_delta(second, delta, 'lu_sites')
+		self.assertEqual(result[1:], [['NTCT IT', '1', 'Pune (MS)', 'update'], ['NTCT IT', '3', 'Plano', 'insert'], ['', '2', '', 'delete']])
+		
+		# key values holding the output separator keep their columns, and the records may be a stream
+		delta = {'key_columns': ['customer', 'siteid'], 'state_dir': state_dir, 'full_snapshot_days': 7}
+		result, fingerprint = vaas_de.dimension_delta(iter([['customer', 'siteid', 'sitename'], ['NTCT\tIT', '1', 'Pune']]), delta, 'lu_site_keys')
+		vaas_de.save_dimension_fingerprint(fingerprint)
+		result, fingerprint = vaas_de.dimension_delta(iter([['customer', 'siteid', 'sitename']]), delta, 'lu_site_keys')
+		self.assertEqual(result[1:], [['NTCT\tIT', '1', '', 'delete']])
+		
+		# a fingerprint of the older, separator-joined, keys gives a full snapshot
+		with open(state_dir + '/lu_site_keys.fingerprint.json', 'w') as output:
+			json.dump({'full_snapshot': fingerprint['full_snapshot'], 'rows': {'NTCT IT\t1': 'x'}}, output)
+		result, fingerprint = vaas_de.dimension_delta(first, delta, 'lu_site_keys')
+		self.assertEqual([row[-1] for row in result[1:]], ['snapshot', 'snapshot'])
+		
+		shutil.rmtree(state_dir)
+
+	def test_transform_records(self):
+		
+		with open("transformations_add_header.yml","r") as input:
+			transformations=yaml.load(input)
+		
+		transformations['Transformations'] = {'Customer': {'type': 'simple', 'default': 'Netscout'}}
+		
+		# values with quotes and separators go through untouched: records are never re-split
+		records = iter([('1', 'Pune "MS"', 'a\tb', '4', '5', '6', '7', '8')])
+		
+		result = list(vaas_de.transform_records(records, ['Customer', 'field2', 'field3'], transformations))
+		
+		self.assertEqual(result, [['Customer', 'field2', 'field3'], ['Netscout', 'Pune "MS"', 'a\tb']])
+
+	
+	@unittest.skipUnless(importlib.util.find_spec('pandas'), "pandas is not installed")
+	def test_transform_records_columnar(self):
+		
+		with open("test_transformation.yml","r") as input:
+			transformations=yaml.load(input)
+		with open("test_service_configuration.yml","r") as input:
+			service=yaml.load(input)
+		with open("api_response.txt","r") as input:
+			records=list(csv.reader(input))
+		
+		backend, chunk_size, min_rows = vaas_de.transformation_backend, vaas_de.columnar_chunk_size, vaas_de.columnar_min_rows
+		try:
+			vaas_de.transformation_backend = 'python'
+			reference = [list(row) for row in vaas_de.transform_records(records, service['Service']['output_format'], transformations)]
+			
+			# several chunks, the last one too small for the columnar backend
+			vaas_de.transformation_backend, vaas_de.columnar_chunk_size, vaas_de.columnar_min_rows = 'pandas', 8, 8
+			result = [list(row) for row in vaas_de.transform_records(records, service['Service']['output_format'], transformations)]
+		finally:
+			vaas_de.transformation_backend, vaas_de.columnar_chunk_size, vaas_de.columnar_min_rows = backend, chunk_size, min_rows
+		
+		self.assertEqual(result, reference)
+
+	
+	def test_transform_records_processes(self):
+		
+		with open("test_transformation.yml","r") as input:
+			transformations=yaml.load(input)
+		with open("test_service_configuration.yml","r") as input:
+			service=yaml.load(input)
+		with open("api_response.txt","r") as input:
+			records=list(csv.reader(input))
+		
+		processes = dict(vaas_de.transformation_processes)
+		try:
+			vaas_de.transformation_processes['enabled'] = False
+			reference = [list(row) for row in vaas_de.transform_records(records, service['Service']['output_format'], transformations)]
+			
+			# 5 records here, then chunks of 4 records on 2 workers, still written in input order
+			vaas_de.transformation_processes.update({'enabled': True, 'workers': 2, 'min_rows': 5, 'chunk_size': 4})
+			# the workers import the library as vaaspipe runs it, from the repository root
+			sys.path.insert(0, os.path.abspath('../lib'))
+			os.chdir('..')
+			try:
+				result = [list(row) for row in vaas_de.transform_records(records, service['Service']['output_format'], transformations)]
+			finally:
+				os.chdir('tests')
+				sys.path.pop(0)
+		finally:
+			vaas_de.transformation_processes.update(processes)
+		
+		self.assertEqual(result, reference)
+
+	
+	def test_merge_sources(self):
+		
+		def failing():
+			raise Exception("unreachable")
+		
+		extracts = [('acme', lambda: iter([('a', 'b'), ('1', '2')])),
+		            ('initech', failing),
+		            ('globex', lambda: iter([('b', 'c', 'a'), ('3', 'x', '4')]))]
+		
+		result = list(vaas_de.merge_sources(extracts, 'customer'))
+		
+		self.assertEqual(result, [('a', 'b', 'customer'), ('1', '2', 'acme'), ('4', '3', 'globex')])
+		
+		with self.assertRaises(Exception):
+			list(vaas_de.merge_sources([('initech', failing)]))
+
+	
+	def test_records_to_database(self):
+		
+		directory = tempfile.mkdtemp()
+		database = {'type': 'sqlite', 'path': directory + '/vaaspipe.db'}
+		
+		vaas_de.records_to_database(iter([('site', 'date', 'count'), ('Pune', '01-07-2018', '1'), ('Allen', '01-07-2018', '')]), database, 'sites', ['site', 'date'])
+		# upsert on the key columns
+		vaas_de.records_to_database(iter([('site', 'date', 'count'), ('Pune', '01-07-2018', '2')]), database, 'sites', ['site', 'date'])
+		
+		connection = sqlite3.connect(database['path'])
+		rows = connection.execute('SELECT site, date, count FROM sites ORDER BY site').fetchall()
+		connection.close()
+		shutil.rmtree(directory)
+		
+		self.assertEqual(rows, [('Allen', '01-07-2018', None), ('Pune', '01-07-2018', '2')])
+
+	
+	def test_trend_store_rollup(self):
+		
+		directory = tempfile.mkdtemp()
+		settings = dict(vaas_de.trend_store_settings)
+		vaas_de.trend_store_settings['directory'] = directory
+		
+		yesterday = (datetime.datetime.now(vaas_de.tz) - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+		header = ['date', 'serviceTestName', 'npoint', 'availabilityPercentage', 'maxRespTime', 'count', 'startTimeMs', 'endTimeMs']
+		rows = [(yesterday+' 10:00:00', 'Outlook', 'Pune', '100', '10', '1', '0', '0'),
+		        (yesterday+' 10:05:00', 'Outlook', 'Pune', '90', '30', '1', '0', '0'),
+		        (yesterday+' 11:00:00', 'Outlook', 'Pune', '', '20', '1', '0', '0')]
+		query = {'kpi_filter_params': {'start': {'relativedelta': {'days': -1}, 'replace': {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}},
+		                               'end': {'relativedelta': {'days': 0}, 'replace': {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}}}}
+		aggregations = {'availabilityPercentage': 'avg', 'maxRespTime': 'max', 'count': 'samples'}
+		try:
+			store = {'name': 'outlook', 'key_columns': ['serviceTestName', 'npoint']}
+			# the 10:05 row is fetched again by the next run and replaced
+			list(vaas_de.trend_store_append(iter(rows), store, header))
+			list(vaas_de.trend_store_append(iter(rows[1:2]), store, header))
+			
+			result = list(vaas_de.trend_store_rollup({'name': 'outlook', 'rollup': 'hourly', 'aggregations': aggregations}, query))
+		finally:
+			vaas_de.trend_store_settings.update(settings)
+			shutil.rmtree(directory)
+		
+		day = yesterday[8:10]+'-'+yesterday[5:7]+'-'+yesterday[0:4]
+		self.assertEqual(result, [(day+' 10:00:00', 'Outlook', 'Pune', '95.0', '30', '2', '', ''),
+		                          (day+' 11:00:00', 'Outlook', 'Pune', '', '20', '1', '', '')])
+
+	
+	def test_governor(self):
+		
+		governor = vaas_de._Governor('nG1', {'rate': 0, 'burst': 1, 'max_in_flight': 4, 'adaptive': True, 'target_latency': 10})
+		
+		# a 503 halves the calls in flight, a window of fast calls adds one back
+		governor.acquire()
+		governor.release(0.5, congested=True)
+		self.assertEqual(governor.limit, 2)
+		for i in range(2):
+			governor.acquire()
+			governor.release(0.5)
+		self.assertEqual(governor.limit, 3)
+		
+		# callers wait for a free slot, at most until the pipeline deadline
+		for i in range(3):
+			governor.acquire()
+		vaas_de.set_deadline(0.1)
+		try:
+			self.assertRaises(vaas_de.DeadlineExceeded, governor.acquire)
+		finally:
+			vaas_de.set_deadline(None)
+
+	def test_profile(self):
+		
+		directory = tempfile.mkdtemp()
+		processes = vaas_de.transformation_processes['enabled']
+		try:
+			vaas_de.start_profile()
+			def records():
+				with vaas_de.profile_stage('fetch'):
+					rows = [[str(i)] * 10 for i in range(1000)]
+				yield from rows
+			with vaas_de.profile_stage('sink'):
+				rows = list(vaas_de.profile_iter('parse', records()))
+				# sinks fed at the same time run on threads of their own
+				vaas_de.tee_sinks(rows, [('first', list), ('second', list)])
+			vaas_de.write_profile(directory)
+			
+			# every record is passed through
+			self.assertEqual(len(rows), 1000)
+			with open(directory + '/report.txt') as report:
+				summary = report.read().split('\n\n')[0]
+			self.assertEqual([line.split()[0] for line in summary.split('\n')[1:]], ['other', 'sink', 'parse', 'fetch', 'sink*'])
+			self.assertTrue(os.path.exists(directory + '/sink_threads.prof'))
+			self.assertIsNone(vaas_de._profile)
+		finally:
+			vaas_de.transformation_processes['enabled'] = processes
+			shutil.rmtree(directory)
+	
+
+	def test_json_items(self):
+		
+		body = b'{"data": [{"agent": {"name": "Pune \\u00e9"}, "availPercent": 99.25, "count": 12}, {"agent": {"name": "Allen"}, "availPercent": null, "count": 1.5e1}], "total": 2}'
+		class Response(object):
+			content = body
+			def __init__(self):
+				self.raw = io.BytesIO(body)
+			def close(self):
+				pass
+		
+		settings = dict(vaas_de.json_settings)
+		try:
+			for library, incremental, stream in [('json', False, False), ('auto', False, False), ('auto', True, False), ('auto', True, True)]:
+				vaas_de.json_settings.update(library=library, incremental=incremental)
+				items = list(vaas_de._json_items(Response(), 'data', stream))
+				self.assertEqual(items, json.loads(body.decode())['data'])
+				self.assertEqual([str(item['count']) for item in items], ['12', '15.0'])
+		finally:
+			vaas_de.json_settings.update(settings)
+	
+
+	def test_dbONE_projection(self):
+		
+		with open('../nG1_queries/applications/service_applications_daily.xml', 'rb') as query_file:
+			query = query_file.read()
+		transformations = {'Transformations': {'customer': {'type': 'simple', 'default': 'NTCT IT'},
+		                                       'date': {'type': 'date', 'lookup_column': 'targetTime_String', 'date_format': '%d-%m-%Y %H:%M:%S'}}}
+		columns = vaas_de.transformation_columns(['customer', 'date', 'serviceId', 'failedPercentage'], transformations)
+		
+		projected, conversion = vaas_de.dbONE_projection(query, columns)
+		self.assertEqual(re.findall(rb'<ClientColumn>(\w+)</ClientColumn>', projected),
+		                 [b'totalTransactions', b'failedTransactions', b'serviceId', b'failedPercentage', b'targetTime', b'failedPercentage'])
+		self.assertEqual(conversion, 'true')
+		
+		# without _String columns nG1 does not need to convert ids
+		self.assertEqual(vaas_de.dbONE_projection(query, ['serviceId', 'totalTransactions'])[1], 'false')
+		self.assertIsNone(vaas_de.transformation_columns(['customer'], dict(transformations, Header={'add_header': ['serviceId']})))
+	
+
+	def test_dbONE_enrich(self):
+		
+		# the api response as sent with conversion=false, plus the names of the services
+		with open('api_response.txt') as api_response:
+			converted = [tuple(row) for row in csv.reader(api_response) if row]
+		names = {'serviceId': dict((row[0], row[6]) for row in converted[1:])}
+		
+		enriched = list(vaas_de._dbONE_enrich(iter([row[:6] for row in converted]), names))
+		self.assertEqual(enriched, converted)
+	
+
+	def test_dbONE_template(self):
+		
+		with open('../nG1_queries/links/service_linksDrillDown_daily.xml', 'rb') as query_file:
+			template = query_file.read()
+		with open('../nG1_queries/links/service_linksDrillDown_Pune_daily.xml', 'rb') as query_file:
+			pune = query_file.read()
+		
+		query = vaas_de.dbONE_template(template, {'site': 'Pune', 'networkServiceId': 160637025})
+		self.assertEqual(re.findall(rb'<networkServiceId>(\d+)</networkServiceId>', query), re.findall(rb'<networkServiceId>(\d+)</networkServiceId>', pune))
+		self.assertRaises(Exception, vaas_de.dbONE_template, template, {'site': 'Pune'})
+	
+
+	def test_csv_partitions_to_disk(self):
+		
+		directory = tempfile.mkdtemp()
+		max_open_files = vaas_de.partition_settings['max_open_files']
+		try:
+			# rows of 5 locations interleaved, written with at most 2 files open
+			vaas_de.partition_settings['max_open_files'] = 2
+			records = [['customer', 'location', 'value']] + [['NTCT IT', location, str(i)] for i in range(4) for location in ['Allen', 'Pune', 'San Jose', 'Plano', '']]
+			partitions = vaas_de.csv_partitions_to_disk(records, ['location'], 'links_20181030.csv', directory)
+			
+			self.assertEqual([os.path.basename(path) for values, path in partitions],
+			                 ['links_20181030_Allen.csv', 'links_20181030_Pune.csv', 'links_20181030_San_Jose.csv', 'links_20181030_Plano.csv', 'links_20181030_none.csv'])
+			with open(partitions[2][1], newline='') as partition:
+				rows = list(csv.reader(partition, delimiter=vaas_de.output_separator))
+			self.assertEqual(rows, [records[0]] + [row for row in records[1:] if row[1] == 'San Jose'])
+		finally:
+			vaas_de.partition_settings['max_open_files'] = max_open_files
+			shutil.rmtree(directory)
+	
+
+	def test_explain(self):
+		
+		directory = tempfile.mkdtemp()
+		catalog_directory = vaas_de.explain_settings['catalog_directory']
+		try:
+			vaas_de.explain_settings['catalog_directory'] = directory
+			datasource = {'host': 'ngp', 'port': '443', 'emailOrUsername': 'vaas'}
+			query = {'nGP_Service_Test_List': ['Jabber Allen', 'Jabber Pune'],
+			         'kpi_filter_params': {'trends': 'availability,avgLqmosRx,avgLqmosTx,count', 'type': 'test,agent', 'rowLimit': 10,
+			                               'start': {'relativedelta': {'hours': -1}, 'replace': {'minute': 0, 'second': 0, 'microsecond': 0}},
+			                               'end': {'relativedelta': {'hours': 0}, 'replace': {'minute': 0, 'second': 0, 'microsecond': 0}}}}
+			
+			# without a cached catalog every listed test is assumed to run
+			plan = vaas_de.explain_nGPulse(datasource, query, 'VoIP Test')
+			self.assertEqual(plan['tests'], ['Jabber Allen', 'Jabber Pune'])
+			
+			vaas_de._catalog_save('ngp:443', 'VoipPulse', {'Jabber Allen': 'a', 'Jabber Plano': 'c'})
+			plan = vaas_de.explain_nGPulse(datasource, query, 'VoIP Test')
+			self.assertEqual(plan['tests'], ['Jabber Allen'])
+			# 10 agents with 12 points of 5 minutes each
+			self.assertEqual([(method, url, rows) for method, url, key, rows in plan['calls']],
+			                 [('POST', 'ngp:443/ipm/auth/login', 0), ('GET', 'ngp:443/ipm/v1/admin/testTypes', 0),
+			                  ('GET', 'ngp:443/ipm/v1/admin/tests', 0), ('GET', 'ngp:443/query/table', 120)])
+			
+			# a second pipeline on the same nGPulse shares its login and catalog calls
+			report = vaas_de.explain_report([('voip', 'VoIP Test', [(None, plan)]), ('voip again', 'VoIP Test', [(None, plan)])])
+			self.assertIn('Total: 8 calls (as few as 4 after coalescing identical ones), <= 240 rows, up to 2 calls at once', report)
+		finally:
+			vaas_de.explain_settings['catalog_directory'] = catalog_directory
+			shutil.rmtree(directory)
+	
+
+	def test_typed_columns(self):
+		
+		records = [['serviceId', 'targetTime', 'totalTransactions', 'responseTime', 'failedPercentage'],
+		           ['122029775', '1530417600000', '65939', '163408.43723725548', '0.0'],
+		           ['122030298', '1530417600000', '', '288608.1789814946', 'n/a']]
+		transformations = {'Transformations': {'customer': {'type': 'simple', 'default': 'NTCT IT'}},
+		                   'Types': {'targetTime': {'type': 'datetime'}, 'totalTransactions': {'type': 'int'},
+		                             'responseTime': {'type': 'float', 'decimals': 3}, 'failedPercentage': {'type': 'float', 'decimals': 2}}}
+		output_headers = ['customer', 'serviceId', 'targetTime', 'totalTransactions', 'responseTime', 'failedPercentage']
+		
+		rows = list(vaas_de.transform_records(records, output_headers, transformations))
+		self.assertEqual(rows[1], ['NTCT IT', '122029775', datetime.datetime(2018, 7, 1, 4, 0, tzinfo=datetime.timezone.utc), 65939, 163408.437, 0.0])
+		# empty values and values that are not numbers are left empty
+		self.assertEqual(rows[2][3:], [None, 288608.179, None])
+		
+		# the columnar backend gives the same rows
+		plan = vaas_de._transformation_plan(records[0], output_headers, transformations['Transformations'], transformations['Types'])
+		if vaas_de._columnar():
+			self.assertEqual([list(row) for row in vaas_de._transform_columns(plan, records[1:])], rows[1:])
+		
+		# ints are read exactly; decimals are not ints
+		self.assertEqual([vaas_de._typed_value(('int',), value) for value in ['9007199254740993', '12.0', '12.7', '1.2e3', 12]],
+		                 [9007199254740993, 12, None, 1200, 12])
+		# text sinks write datetimes, in the time zone of the library, with the declared format
+		target_time = rows[1][2].astimezone(vaas_de.tz)
+		transformations['Types']['targetTime']['format'] = '%Y%m%d %H:%M'
+		text = list(vaas_de.text_records(rows, transformations['Types']))
+		self.assertEqual(text[1][2], '%04i%02i%02i %02i:00' % (target_time.year, target_time.month, target_time.day, target_time.hour))
+		self.assertEqual(list(vaas_de.text_records(rows, {'targetTime': {'type': 'datetime'}}))[1][2], '%02i-%02i-%04i %02i:00:00' % (target_time.day, target_time.month, target_time.year, target_time.hour))
+	
+
+	def test_tee_sinks(self):
+		
+		records = [['customer', 'value']] + [['NTCT IT', str(i)] for i in range(2500)]
+		received = {}
+		def sink(name, fail_after=None):
+			def function(rows):
+				received[name] = []
+				for row in rows:
+					if len(received[name]) == fail_after:
+						raise IOError(name + ' is full')
+					received[name].append(row)
+				return name
+			return function
+		
+		self.assertEqual(vaas_de.tee_sinks(iter(records), [('local_csv', sink('local_csv')), ('email', sink('email'))]),
+		                 {'local_csv': 'local_csv', 'email': 'email'})
+		self.assertEqual(received['local_csv'], records)
+		self.assertEqual(received['email'], records)
+		
+		# a failed sink does not stop the others, but fails the pipeline once they are done
+		with self.assertRaisesRegex(Exception, 'email is full'):
+			vaas_de.tee_sinks(iter(records), [('local_csv', sink('local_csv')), ('email', sink('email', fail_after=10))])
+		self.assertEqual(received['local_csv'], records)
+		self.assertEqual(len(received['email']), 10)
+	
+
+	def test_names(self):
+		
+		names = vaas_de._Names()
+		# every row of an extract gets the same string for a name, with the separator replaced
+		self.assertEqual(names['Jabber' + vaas_de.output_separator + 'Pune'], 'Jabber Pune')
+		self.assertIs(names['Jabber' + vaas_de.output_separator + 'Pune'], names['Jabber' + vaas_de.output_separator + 'Pune'])
+		self.assertEqual(names[datetime.datetime(2018, 10, 30, 11, 5)], '2018-10-30 11:05:00')
+		
+		times = vaas_de._TrendTimes()
+		self.assertEqual(times['2018-Oct-30_11:05'], datetime.datetime(2018, 10, 30, 11, 5))
+		self.assertIs(times['2018-Oct-30_11:05'], times['2018-Oct-30_11:05'])
+	
+
+	def test_coalesced(self):
+		'''
+		Identical concurrent calls reach the upstream once, and neither responses nor failures are kept once the call completes
+		'''
+		calls = []
+		release = threading.Event()
+		def call():
+			calls.append(1)
+			release.wait(10)
+			return 'response'
+		key = ('GET', 'https://ngpulse/api/tests', ())
+		results = []
+		first = threading.Thread(target = lambda: results.append(vaas_de._coalesced(key, call)))
+		first.start()
+		while not calls:
+			time.sleep(0.01)
+		waiters = [threading.Thread(target = lambda: results.append(vaas_de._coalesced(key, call))) for i in range(3)]
+		for waiter in waiters:
+			waiter.start()
+		time.sleep(0.2) # let the waiters reach the in-flight call
+		release.set()
+		for thread in [first] + waiters:
+			thread.join()
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(results, ['response'] * 4)
+		self.assertNotIn(key, vaas_de._coalesced_calls)
+		# once completed, the next identical call reaches the upstream again
+		self.assertEqual(vaas_de._coalesced(key, call), 'response')
+		self.assertEqual(len(calls), 2)
+		# a failed call is not cached
+		def failing():
+			calls.append(1)
+			raise ConnectionError('upstream down')
+		self.assertRaises(ConnectionError, vaas_de._coalesced, key, failing)
+		self.assertNotIn(key, vaas_de._coalesced_calls)
+		self.assertEqual(vaas_de._coalesced(key, call), 'response')
+		self.assertEqual(len(calls), 4)
+
+	def test_pipeline_log(self):
+		'''
+		Records reach the handler of the pipeline that logged them, including from its worker threads
+		'''
+		logger = logging.getLogger('test_pipeline_log')
+		logger.propagate = False
+		streams = {}
+		for log_file in ['a.log', 'b.log']:
+			streams[log_file] = io.StringIO()
+			handler = logging.StreamHandler(streams[log_file])
+			handler.addFilter(vaas_de.PipelineLogFilter(log_file, default=log_file == 'a.log'))
+			logger.addHandler(handler)
+		def pipeline(log_file):
+			vaas_de.set_pipeline_log(log_file)
+			logger.warning('from ' + log_file)
+			worker = threading.Thread(target=vaas_de._pipeline_task(lambda: logger.warning('worker of ' + log_file)))
+			worker.start()
+			worker.join()
+		threads = [threading.Thread(target=pipeline, args=(log_file,)) for log_file in ['a.log', 'b.log']]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		logger.warning('outside')
+		self.assertEqual(sorted(streams['a.log'].getvalue().splitlines()), ['from a.log', 'outside', 'worker of a.log'])
+		self.assertEqual(sorted(streams['b.log'].getvalue().splitlines()), ['from b.log', 'worker of b.log'])
+
+	def test_typed_delta_partitions(self):
+		'''
+		Typed columns (see test_typed_columns) through the delta export and the partitioned email sink
+		'''
+		records = [['siteid', 'location', 'updated', 'sessions'], ['1', 'Pune', '1530417600000', '12'], ['2', 'Allen', '1530417600000', '']]
+		transformations = {'Transformations': {}, 'Types': {'siteid': {'type': 'int'}, 'updated': {'type': 'datetime'}, 'sessions': {'type': 'int'}}}
+		typed = list(vaas_de.transform_records(records, records[0], transformations))
+		
+		state_dir = tempfile.mkdtemp()
+		try:
+			delta = {'key_columns': ['siteid'], 'state_dir': state_dir}
+			result, fingerprint = vaas_de.dimension_delta(typed, delta, 'lu_sites')
+			self.assertEqual(result[1], typed[1] + ['snapshot'])
+			self.assertEqual(sorted(fingerprint['rows']), ['["1"]', '["2"]'])
+			vaas_de.save_dimension_fingerprint(fingerprint)
+			typed[2][3] = 7
+			result, fingerprint = vaas_de.dimension_delta(typed, delta, 'lu_sites')
+			self.assertEqual(result[1:], [typed[2] + ['update']])
+		finally:
+			shutil.rmtree(state_dir)
+		
+		sent = []
+		send_notification = vaas_de.send_notification
+		vaas_de.send_notification = lambda server, port, from_email, to_email, subject, msg_body, content, filename: sent.append((subject, filename))
+		try:
+			vaas_de.send_partitions('smtp', 25, 'from', ['to'], 'Sites', 'body', typed, ['siteid', 'sessions'], 'sites.csv')
+		finally:
+			vaas_de.send_notification = send_notification
+		self.assertEqual(sent, [('Sites;1;12', 'sites_1_12.csv'), ('Sites;2;7', 'sites_2_7.csv')])
+
+	def test_http_request(self):
+		'''
+		Retries with backoff, circuit breaker and pipeline deadline of upstream calls, against a mocked requests.Session
+		'''
+		def response(status, headers=None):
+			result = requests.models.Response()
+			result.status_code = status
+			result.headers.update(headers or {})
+			result._content = b'{}'
+			return result
+		http = {'retries': 2, 'backoff': 0, 'max_backoff': 0, 'breaker_failures': 3, 'breaker_reset': 0.2}
+		
+		# a connection error and a 503 are retried, honouring Retry-After; the third attempt succeeds
+		with mock.patch.object(requests.Session, 'request', side_effect=[requests.exceptions.ConnectionError('reset'),
+		                       response(503, {'Retry-After': '0.05'}), response(200)]) as request, mock.patch('time.sleep') as sleep:
+			self.assertEqual(vaas_de._http_request('GET', 'https://retry.example/tests', http, True).status_code, 200)
+		self.assertEqual(request.call_count, 3)
+		self.assertGreaterEqual(sleep.call_args_list[1][0][0], 0.05)
+		# calls that are not idempotent are sent once
+		with mock.patch.object(requests.Session, 'request', side_effect=[response(503), response(200)]) as request:
+			self.assertRaises(requests.exceptions.HTTPError, vaas_de._http_request, 'POST', 'https://retry.example/tests', http)
+		self.assertEqual(request.call_count, 1)
+		
+		# 2 failed calls open the breaker: calls fail fast until a trial call after 'breaker_reset' seconds succeeds
+		http = dict(http, retries=0, breaker_failures=2)
+		with mock.patch.object(requests.Session, 'request', side_effect=requests.exceptions.ConnectionError('refused')) as request:
+			for i in range(2):
+				self.assertRaises(requests.exceptions.ConnectionError, vaas_de._http_request, 'GET', 'https://breaker.example/tests', http, True)
+			self.assertRaises(vaas_de.CircuitOpen, vaas_de._http_request, 'GET', 'https://breaker.example/tests', http, True)
+		self.assertEqual(request.call_count, 2)
+		time.sleep(0.25)
+		with mock.patch.object(requests.Session, 'request', side_effect=[response(200), response(200)]) as request:
+			vaas_de._http_request('GET', 'https://breaker.example/tests', http, True)
+			vaas_de._http_request('GET', 'https://breaker.example/tests', http, True)
+		self.assertEqual(request.call_count, 2)
+		
+		# timeouts never go beyond the deadline, and no backoff outlasts it
+		vaas_de.set_deadline(1)
+		try:
+			with mock.patch.object(requests.Session, 'request', side_effect=[response(503, {'Retry-After': '5'})]) as request:
+				self.assertRaises(vaas_de.DeadlineExceeded, vaas_de._http_request, 'GET', 'https://deadline.example/tests', {'retries': 2}, True)
+			self.assertLessEqual(max(request.call_args[1]['timeout']), 1)
+		finally:
+			vaas_de.set_deadline(None)
+
+	def test_http_stream(self):
+		'''
+		A streamed call holds its governor slot until the body is read, and a body that breaks off is read again without repeating items
+		'''
+		class Response(object):
+			status_code = 200
+			headers = {}
+			def __init__(self, broken):
+				self.broken = broken
+				self.closed = False
+			def items(self):
+				for item in range(4):
+					if item == self.broken:
+						raise requests.exceptions.ChunkedEncodingError('connection broken')
+					yield item
+			def close(self):
+				self.closed = True
+		responses = [Response(2), Response(None)]
+		http = {'backoff': 0, 'max_backoff': 0, 'governor': {'max_in_flight': 1}}
+		governor = vaas_de._governor('stream.example', http['governor'])
+		
+		with mock.patch.object(requests.Session, 'request', side_effect=responses) as request:
+			items = vaas_de._http_get('https://stream.example/query/table', http=http, read=lambda response: response.items())
+			self.assertEqual(next(items), 0)
+			self.assertEqual(governor.in_flight, 1)
+			self.assertEqual(list(items), [1, 2, 3])
+		self.assertEqual(request.call_count, 2)
+		self.assertTrue(request.call_args[1]['stream'])
+		self.assertEqual(governor.in_flight, 0)
+		self.assertTrue(all(response.closed for response in responses))
+		
+		# the deadline also bounds the reading of the body
+		with mock.patch.object(requests.Session, 'request', side_effect=[Response(None)]):
+			vaas_de.set_deadline(0.1)
+			try:
+				items = vaas_de._http_get('https://stream.example/query/table', http=http, read=lambda response: response.items())
+				next(items)
+				time.sleep(0.15)
+				self.assertRaises(vaas_de.DeadlineExceeded, next, items)
+			finally:
+				vaas_de.set_deadline(None)
+		self.assertEqual(governor.in_flight, 0)
+
+	def test_query_psql_parallel(self):
+		'''
+		Parallel dimension extracts against a mocked connection pool: one exported snapshot imported by every extract, rows keyed by sql
+		'''
+		directory = tempfile.mkdtemp()
+		tables = {'select * from lu_sites': [(1, 'Pune'), (2, 'Allen')], 'select * from lu_codec': [(0, 'G.711')]}
+		sqls = []
+		for name, query in zip(['lu_sites.sql', 'lu_codec.sql'], tables):
+			sqls.append(os.path.join(directory, name))
+			with open(sqls[-1], 'w') as output:
+				output.write(query)
+		
+		executed = []
+		class Cursor(object):
+			def execute(self, query, params=None):
+				executed.append((query, params))
+				self.rows = tables.get(query, [])
+			def fetchone(self):
+				return ('00000003-00000002-1',)
+			def __iter__(self):
+				return iter(self.rows)
+		class Pool(object):
+			def __init__(self, *args, **kwargs):
+				self.connections = 0
+				self.lock = threading.Lock()
+			def getconn(self):
+				with self.lock:
+					if self.connections == failing_connection:
+						raise psycopg2.pool.PoolError('connection pool exhausted')
+					self.connections += 1
+				return mock.Mock(cursor=Cursor)
+			def putconn(self, connection):
+				pass
+			def closeall(self):
+				pass
+		
+		try:
+			failing_connection = None
+			with mock.patch('psycopg2.pool.ThreadedConnectionPool', Pool):
+				result = vaas_de.query_psql_parallel('localhost', 'vaas', 'secret', 'ng1', sqls, max_workers=2)
+			self.assertEqual(result, {sqls[0]: [('1', 'Pune'), ('2', 'Allen')], sqls[1]: [('0', 'G.711')]})
+			self.assertEqual(executed[0], ("SELECT pg_export_snapshot()", None))
+			self.assertEqual([params for query, params in executed if query == "SET TRANSACTION SNAPSHOT %s"], [('00000003-00000002-1',)] * 2)
+			
+			# a connection that cannot be had does not keep the slot of the database governor
+			failing_connection = 1
+			with mock.patch('psycopg2.pool.ThreadedConnectionPool', Pool):
+				self.assertRaises(psycopg2.pool.PoolError, vaas_de.query_psql_parallel, 'localhost', 'vaas', 'secret', 'ng1', sqls[:1])
+			self.assertEqual(vaas_de._governor('postgres://localhost/ng1').in_flight, 0)
+		finally:
+			shutil.rmtree(directory)
+
+	def test_trend_period(self):
+		'''
+		Rollup periods on the days DST starts and ends
+		'''
+		local = vaas_de.tz
+		vaas_de.tz = pytz.timezone('America/New_York')
+		try:
+			def period(rollup, year, month, day, hour, minute, is_dst=None):
+				start, end = vaas_de._trend_period(rollup, vaas_de.tz.localize(datetime.datetime(year, month, day, hour, minute), is_dst=is_dst))
+				return start.isoformat(), end.isoformat()
+			# DST ends on 4 November 2018: the day lasts 25 hours and 1:00 to 2:00 happens twice
+			self.assertEqual(period('daily', 2018, 11, 4, 12, 0), ('2018-11-04T00:00:00-04:00', '2018-11-05T00:00:00-05:00'))
+			self.assertEqual(period('hourly', 2018, 11, 4, 1, 30, is_dst=True), ('2018-11-04T01:00:00-04:00', '2018-11-04T01:00:00-05:00'))
+			self.assertEqual(period('hourly', 2018, 11, 4, 1, 30, is_dst=False), ('2018-11-04T01:00:00-05:00', '2018-11-04T02:00:00-05:00'))
+			self.assertEqual(period('monthly', 2018, 11, 15, 8, 0), ('2018-11-01T00:00:00-04:00', '2018-12-01T00:00:00-05:00'))
+			# DST starts on 11 March 2018: the day lasts 23 hours
+			self.assertEqual(period('daily', 2018, 3, 11, 12, 0), ('2018-03-11T00:00:00-05:00', '2018-03-12T00:00:00-04:00'))
+		finally:
+			vaas_de.tz = local
+
+	def test_merge_sources_streaming(self):
+		
+		settings = dict(vaas_de.source_settings)
+		vaas_de.source_settings.update({'chunk_size': 2, 'queue_chunks': 1})
+		produced = []
+		finished = threading.Event()
+		
+		def source(name, rows):
+			yield ('a',)
+			for i in range(rows):
+				produced.append((name, i))
+				yield (str(i),)
+		
+		def waiting():
+			# ends only once the first source has been merged
+			finished.wait(5)
+			return iter([('a',), ('x',)])
+		
+		try:
+			merged = vaas_de.merge_sources([('big', lambda: source('big', 1000)), ('late', waiting)])
+			# the first rows are merged while the second source is still running
+			self.assertEqual(next(merged), ('a', 'source'))
+			self.assertEqual(next(merged), ('0', 'big'))
+			# and the first source runs ahead only by the bounded queue
+			self.assertLess(len(produced), 20)
+			finished.set()
+			rows = list(merged)
+			self.assertEqual(len(rows), 1000)
+			self.assertEqual(rows[-2:], [('999', 'big'), ('x', 'late')])
+			
+			# closing the merge early stops the sources still running
+			merged = vaas_de.merge_sources([('big', lambda: source('big', 100000))])
+			next(merged)
+			merged.close()
+			self.assertLess(len(produced), 1000 + 20)
+		finally:
+			finished.set()
+			vaas_de.source_settings.clear()
+			vaas_de.source_settings.update(settings)
+
+	def test_profile_peaks(self):
+		
+		class Tracemalloc(object):
+			# tracemalloc before Python 3.9, whose peak cannot be reset
+			def __getattr__(self, name):
+				if name == 'reset_peak':
+					raise AttributeError(name)
+				return getattr(tracemalloc, name)
+		
+		directory = tempfile.mkdtemp()
+		processes = vaas_de.transformation_processes['enabled']
+		try:
+			with mock.patch.object(vaas_de, 'tracemalloc', Tracemalloc()):
+				vaas_de.start_profile()
+				with vaas_de.profile_stage('fetch'):
+					big = bytearray(20 * 1048576)
+					del big
+				with vaas_de.profile_stage('sink'):
+					small = bytearray(1048576)
+				vaas_de.write_profile(directory)
+			
+			with open(directory + '/report.txt') as report:
+				summary = report.read().split('\n\n')[0]
+			peaks = dict((line.split()[0], float(line.split()[2])) for line in summary.split('\n')[1:])
+			# the stage after the highest one is not charged with the peak of the run
+			self.assertGreaterEqual(peaks['fetch'], 20)
+			self.assertLess(peaks['sink'], 5)
+			self.assertEqual(len(small), 1048576)
+		finally:
+			vaas_de.transformation_processes['enabled'] = processes
+			shutil.rmtree(directory)
+
+	def test_trend_store_rollup_days(self):
+		
+		directory = tempfile.mkdtemp()
+		settings = dict(vaas_de.trend_store_settings)
+		vaas_de.trend_store_settings['directory'] = directory
+		
+		days = [(datetime.datetime.now(vaas_de.tz) - datetime.timedelta(days=days)).strftime('%Y-%m-%d') for days in [2, 1]]
+		header = ['date', 'npoint', 'maxRespTime', 'count']
+		rows = [(days[0]+' 10:00:00', 'Pune', '10', '1'), (days[0]+' 23:55:00', 'Pune', '40', '1'), (days[1]+' 00:00:00', 'Pune', '20', '1')]
+		query = {'kpi_filter_params': {'start': {'relativedelta': {'days': -2}, 'replace': {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}},
+		                               'end': {'relativedelta': {'days': 0}, 'replace': {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}}}}
+		store = {'name': 'voip', 'key_columns': ['npoint'], 'rollup': 'daily', 'aggregations': {'maxRespTime': 'sum', 'count': 'samples'}}
+		read = []
+		partition_read = vaas_de._trend_partition_read
+		def reading(path):
+			read.append(os.path.basename(path))
+			return partition_read(path)
+		try:
+			list(vaas_de.trend_store_append(iter(rows), store, header))
+			with mock.patch.object(vaas_de, '_trend_partition_read', reading):
+				result = vaas_de.trend_store_rollup(store, query)
+				first = next(result)
+				# a day is yielded before the next partition is read
+				self.assertEqual(read, [days[0] + '.json.gz'])
+				result = [first] + list(result)
+		finally:
+			vaas_de.trend_store_settings.update(settings)
+			shutil.rmtree(directory)
+		
+		self.assertEqual([record[1:] for record in result], [('Pune', '50', '2'), ('Pune', '20', '1')])
+
+	def test_dbONE_rollup(self):
+		
+		with open("../nG1_queries/service_enablers/service_enablers_monthly.xml","rb") as input:
+			query=input.read()
+		aggregations = {'totalTransactions': 'sum', 'failedTransactions': 'sum', 'responseTime': {'avg': 'totalTransactions'}}
+		shards = {'interval': {'days': 1}, 'resolution': 'ONE_DAY', 'max_workers': 2, 'aggregations': aggregations}
+		now = vaas_de.tz.localize(datetime.datetime(2018, 7, 4, 5, 30))
+		
+		# the ONE_MONTH bucket of LAST_MONTH is queried a day at a time
+		queries = vaas_de._dbONE_shard_queries(query, shards, now=now)
+		self.assertEqual(len(queries), 30)
+		self.assertIn(b'<startTime>2018-06-30_00:00:00</startTime>', queries[-1])
+		self.assertIn(b'<resolution>ONE_DAY</resolution>', queries[-1])
+		# the failedPercentage cannot be computed again unless its operands are summed
+		self.assertEqual(vaas_de._dbONE_shard_queries(query, dict(shards, aggregations={'totalTransactions': 'sum'}), now=now), [query])
+		# nor can ONE_WEEK shards be added up to a month
+		self.assertEqual(vaas_de._dbONE_shard_queries(query, dict(shards, interval={'weeks': 1}, resolution='ONE_WEEK'), now=now), [query])
+		
+		expected = {'total': 0, 'failed': 0, 'time': 0}
+		def post(url, data, **kwargs):
+			start = datetime.datetime.strptime(re.search(rb'<startTime>([^<]*)', data).group(1).decode(), vaas_de.dbONE_time_format)
+			target_time = int(vaas_de.tz.localize(start).timestamp() * 1000)
+			total, failed, response_time = (100 + start.day, start.day % 3, 2.5 * start.day)
+			expected['total'] += total; expected['failed'] += failed; expected['time'] += response_time * total
+			response = requests.Response()
+			response._content = ('totalTransactions,responseTime,failedTransactions,serviceId,failedPercentage,targetTime,serviceId_String,targetTime_String\n'
+			                     '%i,%.10f,%i,7,0,%i,DNS (Pune),day\n' % (total, response_time, failed, target_time)).encode()
+			response.encoding = 'utf-8'
+			return response
+		
+		with mock.patch.object(vaas_de, '_http_post', post):
+			records = list(vaas_de.query_dbONE('nG1', 8443, query, 'user', 'password', shards=shards))
+		
+		self.assertEqual(len(records), 2)
+		row = dict(zip(records[0], records[1]))
+		month = vaas_de.tz.localize(datetime.datetime(*(datetime.datetime.now(vaas_de.tz) - relativedelta(months=1)).timetuple()[:2], 1))
+		self.assertEqual(row['targetTime'], str(int(month.timestamp() * 1000)))
+		self.assertEqual((row['serviceId'], row['serviceId_String']), ('7', 'DNS (Pune)'))
+		self.assertEqual(row['totalTransactions'], str(expected['total']))
+		self.assertEqual(row['failedTransactions'], str(expected['failed']))
+		self.assertAlmostEqual(float(row['failedPercentage']), 100.0 * expected['failed'] / expected['total'])
+		self.assertAlmostEqual(float(row['responseTime']), expected['time'] / expected['total'])
+		self.assertEqual(row['targetTime_String'], vaas_de._dbONE_time(row['targetTime'], pytz.timezone(vaas_de.dimension_cache_settings['timezone'])))
 	
 	
 if __name__ == '__main__':
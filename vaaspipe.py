@@ -1,89 +1,362 @@
 import yaml
 import argparse
+import copy
+import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import lib.vaas_de as vaas_de
 
 # vaaspipe -service service.yml -transformations transformations.yml -notification notification.yml -datasource datasource.yml
-parser = argparse.ArgumentParser(description='VaaS Data Extraction for nGenius by NETSCOUT', 
-                                 usage='vaaspipe -service service.yml -transformations transformations.yml -notification notification.yml -datasource datasource.yml', prog='vasspipe')
+# Several pipelines can share one process (and their identical upstream calls):
+# vaaspipe -service a.yml b.yml -transformations ta.yml tb.yml -notification notification.yml -datasource datasource.yml
+parser = argparse.ArgumentParser(description='VaaS Data Extraction for nGenius by NETSCOUT',
+                                 usage='vaaspipe -service service.yml [service.yml ...] -transformations transformations.yml [transformations.yml ...] -notification notification.yml -datasource datasource.yml', prog='vasspipe')
 
 
 
-parser.add_argument('-s','-service', action="store", dest="service")
-parser.add_argument('-t','-transformations', action="store", dest="transformations")
+parser.add_argument('-s','-service', action="store", dest="service", nargs='+')
+parser.add_argument('-t','-transformations', action="store", dest="transformations", nargs='+')
 parser.add_argument('-n','-notifications', action="store", dest="notifications")
 parser.add_argument('-d','-datasource', action="store", dest="datasource")
+# per-stage cProfile and tracemalloc report, written to the given directory (default: profile)
+parser.add_argument('--profile', action="store", dest="profile", nargs='?', const='profile')
+# dry run: prints the upstream calls (and rows) every pipeline would cause, without extracting or sending anything
+parser.add_argument('--explain', action="store_true", dest="explain")
 
-pipe_setup=parser.parse_args()
+# service categories queried through dbONE
+dbONE_categories = ['Applications', 'Links', 'Service Enablers', 'Unified Communications']
 
-datasource=yaml.load(open(pipe_setup.datasource,"r"))
-transformations=yaml.load(open(pipe_setup.transformations,"r"))
-service=yaml.load(open(pipe_setup.service,"r"))
-notification=yaml.load(open(pipe_setup.notifications,"r"))
 
+def extract(service, query, datasource, columns=None, site=None):
+	'''
+	Records of the service query from one datasource. columns: the nG1 columns the pipeline uses, when its query is projected or enriched.
+	site: parameters of one site of a templated nG1 query
+	'''
+	store = service['Service'].get('trend_store') or {}
+	if store.get('rollup'):
+		# hourly, daily or monthly feed computed from the 5 minute trends kept by the trend feed, instead of querying nGPulse
+		return vaas_de.trend_store_rollup(store, query['Query'])
 
-logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s]:[%(levelname)s]:%(message)s', 
-                    datefmt='%m/%d/%Y %I:%M:%S %p', filename=service['Service']['logging'])
+	if service['Service']['Service_Category'] in dbONE_categories:
+		names = None
+		if columns is not None and service['Service'].get('dbONE_enrichment'):
+			# names of the ids looked up in the local dimension cache instead of converted by nG1
+			names = vaas_de.dimension_names(columns, datasource.get('postGres'))
+		with open(service['Service']['query_file'], 'rb') as query_file:
+			dbONE_query = query_file.read()
+		if site is not None:
+			dbONE_query = vaas_de.dbONE_template(dbONE_query, site)
+		return vaas_de.query_dbONE(datasource.get('nG1_API').get('host'),
+										   datasource.get('nG1_API').get('port'),
+									   dbONE_query,
+									   datasource.get('nG1_API').get('user'),
+									   datasource.get('nG1_API').get('password')
+									   ,ssl=datasource.get('nG1_API').get('ssl')
+									   ,http=datasource.get('nG1_API').get('http')
+									   ,shards=service['Service'].get('dbONE_shards')
+									   ,columns=columns if service['Service'].get('dbONE_projection') else None
+									   ,names=names
+									   )
+	elif service['Service']['Service_Category'] in ['Infrastructure']:
+		return vaas_de.query_nGPulse_server(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
+	elif service['Service']['Service_Category'] in ['VoIP Test']:
+		return vaas_de.query_nGPulse_voip(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
+	elif service['Service']['Service_Category'] in ['Latency Test']:
+		return vaas_de.query_nGPulse_latency(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
+	elif service['Service']['Service_Category'] in ['Ping Test']:
+		return vaas_de.query_nGPulse_ping(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
+	elif service['Service']['Service_Category'] in ['Web Test']:
+		return vaas_de.query_nGPulse_web(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
+	elif service['Service']['Service_Category'] in ['O365 OneDrive Test']:
+		return vaas_de.query_nGPulse_o365_onedrive(datasource['nGPulse'],query['Query'])
+	elif service['Service']['Service_Category'] in ['O365 Outlook Test']:
+		return vaas_de.query_nGPulse_o365_outlook(datasource['nGPulse'],query['Query'])
+	elif service['Service']['Service_Category'] in ['Dimensions']:
+		if service['Service']['query_file'] in dimension_extracts and datasource is default_datasource:
+			return dimension_extracts[service['Service']['query_file']]
+		return vaas_de.query_psql(datasource.get('postGres').get('host'),datasource.get('postGres').get('user'),datasource.get('postGres').get('password'),datasource.get('postGres').get('dbname'),service.get('Service').get('query_file'),
+		                          governor=datasource.get('postGres').get('governor'))
+	else:
+		raise Exception(service['Service']['Service_Category']+' is not a valid Service Category')
 
 
-logging.info("Query File: "+service['Service']['query_file'])
-query_file=open(service['Service']['query_file'], 'rb')
-with open(service['Service']['query_file'], 'rb') as input:
-			query=yaml.load(input)
+def explain(service, query, datasource, columns=None, site=None):
+	'''
+	Plan of the upstream calls extract would make, see vaas_de.explain_report
+	'''
+	store = service['Service'].get('trend_store') or {}
+	if store.get('rollup'):
+		return vaas_de.explain_trend_store(store, query['Query'])
 
+	category = service['Service']['Service_Category']
+	if category in dbONE_categories:
+		with open(service['Service']['query_file'], 'rb') as query_file:
+			dbONE_query = query_file.read()
+		if site is not None:
+			dbONE_query = vaas_de.dbONE_template(dbONE_query, site)
+		return vaas_de.explain_dbONE(datasource.get('nG1_API'), dbONE_query,
+		                             shards=service['Service'].get('dbONE_shards'),
+		                             columns=columns if service['Service'].get('dbONE_projection') else None,
+		                             enriched=columns is not None and bool(service['Service'].get('dbONE_enrichment')))
+	elif category in ['Infrastructure'] or category in vaas_de.nGPulse_test_types:
+		return vaas_de.explain_nGPulse(datasource['nGPulse'], query['Query'], category)
+	elif category in ['Dimensions']:
+		return vaas_de.explain_psql(datasource.get('postGres'), service['Service']['query_file'])
+	else:
+		raise Exception(category+' is not a valid Service Category')
 
-			
-api_response=None
-if service['Service']['Service_Category'] in ['Applications', 'Links', 'Service Enablers', 'Unified Communications']:
-	api_response = vaas_de.query_dbONE(datasource.get('nG1_API').get('host'), 
-									   datasource.get('nG1_API').get('port'), 
-									   query_file,
-									   datasource.get('nG1_API').get('user'), 
-									   datasource.get('nG1_API').get('password')
-									   ,ssl=datasource.get('nG1_API').get('ssl')
-									   )
-elif service['Service']['Service_Category'] in ['Infrastructure']:
-	api_response = vaas_de.query_nGPulse_server(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
-elif service['Service']['Service_Category'] in ['VoIP Test']:
-	api_response = vaas_de.query_nGPulse_voip(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
-elif service['Service']['Service_Category'] in ['Latency Test']:
-	api_response = vaas_de.query_nGPulse_latency(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
-elif service['Service']['Service_Category'] in ['Ping Test']:
-	api_response = vaas_de.query_nGPulse_ping(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
-elif service['Service']['Service_Category'] in ['Web Test']:
-	api_response = vaas_de.query_nGPulse_web(datasource['nGPulse'],query['Query'], ssl=datasource.get('nGPulse').get('ssl'))
-elif service['Service']['Service_Category'] in ['O365 OneDrive Test']:	
-	api_response = vaas_de.query_nGPulse_o365_onedrive(datasource['nGPulse'],query['Query'])
-elif service['Service']['Service_Category'] in ['O365 Outlook Test']:	
-	api_response = vaas_de.query_nGPulse_o365_outlook(datasource['nGPulse'],query['Query'])
-elif service['Service']['Service_Category'] in ['Dimensions']:
-	api_response = vaas_de.query_psql(datasource.get('postGres').get('host'),datasource.get('postGres').get('user'),datasource.get('postGres').get('password'),datasource.get('postGres').get('dbname'),service.get('Service').get('query_file'))
-else:
-	raise Exception(service['Service_Category']+' is not a valid Service Category')
-								   								   
-								   
-query_file.close()
-logging.info("=========== Start Transformations ======")
-
-result =   vaas_de.transformation(api_response, service['Service']['output_format'],
-                                  transformations) 
-
-#timestamp=vaas_de.get_time()
-timestamp=vaas_de.get_time(service['Service']['date_format'])
-
-								  
-attachment_name = service['Service']['filename']+timestamp+'.csv'
-subject = service['Service']['Key']+";"+timestamp
-
-
-if (notification['Notifications']['local_csv']):
-	vaas_de.csv_to_disk(result,attachment_name,notification['Notifications']['local_csv_dir'])
-else:
-	vaas_de.send_notification(notification['Notifications']['smtp_server'],
-                          notification['Notifications']['port'],
-						  notification['Notifications']['from'],
-						  notification['Notifications']['receiver'],
-						  subject,
-						  service['Service']['Description'], 
-						  result, attachment_name)
 
+def explain_pipeline(service, transformations):
+	'''
+	(Key, Service_Category, [(source, plan)]) of a pipeline, fanned out over its datasources or sites as run_pipeline does
+	'''
+	with open(service['Service']['query_file'], 'rb') as input:
+		query=yaml.load(input)
+
+	columns = None
+	projection = service['Service'].get('dbONE_projection')
+	if projection or service['Service'].get('dbONE_enrichment'):
+		columns = vaas_de.transformation_columns(service['Service']['output_format'], transformations)
+		if columns is not None and isinstance(projection, list):
+			columns.update(projection)
+
+	if service['Service'].get('datasources') is not None:
+		plans = [(name, explain(service, copy.deepcopy(query), instance, columns)) for name, instance in service_datasources(service)]
+	elif service['Service'].get('sites') is not None:
+		plans = [(site['site'], explain(service, query, default_datasource, columns, site)) for site in service['Service']['sites']]
+	else:
+		plans = [(None, explain(service, query, default_datasource, columns))]
+	return service['Service']['Key'], service['Service']['Service_Category'], plans
+
+
+def service_datasources(service):
+	'''
+	(name, datasource) of the named datasource instances the service runs against ('datasources': list of names, or all)
+	'''
+	instances = datasource.get('Datasources') or {}
+	names = service['Service']['datasources']
+	if names == 'all':
+		names = list(instances.keys())
+	for name in names:
+		if name not in instances:
+			raise Exception(str(name)+' is not a datasource in '+pipe_setup.datasource)
+	return [(name, instances[name]) for name in names]
+
+
+def run_pipeline(service, transformations):
+
+	vaas_de.set_pipeline_log(service['Service']['logging'])
+	# optional upper bound, in seconds, for all upstream calls of this pipeline
+	vaas_de.set_deadline(service['Service'].get('deadline'))
+
+	logging.info("Query File: "+service['Service']['query_file'])
+	with vaas_de.profile_stage('config'), open(service['Service']['query_file'], 'rb') as input:
+				query=yaml.load(input)
+
+	output_format = service['Service']['output_format']
+
+	# nG1 queries can be cut down to the columns the pipeline uses (plus the listed ones, e.g. columns that split rows),
+	# and the names of their ids looked up locally
+	columns = None
+	projection = service['Service'].get('dbONE_projection')
+	if projection or service['Service'].get('dbONE_enrichment'):
+		columns = vaas_de.transformation_columns(output_format, transformations)
+		if columns is not None and isinstance(projection, list):
+			columns.update(projection)
+
+	extracts = None
+	if service['Service'].get('datasources') is not None:
+		# several customer systems: queried concurrently, every row tagged with the name of its datasource
+		source_column = service['Service'].get('source_column', 'source')
+		extracts = [(name, functools.partial(extract, service, copy.deepcopy(query), instance, columns)) for name, instance in service_datasources(service)]
+	elif service['Service'].get('sites') is not None:
+		# one templated nG1 query per site: queried concurrently, every row tagged with the name of its site
+		if service['Service']['Service_Category'] not in dbONE_categories:
+			raise Exception("'sites' needs a templated nG1 query, not a "+service['Service']['Service_Category']+" service")
+		source_column = service['Service'].get('site_column', 'site')
+		extracts = [(site['site'], functools.partial(extract, service, query, default_datasource, columns, site)) for site in service['Service']['sites']]
+
+	if extracts is None:
+		with vaas_de.profile_stage('parse'):
+			api_response = extract(service, query, default_datasource, columns)
+	else:
+		has_header = 'add_header' not in (transformations.get('Header') or {})
+		api_response = vaas_de.merge_sources(extracts, source_column, has_header)
+		if not has_header:
+			transformations = dict(transformations, Header=dict(transformations['Header'], add_header=transformations['Header']['add_header'] + [source_column]))
+		if source_column not in output_format:
+			output_format = output_format + [source_column]
+
+	store = service['Service'].get('trend_store') or {}
+	if store and not store.get('rollup'):
+		# 5 minute trend feed: its rows are also kept in the local trend store
+		api_response = vaas_de.trend_store_append(api_response, store, (transformations.get('Header') or {}).get('add_header'))
+
+	logging.info("=========== Start Transformations ======")
+
+	if pipe_setup.profile:
+		api_response = vaas_de.profile_iter('parse', api_response)
+
+	# records stream from the extractor through the transformation into the sink
+	result =   vaas_de.transform_records(api_response, output_format,
+	                                     transformations)
+
+	if pipe_setup.profile:
+		result = vaas_de.profile_iter('transform', result)
+
+	# change-only dimension exports: only inserted, updated and deleted rows since the previous export
+	fingerprint = None
+	if service['Service'].get('delta'):
+		with vaas_de.profile_stage('transform'):
+			result, fingerprint = vaas_de.dimension_delta(result, service['Service']['delta'], service['Service']['filename'].strip('_'))
+		if result is None:
+			logging.info("No changes in "+service['Service']['Key']+", nothing to send")
+			vaas_de.save_dimension_fingerprint(fingerprint)
+			return
+
+	#timestamp=vaas_de.get_time()
+	timestamp=vaas_de.get_time(service['Service']['date_format'])
+
+
+	attachment_name = service['Service']['filename']+timestamp+'.csv'
+	subject = service['Service']['Key']+";"+timestamp
+
+
+	# one file or email per value of these output columns, e.g. location
+	partition_by = service['Service'].get('partition_by')
+	if isinstance(partition_by, str):
+		partition_by = [partition_by]
+
+	def database_sink(records):
+		# rows are loaded straight into a table; the service 'database' section names it and its key columns
+		table = service['Service'].get('database') or {}
+		vaas_de.records_to_database(records, notification['Notifications']['database'],
+		                            table.get('table', service['Service']['filename'].strip('_')), table.get('key_columns'),
+		                            transformations.get('Types'))
+
+	def local_csv_sink(records):
+		records = vaas_de.text_records(records, transformations.get('Types'))
+		if partition_by:
+			vaas_de.csv_partitions_to_disk(records, partition_by, attachment_name, notification['Notifications']['local_csv_dir'])
+		else:
+			vaas_de.csv_to_disk(records,attachment_name,notification['Notifications']['local_csv_dir'])
+
+	def email_sink(records):
+		records = vaas_de.text_records(records, transformations.get('Types'))
+		if partition_by:
+			vaas_de.send_partitions(notification['Notifications']['smtp_server'],
+			                        notification['Notifications']['port'],
+			                        notification['Notifications']['from'],
+			                        notification['Notifications']['receiver'],
+			                        subject,
+			                        service['Service']['Description'],
+			                        records, partition_by, attachment_name)
+		else:
+			vaas_de.send_notification(notification['Notifications']['smtp_server'],
+		                          notification['Notifications']['port'],
+								  notification['Notifications']['from'],
+								  notification['Notifications']['receiver'],
+								  subject,
+								  service['Service']['Description'],
+								  records, attachment_name)
+
+	sinks = {'database': database_sink, 'local_csv': local_csv_sink, 'email': email_sink}
+	# a list of sinks gets the same rows at the same time; otherwise the database, the local CSV or the email
+	names = notification['Notifications'].get('sinks')
+	if names is None:
+		names = ['database' if notification['Notifications'].get('database') else 'local_csv' if notification['Notifications']['local_csv'] else 'email']
+	for name in names:
+		if name not in sinks:
+			raise Exception(str(name)+' is not a valid sink')
+
+	with vaas_de.profile_stage('sink'):
+		if len(names) == 1:
+			sinks[names[0]](result)
+		else:
+			vaas_de.tee_sinks(result, [(name, sinks[name]) for name in names])
+
+	if fingerprint is not None:
+		vaas_de.save_dimension_fingerprint(fingerprint)
+
+
+# the run; worker processes of the transformation (see vaas_de._run_plan_processes) import this script without running it
+if __name__ == '__main__':
+	pipe_setup=parser.parse_args()
+
+	if len(pipe_setup.service) != len(pipe_setup.transformations):
+		parser.error('each service configuration needs its own transformations file')
+
+	if pipe_setup.profile:
+		vaas_de.start_profile()
+
+	with vaas_de.profile_stage('config'):
+		datasource=yaml.load(open(pipe_setup.datasource,"r"))
+		# the top-level nG1_API, nGPulse and postGres; named instances are listed under 'Datasources'
+		default_datasource=datasource
+		notification=yaml.load(open(pipe_setup.notifications,"r"))
+		pipelines=[(yaml.load(open(service_file,"r")), yaml.load(open(transformations_file,"r")))
+		           for service_file, transformations_file in zip(pipe_setup.service, pipe_setup.transformations)]
+
+
+	# every pipeline logs to the 'logging' file of its own service configuration; what is logged outside the pipelines
+	# (configuration, shared dimension refresh) goes to the log file of the first one
+	log_formatter = logging.Formatter('[%(asctime)s]:[%(levelname)s]:[%(threadName)s]:%(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+	log_files = []
+	for service, transformations in pipelines:
+		if service['Service']['logging'] not in log_files:
+			log_files.append(service['Service']['logging'])
+	for log_file in log_files:
+		log_handler = logging.FileHandler(log_file)
+		log_handler.setFormatter(log_formatter)
+		log_handler.addFilter(vaas_de.PipelineLogFilter(log_file, default=log_file == log_files[0]))
+		logging.getLogger().addHandler(log_handler)
+	logging.getLogger().setLevel(logging.DEBUG)
+
+	if pipe_setup.explain:
+		print(vaas_de.explain_report([explain_pipeline(service, transformations) for service, transformations in pipelines]))
+		raise SystemExit(0)
+
+
+	# Dimension extracts of the same run are refreshed together: in parallel, over a shared connection pool and from one consistent snapshot
+	dimension_extracts = {}
+	dimension_sqls = [service['Service']['query_file'] for service, transformations in pipelines
+	                  if service['Service']['Service_Category'] in ['Dimensions'] and service['Service'].get('datasources') is None]
+	if len(dimension_sqls) > 1:
+		try:
+			with vaas_de.profile_stage('fetch'):
+				dimension_extracts = vaas_de.query_psql_parallel(datasource.get('postGres').get('host'),datasource.get('postGres').get('user'),datasource.get('postGres').get('password'),datasource.get('postGres').get('dbname'),
+				                                                 dimension_sqls, max_workers=datasource.get('postGres').get('pool_size', 4), governor=datasource.get('postGres').get('governor'))
+		except Exception as e:
+			# every dimension pipeline then runs its own extract
+			logging.error("Parallel dimension refresh failed: "+repr(e))
+
+	try:
+		if len(pipelines) == 1:
+			run_pipeline(*pipelines[0])
+		else:
+			if pipe_setup.profile:
+				# one after another in this thread, the profiled one
+				outcomes = []
+				for service, transformations in pipelines:
+					try:
+						run_pipeline(service, transformations)
+						outcomes.append(None)
+					except Exception as e:
+						outcomes.append(e)
+			else:
+				# pipelines run concurrently so identical upstream calls are in flight together and get coalesced
+				with ThreadPoolExecutor(max_workers=len(pipelines)) as executor:
+					futures = [executor.submit(run_pipeline, service, transformations) for service, transformations in pipelines]
+				outcomes = [future.exception() for future in futures]
+			failed = 0
+			for (service, transformations), exception in zip(pipelines, outcomes):
+				if exception is not None:
+					failed += 1
+					vaas_de.set_pipeline_log(service['Service']['logging'])
+					logging.error("Pipeline "+service['Service']['Key']+" failed: "+repr(exception))
+			vaas_de.set_pipeline_log(None)
+			if failed:
+				raise SystemExit(str(failed)+" of "+str(len(pipelines))+" pipelines failed")
+	finally:
+		if pipe_setup.profile:
+			vaas_de.write_profile(pipe_setup.profile)